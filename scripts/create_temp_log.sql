@@ -3,3 +3,33 @@ CREATE TABLE IF NOT EXISTS temp_log
     livtemp DECIMAL(6, 4),
     date    TIMESTAMP
   );
+
+CREATE TABLE IF NOT EXISTS room_temp
+  (
+    sensor  VARCHAR(20) NOT NULL PRIMARY KEY,
+    room    VARCHAR(32),
+    temp    DECIMAL(6, 4),
+    date    TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+  );
+
+CREATE TABLE IF NOT EXISTS temp_history
+  (
+    sensor  VARCHAR(20) NOT NULL,
+    temp    DECIMAL(6, 4),
+    date    TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (sensor, date),
+    KEY (date)
+  );
+
+CREATE TABLE IF NOT EXISTS temp_rollup
+  (
+    sensor   VARCHAR(20) NOT NULL,
+    period   ENUM('minute', 'hour') NOT NULL,
+    bucket   DATETIME NOT NULL,
+    min_temp DECIMAL(6, 4),
+    max_temp DECIMAL(6, 4),
+    avg_temp DECIMAL(6, 4),
+    samples  INT,
+    PRIMARY KEY (sensor, period, bucket),
+    KEY (period, bucket)
+  );
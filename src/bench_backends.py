@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""Compares the MySQL and SQLite backends for the piheat state.
+
+Replays the same sequence of commands through a StateStore on each backend,
+and reports the time taken to save each command and the number of bytes
+written.  For SQLite this is every byte this process writes (from
+/proc/self/io), for MySQL it is what InnoDB reports writing to its data
+files and redo log.
+
+The MySQL state is put back as it was when the benchmark finishes.  Needs
+the same privileges and .netrc file as piheat.py:
+
+    sudo python bench_backends.py --commands 200
+"""
+import os
+import time
+import argparse
+import tempfile
+import statistics
+
+from piheat import config, DBase, StateStore, close_pools
+
+
+def process_bytes_written():
+    """Gets the number of bytes this process has written so far.
+
+    return: int
+    """
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line.startswith('wchar:'):
+                return int(line.split()[1])
+    return 0
+
+
+def mysql_bytes_written(db):
+    """Gets the number of bytes InnoDB has written, since the server started.
+
+    db: DBase
+    return: int
+    """
+    rows = db.my_query_rows("SHOW GLOBAL STATUS WHERE Variable_name IN "
+                            "('Innodb_data_written', 'Innodb_os_log_written')")
+    return sum(int(value) for name, value in rows)
+
+
+def commands(count):
+    """Builds a repeatable sequence of commands, like those sent by the calendar.
+
+    Every fourth command repeats the one before, so should cost no writes.
+
+    count: int
+    return: list of tuples
+                of the form (function(string), control(string), target_temp(float))
+    """
+    sequence = []
+    for i in range(count):
+        if i % 4 == 3:
+            sequence.append(sequence[-1])
+        else:
+            sequence.append((('CH', 'HW')[i % 2], ('on', 'off')[(i // 2) % 2], 18.0 + (i % 5)))
+    return sequence
+
+
+def run(backend, count):
+    """Saves each command through a StateStore, timing every commit.
+
+    backend: string ('mysql' or 'sqlite')
+    count: int
+    return: dict
+    """
+    db = DBase(backend)
+    db.my_login()
+    pi_state = StateStore(db)
+    pi_state.load()
+    saved = (dict(pi_state), pi_state.target_temp)
+    if backend == 'mysql':
+        written = lambda: mysql_bytes_written(db)
+    else:
+        written = process_bytes_written
+    timings = []
+    start_bytes = written()
+    for function, control, target_temp in commands(count):
+        start = time.perf_counter()
+        pi_state[function] = control
+        pi_state.set_target_temp(target_temp)
+        pi_state.commit()
+        timings.append((time.perf_counter() - start) * 1000.0)
+    bytes_written = written() - start_bytes
+    # Put the state back as it was
+    for function, control in saved[0].items():
+        pi_state[function] = control
+    pi_state.set_target_temp(saved[1])
+    pi_state.commit()
+    db.my_logout()
+    timings.sort()
+    return {'backend': backend,
+            'p50': statistics.median(timings),
+            'p95': timings[int(len(timings) * 0.95) - 1],
+            'mean': statistics.mean(timings),
+            'bytes': bytes_written / float(count)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the piheat state backends.")
+    parser.add_argument('--commands', type=int, default=200,
+                        help="number of commands to replay (default: 200)")
+    parser.add_argument('--backends', nargs='+', default=['mysql', 'sqlite'],
+                        help="backends to compare (default: mysql sqlite)")
+    parser.add_argument('--sqlite-path', default=None,
+                        help="SQLite file to use (default: a temporary file)")
+    args = parser.parse_args()
+
+    tmpdir = None
+    if args.sqlite_path:
+        config.set('database', 'sqlite_path', args.sqlite_path)
+    else:
+        tmpdir = tempfile.mkdtemp()
+        config.set('database', 'sqlite_path', os.path.join(tmpdir, 'bench.db'))
+
+    print("%-8s %10s %10s %10s %14s" % ('backend', 'p50 ms', 'p95 ms', 'mean ms', 'bytes/command'))
+    for backend in args.backends:
+        result = run(backend, args.commands)
+        print("%(backend)-8s %(p50)10.2f %(p95)10.2f %(mean)10.2f %(bytes)14.0f" % result)
+    close_pools()
+
+    if tmpdir:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""Measures how long piheat takes from a command email arriving to the relays switching.
+
+Replays a corpus of calendar notification subjects through Gmail.read_folder,
+against the stand-ins in piheat_sim.py, so needs no Raspberry Pi, Gmail
+account or MySQL server.  For each stage of the command path (IMAP IDLE,
+SEARCH and FETCH, logging in to the database, applying the command to the
+relays, writing the state, ...) the 50th, 95th and 99th percentile and mean
+times are reported, along with the IMAP round trips and memory allocated
+for each command.  Compare the output before and after a change:
+
+    python bench_piheat.py --commands 1000
+"""
+import os
+import math
+import time
+import argparse
+import statistics
+import tracemalloc
+import contextlib
+
+# Must be set before piheat is imported, so it never touches the real GPIO
+os.environ['PIHEAT_SIMULATE'] = 'yes'
+
+import piheat_sim
+from piheat import logging, init_gpio, UID_STATE_FILE, relays, Pio, DBase, StateStore, Gmail, close_pools
+
+GPIO = init_gpio()
+
+
+# Days of the week, as they appear in calendar notifications
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+# Commands as put in calendar event titles
+COMMANDS = ['HWon', 'HWoff', 'CHon', 'CHoff', 'CH = 21', 'CH = 18.5', 'st699on']
+
+
+def corpus(count):
+    """Builds a repeatable list of subjects, like those sent by Google Calendar.
+
+    count: int
+    return: list of string
+    """
+    subjects = []
+    for i in range(count):
+        command = COMMANDS[i % len(COMMANDS)]
+        day = DAYS[(i // len(COMMANDS)) % len(DAYS)]
+        hour = 6 + (i % 16)
+        subjects.append("Notification: %s @ %s %d Jan 2024 %d:00 - %d:30 (GMT)"
+                        % (command, day, 1 + (i % 28), hour, hour))
+    return subjects
+
+
+def percentile(timings, pct):
+    """Nearest-rank percentile.
+
+    timings: list of float (sorted)
+    pct: float (0 to 100)
+    return: float
+    """
+    return timings[max(0, int(math.ceil(pct / 100.0 * len(timings))) - 1)]
+
+
+def setup():
+    """Starts piheat with an empty mailbox and everything off, in the SELECTED state.
+
+    return: tuple
+                of the form (Gmail, StateStore)
+    """
+    piheat_sim.imap_server.reset()
+    if os.path.exists(UID_STATE_FILE):
+        os.remove(UID_STATE_FILE)
+    Pio().st699_on()
+    my_db = DBase()
+    my_db.my_login()
+    piheat_sim.set_room_temp(my_db, 19.0)
+    pi_state = StateStore(DBase('sqlite'))
+    pi_state.load()
+    piheat = Gmail()
+    piheat.login(my_db)
+    pi_state = piheat.read_folder('piheat', 'AUTH', pi_state, idle_timeout=0)
+    return piheat, pi_state
+
+
+def replay(subjects, trace=False):
+    """Emails each subject to the simulated mailbox, and has piheat act on it.
+
+    subjects: list of string
+    trace: boolean
+                measure the memory allocated for each command with tracemalloc,
+                which slows everything down, so is done in a separate run
+    return: list of dict
+                one per command, of the form {stage(string): seconds(float)},
+                plus 'total', 'switch' (email delivered to the first relay
+                change, if any), 'round_trips' and 'allocated' (bytes)
+    """
+    piheat, pi_state = setup()
+    results = []
+    if trace:
+        tracemalloc.start()
+    for subject in subjects:
+        changes = len(GPIO.history)
+        if trace:
+            tracemalloc.clear_traces()
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        delivered = time.time()
+        piheat_sim.imap_server.deliver(subject)
+        pi_state = piheat.read_folder('piheat', 'SELECTED', pi_state, idle_timeout=1)
+        result = dict(piheat.stage_times)
+        result['total'] = time.perf_counter() - start
+        if len(GPIO.history) > changes:
+            result['switch'] = GPIO.history[changes][0] - delivered
+        result['round_trips'] = piheat.round_trips
+        if trace:
+            result['allocated'] = tracemalloc.get_traced_memory()[1] - before
+        results.append(result)
+    if trace:
+        tracemalloc.stop()
+    piheat.logout()
+    return results
+
+
+def report(results, trace_results):
+    """Prints the timings for each stage, then the round trips and allocations."""
+    stages = sorted(set(stage for result in results for stage in result)
+                    - set(['total', 'switch', 'round_trips']))
+    print("%-12s %10s %10s %10s %10s" % ('stage', 'p50 ms', 'p95 ms', 'p99 ms', 'mean ms'))
+    for stage in stages + ['switch', 'total']:
+        timings = sorted(result[stage] * 1000.0 for result in results if stage in result)
+        if not timings:
+            continue
+        print("%-12s %10.3f %10.3f %10.3f %10.3f" % (stage, percentile(timings, 50), percentile(timings, 95),
+                                                     percentile(timings, 99), statistics.mean(timings)))
+    round_trips = [result['round_trips'] for result in results]
+    print("IMAP round trips per command: mean %.2f, max %d" % (statistics.mean(round_trips), max(round_trips)))
+    if trace_results:
+        allocated = sorted(result['allocated'] / 1024.0 for result in trace_results)
+        print("Peak KiB allocated per command: p50 %.1f, p99 %.1f, max %.1f"
+              % (percentile(allocated, 50), percentile(allocated, 99), allocated[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the piheat command path against local fakes.")
+    parser.add_argument('--commands', type=int, default=500,
+                        help="number of command emails to replay (default: 500)")
+    parser.add_argument('--no-allocations', action='store_true',
+                        help="skip the (slower) tracemalloc run")
+    args = parser.parse_args()
+
+    # Only errors are of interest, and the commands are sent faster than the relays are allowed to switch
+    logging.getLogger().setLevel(logging.ERROR)
+    relays.min_dwell = 0
+    subjects = corpus(args.commands)
+    # check_subject and Pio print as they go
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = replay(subjects)
+        trace_results = None if args.no_allocations else replay(subjects, trace=True)
+    close_pools()
+    report(results, trace_results)
+
+
+if __name__ == "__main__":
+    main()
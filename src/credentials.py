@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""Login details for piheat.py and templog.py.
+
+Details are looked up, in order, from:
+    1. environment variables, e.g. for machine 'imap.gmail.com':
+           PIHEAT_IMAP_GMAIL_COM_LOGIN, PIHEAT_IMAP_GMAIL_COM_ACCOUNT
+           and PIHEAT_IMAP_GMAIL_COM_PASSWORD
+    2. a systemd credential (LoadCredential=) named after the machine,
+       written in .netrc format, in $CREDENTIALS_DIRECTORY
+    3. the user's ~/.netrc file
+
+Parsed files are cached for the life of the process.  A file's modification
+time is only checked every CHECK_INTERVAL seconds, and it is only parsed
+again if that has changed, so a changed .netrc is picked up without a
+restart, but looking up a login doesn't normally touch the SD card.
+"""
+import os
+import re
+import time
+import netrc
+import threading
+
+
+# Seconds between checking whether a cached file has changed
+CHECK_INTERVAL = 30
+
+# Cached files, stored as {path: (mtime, time last checked, netrc.netrc)}
+_cache = {}
+_lock = threading.Lock()
+
+
+
+def _env_secrets(machine):
+    """Looks for login details in the environment.
+
+    machine: string
+    return: tuple (or None if there is no password set)
+                of the form (login(string), account(string), password(string))
+    """
+    prefix = 'PIHEAT_' + re.sub(r'[^A-Z0-9]', '_', machine.upper()) + '_'
+    password = os.environ.get(prefix + 'PASSWORD')
+    if password is None:
+        return None
+    return (os.environ.get(prefix + 'LOGIN', ''),
+            os.environ.get(prefix + 'ACCOUNT'),
+            password)
+
+
+def _home_netrc():
+    """The user's own .netrc file, which netrc.netrc() reads when given no path.
+
+    return: string
+    """
+    return os.path.join(os.path.expanduser('~'), '.netrc')
+
+
+def _load(path):
+    """Gets a parsed netrc file from the cache, re-reading it if it has changed.
+
+    path: string
+    return: netrc.netrc (or None if the file doesn't exist)
+    """
+    now = time.time()
+    with _lock:
+        cached = _cache.get(path)
+        if cached and (now - cached[1]) < CHECK_INTERVAL:
+            return cached[2]
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            _cache.pop(path, None)
+            return None
+        if cached and cached[0] == mtime:
+            _cache[path] = (mtime, now, cached[2])
+            return cached[2]
+        if path == _home_netrc():
+            # With no path given, netrc refuses a file others can read, or that isn't ours
+            parsed = netrc.netrc()
+        else:
+            parsed = netrc.netrc(path)
+        _cache[path] = (mtime, now, parsed)
+        return parsed
+
+
+def get_secrets(machine):
+    """Provides the log in data for a machine.
+
+    machine: string
+    return: tuple (or None if there are no details for the machine)
+                of the form (login(string), account(string), password(string))
+    """
+    secrets = _env_secrets(machine)
+    if secrets:
+        return secrets
+    paths = []
+    if os.environ.get('CREDENTIALS_DIRECTORY'):
+        paths.append(os.path.join(os.environ['CREDENTIALS_DIRECTORY'], machine))
+    paths.append(_home_netrc())
+    for path in paths:
+        parsed = _load(path)
+        if parsed is not None:
+            secrets = parsed.authenticators(machine)
+            if secrets:
+                return secrets
+    return None
+
+
+def clear_cache():
+    """Forgets every cached file, so they are read again on next use."""
+    with _lock:
+        _cache.clear()
@@ -15,42 +15,81 @@ Needs to produce these signals in order to replace old programmer
 |ch_on    ||    0    ||    1    ||   1    |
  =========================================
 """
+import time
+# When this module started loading, for the startup profile logged in debug mode
+import_started = time.perf_counter()
 import sys
-
-# Imports for reading from gmail
-import imaplib2
-import email
-import netrc
-
-# Imports for communicating with superhub
-import urllib.parse
-import requests
+import os
+import signal
+import asyncio
+import json
+import socket
+import threading
+import datetime
+import heapq
+import random
+import tempfile
+import importlib
+import contextlib
+import collections
+import configparser
 import re
-from bs4 import BeautifulSoup
+import credentials
+# The heavier modules (imaplib2, email, requests, BeautifulSoup, MySQLdb,
+# sqlite3 and RPi.GPIO) are only imported when first needed, see lazy_import()
 
 import logging
+import piheat_log
+# Any argument (e.g. 'sudo python piheat.py debug') logs everything to the console
 try:
     debug = sys.argv[1]
 except:
     debug = False
-if debug:
-    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
-else:
-    logging.basicConfig(filename='/var/log/piheat.log', level=logging.DEBUG, format='%(asctime)s %(message)s')
-#    logging.basicConfig(filename='/var/log/piheat.log', level=logging.INFO, format='%(asctime)s %(message)s')
 
-# Import python MySQL module
-import MySQLdb
+# Seconds taken by each step of starting up, stored as {step(string): seconds(float)}
+startup_times = {}
+
+
+def lazy_import(name):
+    """Imports a module the first time it is needed, timing how long that takes.
+
+    Keeps the modules only used on rare paths (e.g. BeautifulSoup for
+    resetting the SuperHub) from slowing down every start of the service.
+
+    name: string (e.g. 'bs4' or 'urllib.parse')
+    return: module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    startup_times['import ' + name] = time.perf_counter() - start
+    return module
+
+
+# Settings that can be changed without editing this file
+CONFIG_FILE = os.environ.get('PIHEAT_CONFIG', '/etc/piheat.conf')
+config = configparser.ConfigParser()
+config.read_dict({'database': {'state_backend': 'mysql',
+                               'sqlite_path': '/var/lib/piheat/piheat.db'},
+                  'push': {'listen': '', 'allow': '', 'max_age': '180'},
+                  'schedule': {'ical': '', 'days': '14'},
+                  'logging': piheat_log.DEFAULTS,
+                  'simulation': {'enabled': os.environ.get('PIHEAT_SIMULATE', 'no')}})
+config.read(CONFIG_FILE)
 
+# Buffered in RAM and rate limited, see piheat_log.py
+piheat_log.setup('piheat', config, console=bool(debug))
 
-"""GPIO setup"""
-# Import a Raspberry Pi GPIO module
-import RPi.GPIO as GPIO
+# Run without the Pi, Gmail or MySQL, using the stand-ins in piheat_sim.py
+SIMULATE = config.getboolean('simulation', 'enabled')
+if SIMULATE:
+    import piheat_sim
+
+# The database connection pools, one per backend, created as they are needed
+pools = {}
+pools_lock = threading.Lock()
 
-# Turn off GPIO warnings
-GPIO.setwarnings(False)
-# Set the GPIO numbering convention to be header pin numbers
-GPIO.setmode(GPIO.BOARD)
 
 # Define which RPi pins connect to which relays
 ST699   = 11
@@ -59,60 +98,334 @@ DHW_ON  = 15
 CH_ON   = 16
 gpio_outputs = {'dhw_off':DHW_OFF, 'dhw_on':DHW_ON, 'ch_on':CH_ON}
 
-# Configure each GPIO pin as an output & initialise
-GPIO.setup(ST699, GPIO.OUT, initial = 1)
-for relay in gpio_outputs.values():
-    GPIO.setup(relay, GPIO.OUT, initial = 0)
-"""End of GPIO setup"""
+# The Raspberry Pi GPIO module, set by init_gpio()
+GPIO = None
+
+
+def init_gpio():
+    """GPIO setup.
+
+    Imports the Raspberry Pi GPIO module (or, when simulating, one that only
+    pretends to be), and configures each relay pin as an output, with the
+    ST699 in control and every relay off.  Only does anything the first
+    time it is called.
+
+    return: module (RPi.GPIO, or a piheat_sim.FakeGPIO)
+    """
+    global GPIO
+    if GPIO is not None:
+        return GPIO
+    start = time.perf_counter()
+    if SIMULATE:
+        gpio = piheat_sim.FakeGPIO()
+    else:
+        gpio = lazy_import('RPi.GPIO')
+    # Turn off GPIO warnings
+    gpio.setwarnings(False)
+    # Set the GPIO numbering convention to be header pin numbers
+    gpio.setmode(gpio.BOARD)
+    # Configure each GPIO pin as an output & initialise
+    gpio.setup(ST699, gpio.OUT, initial = 1)
+    for relay in gpio_outputs.values():
+        gpio.setup(relay, gpio.OUT, initial = 0)
+    GPIO = gpio
+    startup_times['GPIO setup'] = time.perf_counter() - start
+    return GPIO
+
+
+# Stops the thermostat and command handling switching relays at the same time
+relay_lock = threading.RLock()
+
+# IMAP FETCH item for just the Subject and Date headers.  PEEK leaves the \Seen flag alone.
+HEADER_FETCH = '(BODY.PEEK[HEADER.FIELDS (SUBJECT DATE)])'
+
+# The command in an email subject, e.g. 'HWon', 'st699off' or 'CH = 21.5 @ Tue 7 Jan 2020 06:30',
+# matched in one pass.  The function mustn't be part of a longer word.
+COMMAND_PATTERN = re.compile(r'(?<![A-Za-z0-9])(?P<target>st699|CH|HW)'
+                             r'(?:\s*(?P<action>on|off)(?![A-Za-z0-9])|\s*=\s*(?P<setpoint>[-+]?\d+(?:\.\d+)?))'
+                             r'(?:\s*@\s*(?P<at>.*))?')
+# The start time in a calendar notification, e.g. '7 Jan 2020 06:30' or '6:30am'
+AT_PATTERN = re.compile(r'(?:(?P<day>\d{1,2}) (?P<month>[A-Za-z]{3})[A-Za-z]* (?P<year>\d{4}) )?'
+                        r'(?P<hour>\d{1,2})(?::(?P<minute>\d{2}))?\s*(?P<ampm>am|pm)?', re.IGNORECASE)
+MONTHS = dict((month, number) for number, month in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], 1))
+
+# How long (in seconds) a successful, or failed, connection check is trusted for
+NET_CHECK_TTL = 60
+NET_CHECK_FAIL_TTL = 5
+
+# The SuperHub is rebooted once the connection has been down for
+# HUB_RESET_AFTER seconds, at most once in HUB_RESET_INTERVAL seconds, and
+# each request to it gives up after HUB_TIMEOUT
+HUB_RESET_AFTER = 300
+HUB_RESET_INTERVAL = 3600
+HUB_TIMEOUT = 10
+
+# Thermostat: seconds between checks, degrees below target before turning
+# back on, and the shortest time (in seconds) to stay on or off
+THERMOSTAT_PERIOD = 60
+THERMOSTAT_HYSTERESIS = 0.3
+THERMOSTAT_MIN_ON = 300
+THERMOSTAT_MIN_OFF = 300
+
+# Seconds to wait in IMAP IDLE before checking in, between temperature
+# polls, and for any other blocking call before giving up on it
+IDLE_TIMEOUT = 600
+TEMP_POLL_PERIOD = 30
+CALL_TIMEOUT = 30
+
+# Reconnecting to Gmail: seconds to wait after the first failure, doubling
+# with each failure after that up to the most, with up to half taken off at
+# random so a house full of devices don't all retry together
+RECONNECT_MIN = 2
+RECONNECT_MAX = 300
+
+# Shortest time (in seconds) between two changes to the same relay
+RELAY_MIN_DWELL = 2
+
+# Where the UIDVALIDITY and last processed UID, and the learned warm-up
+# rate, are saved between restarts
+UID_STATE_FILE = '/var/lib/piheat/uid_state.json'
+WARMUP_STATE_FILE = '/var/lib/piheat/warmup.json'
+SCHEDULE_FILE = '/var/lib/piheat/schedule.json'
+if SIMULATE:
+    UID_STATE_FILE = os.path.join(tempfile.gettempdir(), 'piheat_sim_uid_state.json')
+    WARMUP_STATE_FILE = os.path.join(tempfile.gettempdir(), 'piheat_sim_warmup.json')
+    SCHEDULE_FILE = os.path.join(tempfile.gettempdir(), 'piheat_sim_schedule.json')
+
+
+def make_state_dir(path):
+    """Creates the directory a state file is kept in (e.g. /var/lib/piheat), if it isn't there yet.
+
+    Nothing else creates it on a fresh install.
+
+    path: string (the state file)
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+# Local schedule: a command emailed at the same time each week is expected
+# again, until none has come for SCHEDULE_KEEP_DAYS.  The schedule is checked
+# at least every SCHEDULE_CHECK seconds.
+SCHEDULE_KEEP_DAYS = 21
+SCHEDULE_CHECK = 60
+
+# Pre-heat: the longest (in seconds) to start heating before a 'CH = n @ time'
+# event, the smallest rise (in degrees) worth learning from, and how much each
+# older heating run is weighted down by when a new one is learned
+PREHEAT_MAX = 4 * 3600
+WARMUP_MIN_RISE = 0.5
+WARMUP_DECAY = 0.95
 
 
 
 class CheckNet(object):
+    """Cheap check of the internet connection, with the result cached.
+
+    Rather than downloading a web page, the probe just opens (and closes) a
+    TCP connection to the IMAP server that piheat needs anyway.  A result
+    is reused for ttl seconds (fail_ttl seconds if the probe failed), so the
+    main loop can call test() on every pass without a network round trip.
+    If url is given, a HEAD request on a reused requests.Session is used
+    as the probe instead.
+    """
+
+    def __init__(self, ttl=NET_CHECK_TTL, fail_ttl=NET_CHECK_FAIL_TTL,
+                 host='imap.gmail.com', port=993, timeout=5, url=None):
+        self.ttl = ttl
+        self.fail_ttl = fail_ttl
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.url = url
+        self.session = None
+        self.last_result = None
+        self.last_checked = 0
+
+
+    def probe(self):
+        """Checks the connection right now, ignoring any cached result.
 
-    def test(self):
-        """Trys connecting to a reliable website.
-        
         return: boolean
         """
+        if SIMULATE:
+            return True
+        if self.url:
+            requests = lazy_import('requests')
+            if self.session is None:
+                self.session = requests.Session()
+            try:
+                rv = self.session.head(self.url, timeout=self.timeout)
+                logging.debug(("Response code: ", rv.status_code))
+                return True
+            except requests.RequestException:
+                return False
         try:
-            rv = requests.get("http://www.google.com")
-            logging.debug(("Response code: ", rv.status_code))
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            sock.close()
             return True
-        except requests.ConnectionError:
-            logging.error("Could not connect to website. Lost internet connection?")
+        except (socket.error, socket.timeout):
             return False
 
+
+    def test(self):
+        """Returns whether the internet connection is up.
+
+        The last result is returned if it is recent enough, otherwise the
+        connection is probed again.
+
+        return: boolean
+        """
+        if self.last_result is not None:
+            ttl = self.ttl if self.last_result else self.fail_ttl
+            if (time.time() - self.last_checked) < ttl:
+                return self.last_result
+        self.last_result = self.probe()
+        self.last_checked = time.time()
+        if not self.last_result:
+            logging.error(("Could not connect to", self.url or self.host, "Lost internet connection?"))
+        return self.last_result
+
+
+    def invalidate(self):
+        """Forgets the cached result, e.g. after resetting the hub."""
+        self.last_result = None
+
+
+    def get_status(self):
+        """Gets the last probe result and how old it is.
+
+        return: tuple
+                    (result(boolean or None), age in seconds(float))
+        """
+        return self.last_result, time.time() - self.last_checked
+
     
     
+# A command parsed from an email subject by parse_command().
+#   target:   'st699', 'CH' or 'HW'
+#   action:   'on' or 'off' ('CH = n' is 'on', with a setpoint)
+#   setpoint: float (the target temperature, or None)
+#   at:       datetime.datetime (when the calendar event starts, or None)
+Command = collections.namedtuple('Command', ['target', 'action', 'setpoint', 'at'])
+
+
+def parse_command(subject):
+    """Turns an email subject into a Command, in a single regex pass.
+
+    subject: string
+    return: Command (or None if the subject doesn't hold a command)
+    """
+    found = COMMAND_PATTERN.search(subject)
+    if not found:
+        return None
+    target, action, setpoint, at = found.group('target', 'action', 'setpoint', 'at')
+    if setpoint is not None:
+        # Only the heating has a target temperature
+        if target != 'CH':
+            return None
+        action = 'on'
+        setpoint = float(setpoint)
+    return Command(target, action, setpoint, parse_time(at) if at else None)
+
+
+def parse_time(text, now=None):
+    """Reads the start time from the '@ ...' part of a calendar notification.
+
+    text: string (e.g. 'Tue 7 Jan 2020 06:30 - 07:30 (GMT)', or just '6:30am')
+    now: datetime.datetime (optional)
+                used for the date when the text only has a time
+    return: datetime.datetime (or None if no time could be found)
+    """
+    found = AT_PATTERN.search(text)
+    if not found or (found.group('minute') is None and found.group('ampm') is None):
+        return None
+    hour = int(found.group('hour'))
+    minute = int(found.group('minute') or 0)
+    ampm = (found.group('ampm') or '').lower()
+    if ampm:
+        hour = hour % 12 + (12 if ampm == 'pm' else 0)
+    try:
+        if found.group('day'):
+            month = MONTHS.get(found.group('month').lower())
+            if month is None:
+                return None
+            return datetime.datetime(int(found.group('year')), month, int(found.group('day')), hour, minute)
+        now = now or datetime.datetime.now()
+        return now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    except ValueError:
+        return None
+
+
+
 class UserData(object):
     def get_secrets(self, machine):
         """Class method to provide log in data for other classes.
         
+        The details come from credentials.py, which caches the parsed
+        .netrc file, so this is cheap to call as often as needed.
+
         machine: string
         return: tuple
                     of the form (login(string), account(string), password(string))
         """
-        secrets = netrc.netrc()
-        return secrets.authenticators(machine)
+        return credentials.get_secrets(machine)
 
 
 
 class Gmail(object):
 
-    def login(self):
+    def __init__(self, piheat_db=None):
+        """A Gmail command handler.
+
+        piheat_db: DBase (optional)
+                    the database session to use, even before logging in (e.g.
+                    for the local schedule, when there is no internet at startup)
+        """
+        self.mail = None
+        self.piheat_db = piheat_db
+        self.commands = ["st699", "CH", "HW"]
+        self.target_temp = None
+#        self.pi_state = {}
+        # Incremental mailbox tracking, restored by load_uid_state on SELECT
+        self.mailbox = None
+        self.uidvalidity = None
+        self.last_uid = 0
+        self.kept_uids = {}
+        # UIDs of old messages waiting to be deleted, and IMAP round trip count
+        self.del_uids = []
+        self.round_trips = 0
+        # Seconds spent in each stage of the last wake-up, see timed()
+        self.stage_times = {}
+        # A heating command for later, as (uid, Command), see defer_preheat()
+        self.preheat = None
+        # Stops the runtime starting a pre-heat while an email is being acted on
+        self.lock = threading.RLock()
+        # Held by read_folder, so a read can't overlap a reconnect, or another read
+        self.reading = threading.Lock()
+
+
+    def login(self, piheat_db=None):
         """Log in to Gmail account.
         
+        piheat_db: DBase (optional)
+                    a database session to share, rather than opening another
         return: boolean
                     (True:  if successfully reach the 'AUTH' state)
                     (False: if not)
         """
         mailhost = 'imap.gmail.com'
         g_secrets = UserData()
-        self.mail = imaplib2.IMAP4_SSL(host=mailhost, debug=4, timeout=5)
-        self.piheat_db = DBase()
-        self.commands = ["st699", "CH", "HW"]
-        self.target_temp = None
-#        self.pi_state = {}
+        if SIMULATE:
+            self.mail = piheat_sim.imap_server.connect()
+        else:
+            imaplib2 = lazy_import('imaplib2')
+            self.mail = imaplib2.IMAP4_SSL(host=mailhost, debug=config.getint('logging', 'imap_debug'), timeout=5)
+        if piheat_db is not None:
+            self.piheat_db = piheat_db
+        elif self.piheat_db is None:
+            self.piheat_db = DBase()
 
         # Read from .netrc file
         login, account, password = g_secrets.get_secrets(mailhost)
@@ -133,7 +446,9 @@ class Gmail(object):
         
         return: string ('NONAUTH', 'AUTH', or 'SELECTED')
         """
-        logging.debug(self.mail.state)
+        if self.mail is None:
+            # Haven't tried to log in yet
+            return 'NONAUTH'
         return self.mail.state
             
 
@@ -163,9 +478,88 @@ class Gmail(object):
         return: tuple
                     (response(string), message(string))
         """
-        return self.mail.select(mailbox)
+        return self.imap('select', mailbox)
         
         
+    def select_mailbox(self, mailbox):
+        """Selects mailbox, and restores the last processed UID for it.
+
+        mailbox: string
+        """
+        logging.debug("Select mailbox")
+        response, empty = self.select(mailbox)
+        if response != 'OK':
+            logging.error("Response was:")
+            logging.error(response)
+            raise RuntimeError("read_folder:  Could not select mailbox.")
+        message = "Mailbox " + mailbox + " selected."
+        logging.debug(message)
+        self.load_uid_state(mailbox)
+
+
+    def imap(self, command, *args):
+        """Sends an IMAP command to the server, counting the round trip.
+
+        command: string
+                    name of the imaplib2 method, e.g. 'uid'
+        *args: the arguments for that method
+        return: tuple
+                    (response(string), data(list))
+        """
+        self.round_trips += 1
+        return getattr(self.mail, command)(*args)
+
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """Adds the time spent in a with block to self.stage_times[stage].
+
+        Used by bench_piheat.py to show where the time goes between an
+        email arriving and the relays switching.
+
+        stage: string
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_times[stage] = self.stage_times.get(stage, 0.0) + time.perf_counter() - start
+
+
+    def message_set(self, uids):
+        """Builds a compact IMAP message set, e.g. [1, 2, 3, 7] gives '1:3,7'.
+
+        uids: list of int
+        return: string
+        """
+        ranges = []
+        for uid in sorted(uids):
+            if ranges and uid == ranges[-1][1] + 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+        return ','.join(str(first) if first == last else '%d:%d' % (first, last)
+                        for first, last in ranges)
+
+
+    def delete_messages(self):
+        """Flags every message queued by check_commands as deleted, in one go.
+
+        A single UID STORE covers the whole batch, and the mailbox is only
+        expunged if something was actually flagged.
+
+        return: int
+                    the number of messages deleted
+        """
+        if not self.del_uids:
+            return 0
+        del_uids, self.del_uids = sorted(set(self.del_uids)), []
+        self.imap('uid', 'STORE', self.message_set(del_uids), '+FLAGS.SILENT', '(\\Deleted)')
+        self.imap('expunge')
+        logging.debug(("Deleted", len(del_uids), "old emails"))
+        return len(del_uids)
+
+
     def get_commands(self):
         """Gets the list of commands and returns it.
         
@@ -182,14 +576,214 @@ class Gmail(object):
         return self.target_temp
 
 
-    def read_folder(self, mailbox, mail_state, pi_state):
-        """Selects mailbox and waits for new email, then returns its subject header.
+    def parse_headers(self, raw_header):
+        """Pulls the subject and date out of a header-only FETCH response.
+
+        Much lighter than building a full email.message object, as the
+        response only holds the two headers, e.g.
+        'Subject: HWon\\r\\nDate: Mon, 6 Jan 2020 06:30:00 +0000\\r\\n\\r\\n'.
+
+        raw_header: bytes or string
+        return: tuple
+                    of the form (subject(string), sent(float))
+                    where subject is empty if there is no Subject header, and
+                    sent is the Date as a Unix time, or None if it is missing
+        """
+        if isinstance(raw_header, bytes):
+            raw_header = raw_header.decode('utf-8', 'replace')
+        # Unfold any long header that has been split over several lines
+        raw_header = re.sub(r'\r?\n[ \t]+', ' ', raw_header)
+        subject = ''
+        sent = None
+        for line in raw_header.splitlines():
+            if line[:8].lower() == 'subject:':
+                subject = line[8:].strip()
+                if '=?' in subject:
+                    # Only decode RFC2047 encoded-words when there are some
+                    header = lazy_import('email.header')
+                    subject = str(header.make_header(header.decode_header(subject)))
+            elif line[:5].lower() == 'date:':
+                try:
+                    sent = lazy_import('email.utils').parsedate_to_datetime(line[5:].strip()).timestamp()
+                except (TypeError, ValueError, IndexError):
+                    logging.warning(("Can't read the date", line))
+        return subject, sent
+
+
+    def load_uid_state(self, mailbox):
+        """Restores the last processed UID for the selected mailbox.
+
+        The high-water mark is kept in UID_STATE_FILE so that a restart
+        doesn't re-apply mail that has already been acted on.  It is only
+        trusted if the server's UIDVALIDITY hasn't changed since it was saved.
+        If there is nothing usable saved, only mail arriving from now on is
+        processed, as main() has already restored the last state from MySQL.
+
+        After a reconnect to the same mailbox, carries on from the UID
+        already reached, even if it couldn't be saved.
+
+        mailbox: string
+        """
+        empty, data = self.mail.response('UIDVALIDITY')
+        uidvalidity = int(data[0])
+        if (self.mailbox == mailbox) and (self.uidvalidity == uidvalidity) and self.last_uid:
+            logging.debug(("Reconnected, resuming from UID", self.last_uid))
+            return
+        self.mailbox = mailbox
+        self.uidvalidity = uidvalidity
+        self.kept_uids = {}
+        try:
+            with open(UID_STATE_FILE) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            saved = {}
+        if (saved.get('mailbox') == mailbox) and (saved.get('uidvalidity') == self.uidvalidity):
+            self.last_uid = saved['last_uid']
+            self.kept_uids = saved.get('kept', {})
+            if saved.get('preheat'):
+                # Its email is behind the high-water mark, so won't be read again
+                uid, target, action, setpoint, at = saved['preheat']
+                self.preheat = (uid, Command(target, action, setpoint, datetime.datetime.fromisoformat(at)))
+                logging.info(("Still heating to", setpoint, "by", at))
+            logging.debug(("Resuming from UID", self.last_uid))
+            return
+        empty, data = self.mail.response('UIDNEXT')
+        if data and data[0]:
+            self.last_uid = int(data[0]) - 1
+        else:
+            empty, data = self.imap('uid', 'SEARCH', None, 'ALL')
+            uids = data[0].split()
+            self.last_uid = int(uids[-1]) if uids else 0
+        logging.info(("No saved UID for", mailbox, "starting after UID", self.last_uid))
+        self.save_uid_state()
+
+
+    def save_uid_state(self):
+        """Writes the UID high-water mark, and any held back pre-heat, to UID_STATE_FILE."""
+        if self.mailbox is None:
+            # Not selected yet, so there is nothing to save, and the saved mark must be kept
+            return
+        preheat = None
+        if self.preheat is not None:
+            uid, command = self.preheat
+            preheat = [uid, command.target, command.action, command.setpoint, command.at.isoformat()]
+        saved = {'mailbox': self.mailbox,
+                 'uidvalidity': self.uidvalidity,
+                 'last_uid': self.last_uid,
+                 'kept': self.kept_uids,
+                 'preheat': preheat}
+        try:
+            make_state_dir(UID_STATE_FILE)
+            with open(UID_STATE_FILE + '.tmp', 'w') as f:
+                json.dump(saved, f)
+            os.rename(UID_STATE_FILE + '.tmp', UID_STATE_FILE)
+        except (IOError, OSError):
+            logging.error(("Could not save UID state to", UID_STATE_FILE))
+
+
+    def new_uids(self):
+        """Asks the server for the UIDs of messages newer than self.last_uid.
+
+        'UID n:*' always matches the highest UID in the mailbox, even when it
+        is lower than n, so anything already processed is filtered out.
+
+        return: list of int (in ascending order)
+        """
+        empty, data = self.imap('uid', 'SEARCH', None, 'UID', '%d:*' % (self.last_uid + 1))
+        if not data or not data[0]:
+            return []
+        uids = [int(uid) for uid in data[0].split()]
+        return sorted(uid for uid in uids if uid > self.last_uid)
+
+
+    def fetch_headers(self, uids):
+        """Fetches the subject and date of each message, in a single UID FETCH.
+
+        uids: list of int
+        return: dict
+                    of the form {uid(int): (subject(string), sent(float))}, see parse_headers
+        """
+        # 'empty' collects the response from 'self.imap'
+        empty, data = self.imap('uid', 'FETCH', self.message_set(uids), HEADER_FETCH)
+        headers = {}
+        for response_part in data:
+            if isinstance(response_part, tuple):
+                envelope = response_part[0]
+                if isinstance(envelope, bytes):
+                    envelope = envelope.decode('ascii', 'replace')
+                found = re.search(r'UID (\d+)', envelope)
+                if found:
+                    headers[int(found.group(1))] = self.parse_headers(response_part[1])
+        return headers
+
+
+    def queue_commands(self, uids, headers):
+        """Turns the new messages into an ordered queue of commands.
+
+        The messages are put in the order they were sent (by their Date
+        header, then by UID), and only the last command for each function is
+        kept, so when several calendar events fire together each function
+        ends up as the most recent event says.  The messages with the
+        commands that were overridden are queued for deletion.
+
+        uids: list of int
+        headers: dict
+                    of the form {uid(int): (subject(string), sent(float))}
+        return: list of tuples
+                    of the form (uid(int), Command), in the order sent
+        """
+        latest = {}
+        for uid in uids:
+            var_subject, sent = headers.get(uid, ('', None))
+            logging.debug(("Message", uid, "subject is.....", var_subject))
+            command = parse_command(var_subject)
+            if command is None:
+                logging.warning(("No command found in", var_subject))
+                continue
+            # Messages without a Date are taken to be the most recent
+            order = (float('inf') if sent is None else sent, uid)
+            if command.target in latest:
+                if latest[command.target][0] > order:
+                    logging.debug(("Message", uid, "was overridden by", latest[command.target][1]))
+                    self.del_uids.append(uid)
+                    continue
+                logging.debug(("Message", latest[command.target][1], "was overridden by", uid))
+                self.del_uids.append(latest[command.target][1])
+            latest[command.target] = (order, uid, command)
+        return [(uid, command) for order, uid, command in sorted(latest.values())]
+
+
+    def read_folder(self, mailbox, mail_state, pi_state, idle_timeout=None):
+        """Selects mailbox and waits for new email, then acts on each new command.
         
+        Only messages with a UID above the saved high-water mark are fetched,
+        and the commands in all of them are applied together, see
+        queue_commands and check_commands.
+
         mailbox: string
         mail_state: string ('NONAUTH', 'AUTH', or 'SELECTED')
+        pi_state: StateStore
+        idle_timeout: int (optional)
+                    seconds to wait in IDLE, otherwise the server's limit of 29 minutes
         
-        return: string
+        Only one read can run at a time.  A read abandoned by a timed out
+        IDLE is finished (or has failed) before MailSupervisor.reconnect()
+        logs in again, and stops rather than going on to read from the
+        new connection.
+
+        return: dict
+                    the updated pi_state
         """
+        if not self.reading.acquire(timeout=CALL_TIMEOUT):
+            raise RuntimeError("read_folder:  An earlier read hasn't finished.")
+        try:
+            return self._read_folder(mailbox, mail_state, pi_state, idle_timeout)
+        finally:
+            self.reading.release()
+
+
+    def _read_folder(self, mailbox, mail_state, pi_state, idle_timeout):
+        """The body of read_folder(), run while holding self.reading."""
         def cb(cb_arg_list):
             response, cb_arg, error = cb_arg_list
             typ, data = response
@@ -200,6 +794,9 @@ class Gmail(object):
                     continue
                 print('Message %s:\n%s\n'
                     % (field[0].split()[0], field[1]))
+        # Count the IMAP round trips made, and time each stage, for each wake-up
+        self.round_trips = 0
+        self.stage_times = {}
         # Gmail was timing out & causing the service to stop
         # so need to check connection to Gmail, if it fails, login again
         # Now with use of IMAP IDLE command this should no longer be necessary.
@@ -207,192 +804,506 @@ class Gmail(object):
             message = "Mailbox " + mailbox + " selected."
             logging.debug(message)
         elif mail_state == 'AUTH':
-            logging.debug("Select mailbox")
-            response, empty = self.select(mailbox)
-            if response == 'OK':
-                message = "Mailbox " + mailbox + " selected."
-                logging.debug(message)
-            else:
-                logging.error("Response was:")
-                logging.error(response)
-                raise RuntimeError("read_folder:  Could not select mailbox.")
+            self.select_mailbox(mailbox)
         else:
             raise RuntimeError("read_folder:  Not in 'AUTH' or 'SELECTED' state.")
         # We have reached the 'SELECTED' state, so we can continue
-        rv = self.mail.idle()
+        mail = self.mail
+        with self.timed('idle'):
+            rv = self.imap('idle', idle_timeout)
 #        rv = self.mail.idle(callback=cb)
+        if self.mail is not mail:
+            # Dropped while in IDLE (see MailSupervisor.failed), so given up on
+            raise RuntimeError("read_folder:  The connection was dropped during IDLE.")
         # IDLE response is [NONE] if message received or [TIMEOUT] after 29 minutes 
         logging.debug(self.mail.response('IDLE'))
-        # 'empty' collects the response from 'self.mail.search'
-        empty, data = self.mail.search(None, 'ALL')
-        id_list = data[0].split()
-        # Any emails?
-        if id_list:
-            latest_email_id = int( id_list[-1] )
-            for i in range( latest_email_id, latest_email_id-1, -1):
-                # 'empty' collects the response from 'self.mail.fetch'
-                empty, data = self.mail.fetch(i, '(RFC822)')
-            for response_part in data:
-                if isinstance(response_part, tuple):
-                    msg = email.message_from_string(response_part[1])
-                    logging.debug("Message subject is.....")
-                    logging.debug(msg['subject'])
-            var_subject = msg['subject']
-            if 'Notification' in var_subject:
-                var_subject = var_subject.replace('Notification', '')
-            if 'Mon' in var_subject:
-                var_subject = var_subject.replace('Mon', '')
-#            self.check_subject(var_subject, latest_email_id)
-#            return var_subject
-            return self.check_subject(var_subject, pi_state, latest_email_id)
+        with self.timed('search'):
+            uids = self.new_uids()
+        # Any new emails?
+        if uids:
+            # Only the Subject and Date headers are needed, so don't download
+            # the (much larger) message bodies, or mark the messages as read
+            with self.timed('fetch'):
+                headers = self.fetch_headers(uids)
         else:
-            logging.debug(("No emails in selected folder", mailbox))
-            return None
+            logging.debug(("No new emails in selected folder", mailbox))
+            headers = {}
+        queue = self.queue_commands(uids, headers)
+        pi_state = self.check_commands(queue, pi_state)
+        if uids:
+            # Move the high-water mark on once the commands have been applied
+            self.last_uid = uids[-1]
+            with self.timed('save_uid'):
+                self.save_uid_state()
+        with self.timed('delete'):
+            self.delete_messages()
+        logging.debug(("IMAP round trips for this wake-up:", self.round_trips, "seconds in each stage:",
+                       self.stage_times), extra={'timings': self.stage_times, 'round_trips': self.round_trips})
+        return pi_state
 
 
 
-    def check_subject(self, var_subject, pi_state, latest_email_id=0):
-        """Looks for specific command codes in the email subject.
+    def check_subject(self, var_subject, pi_state, email_uid=0):
+        """Acts on the command in an email subject.
         
         var_subject: string
-        latest_email_id: int (default is 0)
+        pi_state: StateStore
+        email_uid: int (default is 0)
+                    UID of the message the subject came from
         
-        return: tuple
-                    (piheat_command(string), piheat_control(string))
+        return: dict
+                    the updated pi_state
+        """
+        return self.check_commands(self.queue_commands([email_uid], {email_uid: (var_subject, None)}),
+                                   pi_state)
+
+
+    def check_commands(self, queue, pi_state, learn=True):
+        """Applies a queue of commands, with one relay update and one database transaction.
+
+        queue: list of tuples
+                    of the form (uid(int), Command), see queue_commands
+                    (uid is 0 for a command from the local schedule)
+        pi_state: StateStore
+        learn: boolean
+                    False for a pre-heat released by due_preheat(), which was
+                    already learned, at its event time, when it was held back
+
+        return: dict
+                    the updated pi_state
+        """
+        with self.lock:
+            if self.piheat_db is None:
+                # Not logged in to Gmail, e.g. running the local schedule
+                self.piheat_db = DBase()
+            if queue:
+                with self.timed('db_login'):
+                    self.piheat_db.my_login()
+                with self.timed('apply'):
+                    # Work out where every relay ends up, then switch them once
+                    with relays.batch():
+                        for uid, command in queue:
+                            if self.defer_preheat(uid, command):
+                                continue
+                            self.apply_command(command, pi_state)
+                            #  Updates the 'control' in the 'piheat' table for the chosen 'command'
+                            pi_state[command.target] = command.action
+            # Only writes what has actually changed, in one transaction
+            with self.timed('db_write'):
+                pi_state.commit()
+
+        # Remove all but the most recent email from mailbox, for each command.
+        # These are queued and deleted together by delete_messages().
+        for uid, command in queue:
+            if not uid:
+                continue
+            with self.timed('search'):
+                self.del_uids.extend(self.old_uids(command.target, uid))
+            self.kept_uids[command.target] = uid
+            if learn:
+                # Expect the same command at the same time next week
+                schedule.learn(command)
+        return pi_state
+
+
+    def defer_preheat(self, uid, command):
+        """Holds back a heating command for a time that hasn't come yet.
+
+        A calendar reminder set before the event sends 'CH = n @ time'
+        early.  Rather than heating from then, the command is kept until
+        due_preheat() says it is time to start warming the room up.  Any
+        other heating command replaces one that is waiting.  The command
+        waiting is saved with the UID state, as its email has been read,
+        so it isn't lost by a restart.
+
+        uid: int
+        command: Command
+        return: boolean
+                    True if the command has been held back
+        """
+        if command.target != 'CH':
+            return False
+        if (command.action == 'on') and command.at and (command.at > datetime.datetime.now()):
+            logging.info(("Heating to", command.setpoint, "by", command.at.strftime('%H:%M')))
+            self.preheat = (uid, command)
+            self.save_uid_state()
+            return True
+        if self.preheat:
+            logging.info(("Pre-heat for", self.preheat[1].at.strftime('%H:%M'), "replaced by", command))
+            self.preheat = None
+            self.save_uid_state()
+        return False
+
+
+    def due_preheat(self, livtemp, target_temp):
+        """Works out whether a held back heating command should start now.
+
+        It starts as long before its time as the warm-up model says the
+        room needs to get from livtemp up to the setpoint.
+
+        livtemp: float
+        target_temp: float (used if the command doesn't set one)
+        return: list of tuples
+                    of the form (uid(int), Command), for check_commands(), or empty
+        """
+        with self.lock:
+            if self.preheat is None:
+                return []
+            uid, command = self.preheat
+            setpoint = target_temp if command.setpoint is None else command.setpoint
+            lead = warmup.predict(setpoint - livtemp)
+            if datetime.datetime.now() < command.at - datetime.timedelta(seconds=lead):
+                return []
+            logging.info(("Starting to heat", round(lead / 60.0), "minutes before", command.at.strftime('%H:%M')))
+            self.preheat = None
+            self.save_uid_state()
+            return [(uid, command._replace(at=None))]
+
+
+    def apply_command(self, command, pi_state):
+        """Switches the relays for a command.
+
+        command: Command
+        pi_state: StateStore
+                    the target temperature is updated here for 'CH = n'
         """
-        # Initialise these variables so that we can check they are non-zero later
-        sub_data = None
-        piheat_control = None
-        target_temp = None
-        piheat_command = None
+        logging.debug("Turning " + command.target + ' ' + command.action)
         ctrl_pio = Pio()
-        self.piheat_db.my_login()
-        for command in self.commands:
-            if command in var_subject:
-                # Build the search string, e.g. '(SUBJECT "st699")'
-                search = "\'(SUBJECT \"" + command + "\")\'"
-                # 'empty' collects the response from 'self.mail.search'
-                empty, sub_data = self.mail.search(None, search)
-                piheat_command = command
-                if 'on' in var_subject:
-                    piheat_control = 'on'
-                    if command is 'st699':
-                        ctrl_pio.st699_on()
-                    elif command is 'HW':
-                        ctrl_pio.hw_on()
-                    elif command is 'CH':
-                        # Get actual temperature
-                        livtemp = self.piheat_db.my_query("SELECT livtemp FROM temp_log")
-                        self.target_temp = float(self.piheat_db.my_query("SELECT temp FROM target_temp"))
-                        ctrl_pio.ch_on(livtemp, self.target_temp)
-                elif '=' in var_subject:
-                    if command is 'CH':
-                        piheat_control = 'on'
-                        livtemp = self.piheat_db.my_query("SELECT livtemp FROM temp_log")
-                        command_start = var_subject.find('CH =')
-                        command_end = var_subject.find(' @ ')
-                        # string.find() returns -1 if it fails to find the string
-                        if(command_end == -1):
-                            # A normal email
-                            temp_str = var_subject.strip()[command_start+4:]
-                            print("temp_str is.....", temp_str)
-                        elif (command_start != -1) and (command_end != -1):
-                            # Extract the string of numbers for target_temp
-                            temp_str = var_subject.strip()[command_start+4:command_end]
-                            print("temp_str is.....", temp_str)
-                        try:
-                            # Test that a number has been found
-                            target_temp = float(temp_str)
-                            sql = "UPDATE target_temp SET temp=(%s)"
-                            self.piheat_db.my_update(sql, temp_str)
-                            self.target_temp = target_temp
-                        except:
-                            self.target_temp = float(self.piheat_db.my_query("SELECT temp FROM target_temp"))
-                        ctrl_pio.ch_on(livtemp, self.target_temp)
-                elif 'off' in var_subject:
-                    piheat_control = 'off'
-                    if command is 'st699':
-                        ctrl_pio.st699_off()
-                    elif command is 'CH':
-                        ctrl_pio.ch_off()
-                    elif command is 'HW':
-                        ctrl_pio.hw_off()
-                else:
-                    logging.warning(("No control specified for", command))
-                if piheat_control:
-                    message = "Turning " + command + ' ' + piheat_control
-                    logging.debug(message)
-        #  Updates the 'control' in the 'piheat' table for the chosen 'command'
-        if piheat_command and piheat_control:
-            pi_state[piheat_command] = piheat_control
-#            self.pi_state[piheat_command] = piheat_control
-            try:
-                sql = "UPDATE piheat SET piheat_control=(%s) WHERE piheat_function=(%s)"
-                self.piheat_db.my_update(sql, piheat_control, piheat_command)
-            except:
-                self.piheat_db.rollback()
-        else:
-            logging.warning("No data to write!")
-
-        # Remove all but the most recent email from mailbox, for the specified command
-        if sub_data:
-            del_list = sub_data[0].split()
-            for num in enumerate(del_list):
-                i = int(num[1])
-                if (i != latest_email_id):
-                    self.mail.store(num[1], '+FLAGS', '\\Deleted')
+        if command.target == 'st699':
+            if command.action == 'on':
+                ctrl_pio.st699_on()
+            else:
+                ctrl_pio.st699_off()
+        elif command.target == 'HW':
+            if command.action == 'on':
+                ctrl_pio.hw_on()
+            else:
+                ctrl_pio.hw_off()
+        elif command.action == 'on':
+            if command.setpoint is not None:
+                pi_state.set_target_temp(command.setpoint)
+            # Get actual temperature
+            livtemp = self.piheat_db.get_livtemp()
+            self.target_temp = pi_state.target_temp
+            ctrl_pio.ch_on(livtemp, self.target_temp)
         else:
-            logging.debug("No matching emails were found")
-        self.mail.expunge()
-        return pi_state
+            ctrl_pio.ch_off()
+
+
+    def old_uids(self, command, email_uid):
+        """Finds the earlier messages for a command, which can be deleted.
+
+        Only the most recent message for each command is left in the mailbox,
+        and its UID is remembered, so normally no search is needed.  The
+        mailbox is only searched the first time a command is seen.
+
+        command: string
+        email_uid: int
+        return: list of int
+        """
+        if command in self.kept_uids:
+            old_uid = self.kept_uids[command]
+            return [old_uid] if old_uid != email_uid else []
+        empty, data = self.imap('uid', 'SEARCH', None, '(SUBJECT "%s")' % command)
+        if not data or not data[0]:
+            return []
+        return [int(uid) for uid in data[0].split() if int(uid) < email_uid]
 
 
     def logout(self):
         logging.debug("Closing MySQL connection")
         self.piheat_db.my_logout()
+        if self.mail is None:
+            # Dropped, see drop()
+            return
         logging.debug("Closing IMAP connection")
         self.mail.close()
         self.mail.logout()
 
 
+    def drop(self):
+        """Abandons the IMAP connection after it has failed, leaving the database session open.
+
+        Any IDLE still waiting on the connection is ended by the logout.
+        """
+        mail, self.mail = self.mail, None
+        if mail is None:
+            return
+        logging.debug("Dropping IMAP connection")
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+
+
+class MailSupervisor(object):
+    """Keeps a Gmail session connected, for the runtime's mail task.
+
+    A session that fails (an error, or an IDLE that doesn't come back in
+    time) is dropped, then logged in to again after a backoff: the wait
+    doubles with each failure, from RECONNECT_MIN up to RECONNECT_MAX
+    seconds, with up to half taken off at random.  After logging in, the
+    mailbox is selected again and reading carries on from the last UID
+    processed, so no command is missed or applied twice.
+
+    The number of reconnects and the total time without a session are
+    kept, and logged after each reconnect.
+    """
+
+    def __init__(self, piheat, my_db, mailbox='piheat',
+                 min_delay=RECONNECT_MIN, max_delay=RECONNECT_MAX):
+        self.piheat = piheat
+        self.my_db = my_db
+        self.mailbox = mailbox
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        # Failures since the last good read, for the backoff
+        self.failures = 0
+        self.reconnects = 0
+        # Seconds without a session, and when the current outage started
+        self.downtime = 0.0
+        self.down_since = None
+
+
+    def connected(self):
+        """Checks the mailbox is selected, ready to be read.
+
+        return: boolean
+        """
+        return self.piheat.get_mail_state() == 'SELECTED'
+
+
+    def backoff(self):
+        """Works out how long to wait before the next attempt to reconnect.
+
+        return: float (seconds)
+        """
+        delay = min(self.max_delay, self.min_delay * 2 ** max(self.failures - 1, 0))
+        return delay * random.uniform(0.5, 1.0)
+
+
+    def failed(self, error=None):
+        """Drops a session that has failed.
+
+        error: Exception (optional)
+        return: float (seconds to wait before reconnecting)
+        """
+        if self.down_since is None:
+            self.down_since = time.time()
+        self.failures += 1
+        self.piheat.drop()
+        delay = self.backoff()
+        logging.warning(("Gmail session failed:", repr(error), "reconnecting in %.1f seconds" % delay))
+        return delay
+
+
+    def reconnect(self):
+        """Logs in to Gmail again, and selects the mailbox.
+
+        Waits for any read still running on the old connection (e.g. one
+        abandoned after its IDLE timed out) to finish first, so the two
+        can't both use the new connection, or the UID high-water mark.
+
+        Raises RuntimeError if it can't, for the caller to back off.
+        """
+        if not self.piheat.reading.acquire(timeout=CALL_TIMEOUT):
+            raise RuntimeError("reconnect:  The last read on the old connection hasn't finished.")
+        try:
+            if self.piheat.get_mail_state() != 'AUTH':
+                self.piheat.drop()
+                if not self.piheat.login(self.my_db):
+                    raise RuntimeError("reconnect:  Gmail login failed.")
+            self.piheat.select_mailbox(self.mailbox)
+        finally:
+            self.piheat.reading.release()
+        if self.down_since is None:
+            # The first connection, rather than a reconnect
+            return
+        self.reconnects += 1
+        self.downtime += time.time() - self.down_since
+        self.down_since = None
+        logging.info(("Reconnected to Gmail:", self.stats()))
+
+
+    def succeeded(self):
+        """Records a good read, so the next failure starts the backoff again."""
+        self.failures = 0
+
+
+    def stats(self):
+        """Gets the reconnect counts and downtime.
+
+        return: dict
+        """
+        downtime = self.downtime
+        if self.down_since is not None:
+            downtime += time.time() - self.down_since
+        return {'reconnects': self.reconnects, 'failures': self.failures,
+                'downtime': round(downtime, 1), 'connected': self.down_since is None}
+
+
 
 class VMSuperHub(CheckNet):
-    def __init__(self):
-        superhub_address = "http://192.168.0.1"
-        req = requests.Session()
-        home_url = superhub_address + "/home.html"
-        r = req.get(home_url)
+    """Reboots the Virgin Media SuperHub, which can clear a lost connection.
 
+    Every request to the hub is made with a timeout, as this is only used
+    when something is already wrong, so must be run in a worker thread.
+    """
 
-    def vm_login(self):
-        """Logs in to SuperHub"""
+    def __init__(self, timeout=HUB_TIMEOUT):
+        self.superhub_address = "http://192.168.0.1"
+        self.home_url = self.superhub_address + "/home.html"
+        self.timeout = timeout
+        requests = lazy_import('requests')
+        self.req = requests.Session()
+        self.r = self.req.get(self.home_url, timeout=self.timeout)
+
+
+    def vm_login(self, attempts=3):
+        """Logs in to SuperHub, and reboots it.
+
+        attempts: int
+                    how many times to try the password before giving up
+        """
+        BeautifulSoup = lazy_import('bs4').BeautifulSoup
+        urlencode = lazy_import('urllib.parse').urlencode
         v_secrets = UserData()
         login, account, password = v_secrets.get_secrets('superhub')
+        req = self.req
+        r = self.r
         # Check if logged in
-        if r.url == home_url:
-            logged_in = True
-        else:
-            logged_in = False
-
-        while not logged_in:
-            soup = BeautifulSoup(r.text)
+        logged_in = (r.url == self.home_url)
+        for attempt in range(attempts):
+            if logged_in:
+                break
+            soup = BeautifulSoup(r.text, 'html.parser')
             password_name = soup.find("input", id="password")["name"]
-            login_url = superhub_address + "/cgi-bin/VmLoginCgi"
-            data = urllib.parse.urlencode({password_name: password}).encode("utf-8")
+            login_url = self.superhub_address + "/cgi-bin/VmLoginCgi"
+            data = urlencode({password_name: password}).encode("utf-8")
             headers       = {"Content-Type":"application/x-www-form-urlencoded"}
-            req.post(login_url, data = data, headers = headers)
+            req.post(login_url, data = data, headers = headers, timeout=self.timeout)
             # Check again if logged in, to break loop
-            r = req.get(home_url)
-            if r.url == home_url:
-                logged_in = True
-            else:
-                logged_in = False
-        rv = req.get(superhub_address + "/VmRgRebootRestoreDevice.html")
-        rv = re.search('name=\"([^\"]*?)\" value=\"0\"', r.text)
-        logging.debug("Logged in is...", logged_in)
+            r = req.get(self.home_url, timeout=self.timeout)
+            logged_in = (r.url == self.home_url)
+        logging.debug(("Logged in is...", logged_in))
+        if not logged_in:
+            raise RuntimeError("vm_login:  Could not log in to the SuperHub.")
+        rv = req.get(self.superhub_address + "/VmRgRebootRestoreDevice.html", timeout=self.timeout)
+        m = re.search('name=\"([^\"]*?)\" value=\"0\"', rv.text)
+        if m is None:
+            raise RuntimeError("vm_login:  Could not find the SuperHub reboot form.")
         reset_address = "/cgi-bin/VmRgRebootResetDeviceCfgCgi"
-        data = {"VMRebootResetChangeCache":"1",m.group(1).encode('ascii','ignore'):"0"}
-        rv = req.post(superhub_address + reset_address, data=data)
+        data = {"VMRebootResetChangeCache":"1", m.group(1):"0"}
+        rv = req.post(self.superhub_address + reset_address, data=data, timeout=self.timeout)
+        logging.info("SuperHub rebooted")
+
+
+
+def reset_hub():
+    """Reboots the SuperHub.  Blocks for a while, so is run in a worker thread."""
+    hub = VMSuperHub()
+    hub.vm_login()
+
+
+
+class RelayDriver(object):
+    """Drives the relays, keeping a shadow copy of every output's state.
+
+    apply() works out which outputs actually need to change to reach a
+    target, and only writes those.  Outputs that are being switched off are
+    changed before those being switched on, so two relays are never
+    energised together by accident (e.g. dhw_off and dhw_on), and the ST699
+    is powered down before piheat takes over, and only powered up after
+    piheat has let go.  An output that changed less than min_dwell seconds
+    ago is left to settle before it is changed again.  Every switch is
+    counted, per relay, for keeping an eye on relay wear.
+    """
+
+    # The value of each output when the control it drives is off.
+    # The ST699 is powered through an NC contact, so is 'off' when high.
+    OFF_VALUES = {ST699: 1, DHW_OFF: 0, DHW_ON: 0, CH_ON: 0}
+    NAMES = {ST699: 'st699', DHW_OFF: 'dhw_off', DHW_ON: 'dhw_on', CH_ON: 'ch_on'}
+
+
+    def __init__(self, initial, min_dwell=RELAY_MIN_DWELL):
+        """initial: dict
+                    of the form {pin(int): value(int)}, as set up at start up
+        min_dwell: int or float (seconds)
+        """
+        self.state = dict(initial)
+        self.min_dwell = min_dwell
+        self.last_change = dict((pin, 0) for pin in initial)
+        self.switch_counts = dict((self.NAMES[pin], 0) for pin in initial)
+        self.lock = relay_lock
+        # The outputs waiting to be set at the end of a batch()
+        self.pending = None
+
+
+    def read(self, pin):
+        """Gets the state an output was last set to, without touching the GPIO.
+
+        Inside batch(), this is the state it will be set to.
+
+        pin: int
+        return: int
+        """
+        if self.pending and pin in self.pending:
+            return self.pending[pin]
+        return self.state[pin]
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collects every apply() in a with block into one update, made at the end.
+
+        Changes that cancel each other out (e.g. the ST699 switching
+        everything off, then the hot water going back on) never reach the
+        relays.  Nothing is switched if the block raises an exception.
+        """
+        with self.lock:
+            self.pending = {}
+            try:
+                yield
+                target = self.pending
+                self.pending = None
+                self.apply(target)
+            finally:
+                self.pending = None
+
+
+    def apply(self, target):
+        """Changes the outputs that differ from target, in a safe order.
+
+        target: dict
+                    of the form {pin(int): value(int or boolean)}
+        return: list of int
+                    the pins that were changed
+        """
+        with self.lock:
+            if self.pending is not None:
+                self.pending.update((pin, int(bool(value))) for pin, value in target.items())
+                return []
+            changes = [(pin, int(bool(value))) for pin, value in target.items()
+                       if self.state[pin] != int(bool(value))]
+            # Switch things off before switching anything on
+            changes.sort(key=lambda change: change[1] != self.OFF_VALUES[change[0]])
+            for pin, value in changes:
+                settle = self.min_dwell - (time.time() - self.last_change[pin])
+                if settle > 0:
+                    logging.debug(("Waiting", round(settle, 2), "seconds for", self.NAMES[pin], "to settle"))
+                    time.sleep(settle)
+                GPIO.output(pin, value)
+                self.state[pin] = value
+                self.last_change[pin] = time.time()
+                self.switch_counts[self.NAMES[pin]] += 1
+            if changes:
+                logging.debug(("Relay switch counts:", self.switch_counts))
+            return [pin for pin, value in changes]
+
+
+# The one relay driver, starting from the outputs as they were set up above
+relays = RelayDriver({ST699: 1, DHW_OFF: 0, DHW_ON: 0, CH_ON: 0})
 
 
 
@@ -401,13 +1312,34 @@ class Pio(object):
     def check_io(self, pin):
         """Check the output state of a GPIO.
         
+        Comes from the relay driver's copy of the outputs, so is free to call.
+
         pin: int
         return: int
         """
-        pin_state = GPIO.input(pin) 
+        pin_state = relays.read(pin)
         return pin_state
         
 
+    def set_outputs(self, hw, ch):
+        """Sets dhw_off, dhw_on and ch_on to the matching row of the truth table.
+
+         =========================================
+        | All off || HW only || CH only || All on |
+        |=========================================|
+        |dhw_off  ||    0    ||    1    ||   0    |
+        |dhw_on   ||    0    ||    0    ||   1    |
+        |ch_on    ||    0    ||    1    ||   1    |
+         =========================================
+
+        Only the relays that need to change are switched.
+
+        hw: boolean
+        ch: boolean
+        """
+        relays.apply({DHW_OFF: ch and not hw, DHW_ON: hw, CH_ON: ch})
+
+
     def st699_off(self):
         """Switches the old programmer off.
 
@@ -417,7 +1349,7 @@ class Pio(object):
         on the relays.
         """
         logging.info("Switching ST699 off.")
-        GPIO.output(ST699, 1)
+        relays.apply({ST699: 1})
 
 
     def st699_on(self):
@@ -426,9 +1358,7 @@ class Pio(object):
         And switches off the controls from all the other relays.
         """
         logging.info("Switching ST699 on.")
-        GPIO.output(ST699, 0)
-        for relay in gpio_outputs.values():
-            GPIO.output(relay, 0)
+        relays.apply({ST699: 0, DHW_OFF: 0, DHW_ON: 0, CH_ON: 0})
 
 
     def hw_off(self):
@@ -439,77 +1369,1018 @@ class Pio(object):
         state of the ch_on relay.
         """
         logging.info("Switching hot water off.")
-        GPIO.output(DHW_ON,  0)
-        GPIO.output(DHW_OFF, (self.check_io(CH_ON)))
+        with relay_lock:
+            self.set_outputs(False, self.check_io(CH_ON))
 
 
     def hw_on(self):
         logging.info("Switching hot water on.")
-        GPIO.output(DHW_OFF, 0)
-        GPIO.output(DHW_ON,  1)
+        with relay_lock:
+            self.set_outputs(True, self.check_io(CH_ON))
 
 
     def ch_off(self):
         logging.info("Switching central heating off.")
-        GPIO.output(CH_ON,   0)
-        GPIO.output(DHW_OFF, 0)
+        self.ch_relay(False)
+
+
+    def ch_relay(self, heat):
+        """Sets the ch_on relay, and the dhw_off relay to match.
+
+        heat: boolean
+        """
+        with relay_lock:
+            self.set_outputs(self.check_io(DHW_ON), heat)
 
 
     def ch_on(self, actual_temp, target_temp=20):
         """Switches the central heating on if target_temp > actual_temp.
         
-        actual_temp: float
+        actual_temp: float (or None if the room temperature isn't known)
         target_temp: int or float
         
         return: boolean
         """
         logging.info("Switching central heating on.")
+        if actual_temp is None:
+            # The thermostat switches it on once there is a reading
+            logging.warning("Room temperature unknown, leaving the central heating off for now")
+            self.ch_relay(False)
+            return False
         print("actual_temp is...", actual_temp)
         print("target_temp is...", target_temp)
         # Check target temperature against actual room temperature
         if actual_temp < target_temp:
             logging.info("room is not warm enough")
-            GPIO.output(CH_ON, 1)
-            
-            # While ch_on == high, dhw_off = not dhw_on
-            GPIO.output(DHW_OFF, (not self.check_io(DHW_ON)))
+            self.ch_relay(True)
             return True
         else:
             logging.info("room is warm enough")
-            GPIO.output(CH_ON,   0)
-            GPIO.output(DHW_OFF, 0)
+            self.ch_relay(False)
             return False
 
 
 
-class DBase(object):
+class WarmupModel(object):
+    """Learns how long the heating takes to warm the living room up.
 
-    def my_login(self):
-        """Uses MySQLdb to connect to database.
-        
+    Fits seconds = dead_time + rate * degrees, by least squares over the
+    heating runs seen so far.  Only the running sums are kept, so learning
+    from another run, or making a prediction, costs a few multiplications.
+    The older runs are weighted down by 'decay' each time a new one is
+    added, so the model follows the seasons.  It starts from a couple of
+    made-up runs, which are soon outweighed, and is saved to 'path' after
+    every run it learns from.
+    """
+
+    # Made-up runs to start from, as (degrees, seconds)
+    PRIOR = [(1.0, 1800.0), (3.0, 4200.0)]
+
+
+    def __init__(self, path=WARMUP_STATE_FILE, decay=WARMUP_DECAY, max_seconds=PREHEAT_MAX):
+        self.path = path
+        self.decay = decay
+        self.max_seconds = max_seconds
+        # Weighted sums of 1, x, y, x*x and x*y, read from path when first needed
+        self.sums = None
+        self.lock = threading.Lock()
+
+
+    def load(self):
+        """Reads the sums saved by an earlier run, or starts from PRIOR."""
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            self.sums = dict((key, float(saved[key])) for key in ('n', 'x', 'y', 'xx', 'xy'))
+        except (OSError, ValueError, KeyError, TypeError):
+            self.sums = {'n': 0.0, 'x': 0.0, 'y': 0.0, 'xx': 0.0, 'xy': 0.0}
+            for degrees, seconds in self.PRIOR:
+                self.add(degrees, seconds)
+
+
+    def add(self, degrees, seconds):
+        """Adds one run to the sums."""
+        self.sums['n'] += 1
+        self.sums['x'] += degrees
+        self.sums['y'] += seconds
+        self.sums['xx'] += degrees * degrees
+        self.sums['xy'] += degrees * seconds
+
+
+    def save(self):
+        """Writes the sums to a temporary file, then renames it over the old one."""
+        tmp_file = self.path + '.tmp'
+        try:
+            make_state_dir(self.path)
+            with open(tmp_file, 'w') as f:
+                json.dump(self.sums, f)
+            os.replace(tmp_file, self.path)
+        except OSError:
+            logging.exception("Could not save the warm-up model")
+
+
+    def learn(self, degrees, seconds):
+        """Adds a heating run that raised the room by degrees in seconds.
+
+        degrees: float
+        seconds: float
+        """
+        with self.lock:
+            if self.sums is None:
+                self.load()
+            for key in self.sums:
+                self.sums[key] *= self.decay
+            self.add(degrees, seconds)
+            self.save()
+        logging.info(("Warm-up model learned", round(degrees, 2), "degrees in", round(seconds),
+                      "seconds, now", self.coefficients()))
+
+
+    def coefficients(self):
+        """Gets the fitted line.
+
+        return: tuple
+                    (dead_time(float), rate(float)) in seconds, and seconds per degree
+        """
+        with self.lock:
+            if self.sums is None:
+                self.load()
+            n, x, y, xx, xy = (self.sums[key] for key in ('n', 'x', 'y', 'xx', 'xy'))
+        spread = n * xx - x * x
+        if spread > 1e-9:
+            rate = (n * xy - x * y) / spread
+            if rate > 0:
+                return (y - rate * x) / n, rate
+        # All the runs were about the same size, or the fit makes no sense
+        return 0.0, (y / x if x > 0 else 0.0)
+
+
+    def predict(self, degrees):
+        """Gets how long the heating needs to raise the room by degrees.
+
+        degrees: float
+        return: float (seconds, between 0 and max_seconds)
+        """
+        if degrees <= 0:
+            return 0.0
+        dead_time, rate = self.coefficients()
+        return min(max(dead_time + rate * degrees, 0.0), self.max_seconds)
+
+
+# The one warm-up model, shared by the thermostat and the command handler
+warmup = WarmupModel()
+
+
+
+class Schedule(object):
+    """The commands piheat expects, kept locally so they still happen when Gmail can't be reached.
+
+    Entries come from two places:
+        'mail'  every command emailed is expected again at the same time the
+                next week, as calendar events normally repeat weekly.  An
+                entry is dropped once no email has come for it in keep_days.
+        'ical'  the events in an iCalendar file (set by 'ical' in the
+                [schedule] section of the config file), for the next few days.
+
+    Entries are kept in a heap ordered by time, so adding one, or taking
+    the next one due, is O(log n).  An entry that is replaced stays in the
+    heap, and is skipped when it comes out.  The 'mail' entries are saved
+    to 'path', so they survive a restart.
+    """
+
+    def __init__(self, path=SCHEDULE_FILE, keep_days=SCHEDULE_KEEP_DAYS):
+        self.path = path
+        self.keep = keep_days * 86400
+        # Stored as {key(tuple): (when(float), Command, last seen(float))}
+        self.entries = {}
+        # Of the form [(when(float), key(tuple)), ...]
+        self.heap = []
+        self.loaded = False
+        self.ical_checked = None
+        self.lock = threading.RLock()
+
+
+    def add(self, key, when, command, last_seen):
+        """Adds an entry, replacing any with the same key.
+
+        key: tuple
+                    ('mail', target, weekday, 'HH:MM') or ('ical', uid, when)
+        when: float (Unix time)
+        command: Command
+        last_seen: float (Unix time the command was last emailed)
+        """
+        with self.lock:
+            self.entries[key] = (when, command._replace(at=None), last_seen)
+            heapq.heappush(self.heap, (when, key))
+
+
+    def load(self):
+        """Reads the entries saved by an earlier run."""
+        self.loaded = True
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            for key, when, command, last_seen in saved:
+                self.add(tuple(key), when, Command(*command), last_seen)
+        except (OSError, ValueError, TypeError):
+            logging.info(("No saved schedule in", self.path))
+
+
+    def save(self):
+        """Writes the 'mail' entries to a temporary file, then renames it over the old one."""
+        saved = [[key, when, list(command), last_seen]
+                 for key, (when, command, last_seen) in self.entries.items() if key[0] == 'mail']
+        tmp_file = self.path + '.tmp'
+        try:
+            make_state_dir(self.path)
+            with open(tmp_file, 'w') as f:
+                json.dump(saved, f)
+            os.replace(tmp_file, self.path)
+        except OSError:
+            logging.exception("Could not save the schedule")
+
+
+    def learn(self, command, now=None):
+        """Expects an emailed command again, at the same time next week.
+
+        command: Command
+                    its 'at' time is used if it has one, otherwise now
+        now: float (optional)
+        """
+        now = time.time() if now is None else now
+        at = command.at or datetime.datetime.fromtimestamp(now)
+        key = ('mail', command.target, at.weekday(), at.strftime('%H:%M'))
+        when = at.timestamp()
+        while when <= now:
+            when += 7 * 86400
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            old = self.entries.get(key)
+            self.add(key, when, command, now)
+            if (old is None) or (old[0] != when) or (old[1] != command._replace(at=None)):
+                self.save()
+
+
+    def due(self, now=None):
+        """Takes every entry whose time has come out of the schedule.
+
+        'mail' entries are put back for the next week.
+
+        now: float (optional)
+        return: list of Command (in time order)
+        """
+        now = time.time() if now is None else now
+        commands = []
+        changed = False
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            while self.heap and (self.heap[0][0] <= now):
+                when, key = heapq.heappop(self.heap)
+                entry = self.entries.get(key)
+                if (entry is None) or (entry[0] != when):
+                    # Replaced since it was added
+                    continue
+                commands.append(entry[1])
+                del self.entries[key]
+                if key[0] == 'mail':
+                    changed = True
+                    if (now - entry[2]) < self.keep:
+                        self.add(key, when + 7 * 86400, entry[1], entry[2])
+                    else:
+                        logging.info(("No longer expecting", entry[1]))
+            if changed:
+                self.save()
+        return commands
+
+
+    def next_time(self):
+        """Gets the time of the next entry.
+
+        return: float (or None if the schedule is empty)
+        """
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            while self.heap and (self.entries.get(self.heap[0][1], (None,))[0] != self.heap[0][0]):
+                heapq.heappop(self.heap)
+            return self.heap[0][0] if self.heap else None
+
+
+    def import_ical(self, path, days, now=None):
+        """Replaces the 'ical' entries with the events in an iCalendar file.
+
+        Each event whose SUMMARY holds a command (e.g. 'HWon') is added for
+        every time it happens in the next 'days' days.  Daily and weekly
+        RRULEs (with INTERVAL, COUNT, UNTIL and BYDAY) are followed.  Times
+        with a TZID are taken to be local time.
+
+        path: string
+        days: int
+        now: float (optional)
+        return: int (the number of entries added)
+        """
+        now = time.time() if now is None else now
+        with open(path) as f:
+            events = parse_ical(f.read())
+        start = datetime.datetime.fromtimestamp(now)
+        end = start + datetime.timedelta(days=days)
+        added = 0
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == 'ical']:
+                del self.entries[key]
+            for uid, summary, dtstart, rrule in events:
+                command = parse_command(summary)
+                if command is None:
+                    continue
+                for when in ical_occurrences(dtstart, rrule, start, end):
+                    self.add(('ical', uid, when.isoformat()), when.timestamp(), command, now)
+                    added += 1
+        logging.info(("Imported", added, "scheduled commands from", path))
+        return added
+
+
+    def check_ical(self, path, days, now=None):
+        """Imports the iCalendar file again if it has changed, or once a day.
+
+        path: string (or empty if there isn't one)
+        days: int
+        now: float (optional)
+        """
+        if not path:
+            return
+        now = time.time() if now is None else now
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return
+        if self.ical_checked and (self.ical_checked[0] == mtime) and (now - self.ical_checked[1] < 86400):
+            return
+        try:
+            self.import_ical(path, days, now)
+        except (OSError, ValueError):
+            logging.exception(("Could not import", path))
+        self.ical_checked = (mtime, now)
+
+
+# The one local schedule
+schedule = Schedule()
+
+
+def parse_ical(text):
+    """Pulls the events out of an iCalendar file.
+
+    text: string
+    return: list of tuples
+                of the form (uid(string), summary(string), dtstart(datetime), rrule(dict or None))
+                all-day events, which have no start time, are left out
+    """
+    # Unfold the lines that have been split over several
+    text = re.sub(r'\r?\n[ \t]', '', text)
+    events = []
+    event = None
+    for line in text.splitlines():
+        if line == 'BEGIN:VEVENT':
+            event = {}
+        elif line == 'END:VEVENT':
+            if event and event.get('DTSTART'):
+                events.append((event.get('UID', str(len(events))), event.get('SUMMARY', ''),
+                               event['DTSTART'], event.get('RRULE')))
+            event = None
+        elif event is not None:
+            name, sep, value = line.partition(':')
+            name, sep, params = name.partition(';')
+            if name == 'DTSTART':
+                event['DTSTART'] = parse_ical_time(value)
+            elif name == 'RRULE':
+                event['RRULE'] = dict(part.split('=', 1) for part in value.split(';') if '=' in part)
+            elif name in ('UID', 'SUMMARY'):
+                event[name] = value.replace('\\,', ',').replace('\\;', ';').strip()
+    return events
+
+
+def parse_ical_time(value):
+    """Reads an iCalendar DATE-TIME, in local time.
+
+    value: string (e.g. '20240106T063000' or '20240106T063000Z')
+    return: datetime.datetime (or None for a DATE, or anything unreadable)
+    """
+    try:
+        when = datetime.datetime.strptime(value[:15], '%Y%m%dT%H%M%S')
+    except ValueError:
+        return None
+    if value.endswith('Z'):
+        # UTC, so convert to local time
+        when = when.replace(tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+    return when
+
+
+def ical_occurrences(dtstart, rrule, start, end):
+    """Lists the times an event happens between start and end.
+
+    dtstart: datetime.datetime
+    rrule: dict (or None)
+                e.g. {'FREQ': 'WEEKLY', 'BYDAY': 'MO,WE', 'COUNT': '10'}
+    start: datetime.datetime
+    end: datetime.datetime
+    return: list of datetime.datetime
+    """
+    if not rrule:
+        return [dtstart] if start <= dtstart < end else []
+    freq = rrule.get('FREQ')
+    if freq not in ('DAILY', 'WEEKLY'):
+        logging.warning(("Only daily and weekly events can be scheduled, not", freq))
+        return [dtstart] if start <= dtstart < end else []
+    interval = int(rrule.get('INTERVAL', 1))
+    count = int(rrule['COUNT']) if 'COUNT' in rrule else None
+    until = parse_ical_time(rrule['UNTIL']) if 'UNTIL' in rrule else None
+    days = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+    byday = [days.index(day[-2:]) for day in rrule.get('BYDAY', '').split(',') if day[-2:] in days]
+    occurrences = []
+    seen = 0
+    day = dtstart
+    while (day < end) and ((until is None) or (day <= until)) and ((count is None) or (seen < count)):
+        weeks = (day.date() - dtstart.date()).days // 7
+        if freq == 'DAILY':
+            happens = ((day.date() - dtstart.date()).days % interval) == 0
+        else:
+            happens = ((weeks % interval) == 0) and (day.weekday() in (byday or [dtstart.weekday()]))
+        if happens:
+            seen += 1
+            if day >= start:
+                occurrences.append(day)
+        day += datetime.timedelta(days=1)
+    return occurrences
+
+
+
+class Thermostat(object):
+    """Keeps the room at the target temperature while the central heating is on.
+
+    Runtime.control_heating calls tick() whenever a command or a new
+    temperature comes in, and at least every 'period' seconds, to read the
+    room and target temperatures and decide whether the heating should be on.  To stop the
+    relays chattering, the heating comes on when the room drops 'hysteresis'
+    degrees below the target, goes off when it reaches the target, and
+    stays in each state for at least min_on / min_off seconds.
+    """
+
+    def __init__(self, pi_state, period=THERMOSTAT_PERIOD, hysteresis=THERMOSTAT_HYSTERESIS,
+                 min_on=THERMOSTAT_MIN_ON, min_off=THERMOSTAT_MIN_OFF):
+        self.pi_state = pi_state
+        self.period = period
+        self.hysteresis = hysteresis
+        self.min_on = min_on
+        self.min_off = min_off
+        # A session of its own from the shared pool, as DBase isn't thread safe
+        self.db = DBase()
+        self.pio = Pio()
+        self.heating = None
+        self.last_switch = 0
+        self.switch_count = 0
+        # When the current heating run started, as (time, livtemp, target_temp)
+        self.run_start = None
+
+
+    def decide(self, livtemp, target_temp, heating, held_for):
+        """Works out whether the heating should be on.
+
+        livtemp: float
+        target_temp: float
+        heating: boolean (whether the heating is on now)
+        held_for: float (seconds since the heating last switched)
         return: boolean
-                    True: connected
-                    False: not connected
+        """
+        if heating:
+            want = livtemp < target_temp
+            min_time = self.min_on
+        else:
+            want = livtemp < (target_temp - self.hysteresis)
+            min_time = self.min_off
+        if (want != heating) and (held_for < min_time):
+            logging.debug(("Thermostat holding for", round(min_time - held_for), "more seconds"))
+            return heating
+        return want
+
+
+    def read_temps(self):
+        """Reads the room and target temperatures from the database.
+
+        return: tuple
+                    (livtemp(float), target_temp(float))
+        """
+        self.db.my_login()
+        livtemp = self.db.get_livtemp()
+        # The state store already holds the target, so it rarely needs reading
+        target_temp = getattr(self.pi_state, 'target_temp', None)
+        if target_temp is None:
+            target_temp = float(self.db.my_query("SELECT temp FROM target_temp"))
+        return livtemp, target_temp
+
+
+    def tick(self, livtemp=None, target_temp=None):
+        """Re-checks the temperature and switches the heating if needed.
+
+        livtemp: float (optional)
+        target_temp: float (optional)
+                    if not given, both temperatures are read from the database
+        return: boolean (or None if the central heating isn't on, or the room temperature isn't known)
+        """
+        if (self.pi_state.get('CH') != 'on') or (self.pi_state.get('st699') == 'on'):
+            return None
+        start = time.time()
+        if (livtemp is None) or (target_temp is None):
+            livtemp, target_temp = self.read_temps()
+            if livtemp is None:
+                return None
+        heating = bool(self.pio.check_io(CH_ON))
+        if self.heating is None:
+            self.heating = heating
+            if heating:
+                # Most likely just switched on by the command that kicked this tick, so hold it on
+                self.last_switch = start
+                self.run_start = (start, livtemp, target_temp)
+        elif heating != self.heating:
+            # Switched by a command, so start timing from now
+            self.heating = heating
+            self.last_switch = start
+            if heating:
+                self.run_start = (start, livtemp, target_temp)
+        want = self.decide(livtemp, target_temp, heating, start - self.last_switch)
+        self.time_run(livtemp, target_temp, heating, want, start)
+        if want != heating:
+            logging.info(("Thermostat switching heating", 'on' if want else 'off',
+                          "room is", livtemp, "target is", target_temp))
+            self.pio.ch_relay(want)
+            self.heating = want
+            self.last_switch = time.time()
+            self.switch_count += 1
+        logging.debug(("Thermostat tick took", round(time.time() - start, 3),
+                       "seconds, relay switches so far:", self.switch_count))
+        return want
+
+
+    def time_run(self, livtemp, target_temp, heating, want, now):
+        """Times each heating run, from switching on to reaching the target, for the warm-up model.
+
+        livtemp: float
+        target_temp: float
+        heating: boolean (whether the heating was on before this tick)
+        want: boolean (whether it is on after this tick)
+        now: float
+        """
+        if self.run_start:
+            started, start_temp, start_target = self.run_start
+            if start_target != target_temp:
+                # Aiming for something else now, so the run tells us nothing
+                self.run_start = None
+            elif heating and (livtemp >= target_temp):
+                if (target_temp - start_temp) >= WARMUP_MIN_RISE:
+                    warmup.learn(target_temp - start_temp, now - started)
+                self.run_start = None
+        if not want:
+            self.run_start = None
+        elif not heating:
+            self.run_start = (now, livtemp, target_temp)
+
+
+
+class MySQLBackend(object):
+    """Keeps the piheat data in the MySQL database."""
+
+    name = 'mysql'
+
+
+    def __init__(self):
+        self.MySQLdb = lazy_import('MySQLdb')
+        self.Error = self.MySQLdb.Error
+        self.OperationalError = self.MySQLdb.OperationalError
+
+
+    def connect(self):
+        """Opens a brand new MySQL connection.
+
+        return: MySQLdb connection
         """
         # Read from .netrc file
         my_secrets = UserData()
         login, account, password = my_secrets.get_secrets('mysql')
-        self.db = MySQLdb.connect(db=account, user=login)
-        self.cursor = self.db.cursor()
-        if self.db:
-            logging.debug("MySQLdb connected successfully")
+        logging.debug("Opening a new MySQL connection")
+        return self.MySQLdb.connect(db=account, user=login)
+
+
+    def ping(self, db):
+        """Raises MySQLdb.Error if the server has dropped the connection."""
+        db.ping()
+
+
+    def prepare(self, sql):
+        """MySQLdb already uses '%s' placeholders, so nothing to change."""
+        return sql
+
+
+
+class SQLiteBackend(object):
+    """Keeps the piheat state in a local SQLite file, rather than in MySQL.
+
+    The file is used in WAL mode with synchronous=NORMAL, so a commit only
+    appends to the write-ahead log, and the SD card is only synced when the
+    log is checkpointed back into the database, every checkpoint pages.
+    The piheat and target_temp tables are created if they don't exist, and
+    with temp_tables the room temperature tables too (for the simulation,
+    which keeps everything in one in-memory database).
+    """
+
+    name = 'sqlite'
+
+
+    def __init__(self, path, checkpoint=1000, temp_tables=False):
+        self.sqlite3 = lazy_import('sqlite3')
+        self.Error = self.sqlite3.Error
+        self.OperationalError = self.sqlite3.OperationalError
+        self.path = path
+        self.checkpoint = checkpoint
+        self.temp_tables = temp_tables
+        self.created = False
+
+
+    def connect(self):
+        """Opens a connection to the SQLite file.
+
+        return: sqlite3.Connection
+        """
+        logging.debug(("Opening SQLite database", self.path))
+        if not self.path.startswith('file:'):
+            try:
+                make_state_dir(self.path)
+            except OSError as error:
+                # Reported as a database error, like any other failure to connect
+                raise self.sqlite3.OperationalError(str(error))
+        # Connections are shared between threads by the pool, one at a time
+        db = self.sqlite3.connect(self.path, timeout=5, check_same_thread=False,
+                             uri=self.path.startswith('file:'))
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA wal_autocheckpoint=%d" % self.checkpoint)
+        if not self.created:
+            self.create_tables(db)
+            self.created = True
+        return db
+
+
+    def create_tables(self, db):
+        """Creates the state tables, with every function off, if they are missing."""
+        db.execute("CREATE TABLE IF NOT EXISTS piheat "
+                   "(piheat_function TEXT PRIMARY KEY, piheat_control TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS target_temp (temp REAL)")
+        db.execute("INSERT OR IGNORE INTO piheat VALUES ('st699', 'off'), ('CH', 'off'), ('HW', 'off')")
+        db.execute("INSERT INTO target_temp SELECT 20 WHERE NOT EXISTS (SELECT 1 FROM target_temp)")
+        if self.temp_tables:
+            # As in scripts/create_temp_log.sql, with the dates in local time like MySQL's
+            db.execute("CREATE TABLE IF NOT EXISTS temp_log "
+                       "(livtemp REAL, date TIMESTAMP DEFAULT (datetime('now', 'localtime')))")
+            db.execute("CREATE TABLE IF NOT EXISTS room_temp "
+                       "(sensor TEXT PRIMARY KEY, room TEXT, temp REAL, "
+                       "date TIMESTAMP DEFAULT (datetime('now', 'localtime')))")
+            db.execute("CREATE TABLE IF NOT EXISTS temp_history "
+                       "(sensor TEXT NOT NULL, temp REAL, "
+                       "date TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')), "
+                       "PRIMARY KEY (sensor, date))")
+            db.execute("INSERT INTO temp_log (livtemp) SELECT 20 WHERE NOT EXISTS (SELECT 1 FROM temp_log)")
+        db.commit()
+
+
+    def ping(self, db):
+        """Raises sqlite3.Error if the connection can't be used."""
+        db.execute("SELECT 1")
+
+
+    def prepare(self, sql):
+        """Changes MySQLdb style '%s' placeholders into SQLite's '?'."""
+        return sql.replace('%s', '?')
+
+
+
+def make_backend(name):
+    """Creates the database backend called name, as set in the config file.
+
+    name: string ('mysql' or 'sqlite')
+    return: MySQLBackend or SQLiteBackend
+    """
+    if SIMULATE:
+        # Every backend is the same in-memory database
+        return SQLiteBackend(piheat_sim.SIM_DB, temp_tables=True)
+    if name == 'mysql':
+        return MySQLBackend()
+    if name == 'sqlite':
+        return SQLiteBackend(config.get('database', 'sqlite_path'))
+    raise ValueError("Unknown database backend: " + name)
+
+
+
+class DBPool(object):
+    """A small pool of database connections shared by every DBase in the process.
+
+    Connections are handed out by get() and handed back by put().  A
+    connection that has been sitting idle for longer than ping_interval
+    seconds is health-checked with a ping before it is reused, and replaced
+    if the server has dropped it, so a burst of commands only pays for one
+    TCP + authentication handshake.
+    """
+
+    def __init__(self, backend, size=2, ping_interval=60):
+        self.backend = backend
+        self.size = size
+        self.ping_interval = ping_interval
+        # Stored as (connection, time last used)
+        self.idle = []
+        self.lock = threading.Lock()
+
+
+    def alive(self, db, last_used):
+        """Checks that a connection is still usable.
+
+        Connections used within the last ping_interval seconds are trusted
+        without a round trip to the server.
+
+        db: database connection
+        last_used: float (seconds since the epoch)
+        return: boolean
+        """
+        if (time.time() - last_used) < self.ping_interval:
             return True
-        else:
-            logging.error("MySQLdb failed to connect")
+        try:
+            self.backend.ping(db)
+            return True
+        except self.backend.Error:
+            logging.warning(("Stale", self.backend.name, "connection, reconnecting"))
+            self.discard(db)
             return False
-        
+
+
+    def get(self):
+        """Takes a healthy connection from the pool, or opens a new one.
+
+        return: database connection
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                db, last_used = self.idle.pop()
+            if self.alive(db, last_used):
+                return db
+        return self.backend.connect()
+
+
+    def put(self, db):
+        """Returns a connection to the pool, closing it if the pool is full.
+
+        Anything left uncommitted is rolled back first, so the next session
+        to take the connection starts afresh (and sees the latest data).
+
+        db: database connection
+        """
+        try:
+            db.rollback()
+        except self.backend.Error:
+            self.discard(db)
+            return
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((db, time.time()))
+                return
+        self.discard(db)
+
+
+    def discard(self, db):
+        """Closes a connection without returning it to the pool."""
+        try:
+            db.close()
+        except self.backend.Error:
+            pass
+
+
+    def close_all(self):
+        """Closes every idle connection in the pool."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for db, last_used in idle:
+            self.discard(db)
+
+
+
+def get_pool(backend='mysql'):
+    """Gets the process-wide connection pool for a backend, creating it if needed.
+
+    backend: string ('mysql' or 'sqlite')
+    return: DBPool
+    """
+    with pools_lock:
+        if backend not in pools:
+            pools[backend] = DBPool(make_backend(backend))
+        return pools[backend]
+
+
+def close_pools():
+    """Closes every idle connection, in every pool."""
+    with pools_lock:
+        all_pools = list(pools.values())
+    for pool in all_pools:
+        pool.close_all()
+
+
+
+class DBase(object):
+
+    def __init__(self, backend='mysql'):
+        """A database session.
+
+        backend: string ('mysql' or 'sqlite')
+                    the room temperatures are only ever in MySQL, the piheat
+                    state can be in either (see 'state_backend' in the config file)
+        """
+        # One pool per backend for the whole process, so every session shares connections
+        self.pool = get_pool(backend)
+        self.backend = self.pool.backend
+        self.db = None
+        self.cursor = None
+        self.last_used = 0
+        # True once a statement has changed something that isn't committed yet
+        self.pending = False
+
+
+    def my_login(self):
+        """Makes sure this session holds a working database connection.
+
+        The connection is taken from the shared pool the first time, and
+        then kept for the life of the session, so calling this for every
+        email is cheap.  It is only re-checked with the server once it has
+        been idle for a while, and replaced if it has gone stale.
+
+        return: boolean
+                    True: connected
+                    False: not connected
+        """
+        if self.db is not None:
+            if self.pool.alive(self.db, self.last_used):
+                return True
+            # The pool has already closed the stale connection
+            self.db = None
+            self.cursor = None
+        try:
+            self.db = self.pool.get()
+        except self.backend.Error:
+            logging.error((self.backend.name, "failed to connect"))
+            return False
+        # The cursor is kept and reused for every statement in this session
+        self.cursor = self.db.cursor()
+        self.last_used = time.time()
+        logging.debug((self.backend.name, "connected successfully"))
+        return True
+
+
+    def execute(self, sql, values=None):
+        """Executes a statement on the session cursor.
+
+        If the server has dropped the connection the session reconnects
+        and tries the statement once more, but only if no earlier change
+        is waiting to be committed, as that was lost with the connection.
+        Otherwise the error is raised, for the caller to roll back and
+        start the whole transaction again.
+
+        Raises backend.Error (e.g. MySQLdb.Error) if it can't connect.
+
+        sql: string
+        values: tuple (optional)
+        """
+        if self.db is None:
+            self.connect()
+        sql = self.backend.prepare(sql)
+        args = (sql,) if values is None else (sql, values)
+        try:
+            self.cursor.execute(*args)
+        except self.backend.OperationalError:
+            logging.warning(("Lost", self.backend.name, "connection, reconnecting"))
+            self.pool.discard(self.db)
+            self.db = None
+            self.cursor = None
+            if self.pending:
+                self.pending = False
+                raise
+            self.connect()
+            self.cursor.execute(*args)
+        if not sql.lstrip().upper().startswith('SELECT'):
+            self.pending = True
+        self.last_used = time.time()
+
+
+    def connect(self):
+        """Logs in, raising backend.Error if that fails, rather than returning False."""
+        if not self.my_login():
+            raise self.backend.OperationalError("could not connect to " + self.backend.name)
+
+
+    def end_read(self):
+        """Ends the transaction a read started, unless a change is waiting to be committed.
+
+        MySQL (InnoDB, REPEATABLE READ) shows a connection the data as it
+        was at its first SELECT until the transaction ends, so a session
+        that only ever reads would never see the temperatures templog
+        writes after that.
+        """
+        if self.pending or (self.db is None):
+            return
+        try:
+            self.db.rollback()
+        except self.backend.Error:
+            # Reconnect on the next statement
+            self.pool.discard(self.db)
+            self.db = None
+            self.cursor = None
+
 
     def my_query(self, sql):
-        self.cursor.execute(sql)
+        self.execute(sql)
         data = self.cursor.fetchone()
+        self.end_read()
         return data[0]
 
 
+    def my_query_rows(self, sql, *values):
+        """Runs a SELECT and returns every row.
+
+        sql: string
+        *values: the values for any '%s' placeholders in sql
+        return: tuple of tuples
+        """
+        self.execute(sql, values)
+        rows = self.cursor.fetchall()
+        self.end_read()
+        return rows
+
+
+    def latest_reading(self, room='living'):
+        """Gets the most recent temperature reading for a room.
+
+        templog keeps the latest reading from each sensor in 'room_temp',
+        which has a row per sensor, so 'temp_history' isn't needed at all.
+        Falls back to 'temp_log' if there is no sensor for the living room.
+
+        room: string
+        return: tuple
+                    (temperature(float), date(datetime)), or None if there is no reading
+        """
+        rows = self.my_query_rows("SELECT temp, date FROM room_temp "
+                                  "WHERE room = %s ORDER BY date DESC LIMIT 1", room)
+        if rows:
+            return float(rows[0][0]), rows[0][1]
+        if room == 'living':
+            rows = self.my_query_rows("SELECT livtemp, date FROM temp_log")
+            if rows:
+                return float(rows[0][0]), rows[0][1]
+        return None
+
+
+    def recent_readings(self, minutes, room='living'):
+        """Gets every temperature reading for a room in the last few minutes.
+
+        The room's sensors are looked up first, so each 'temp_history'
+        query is a range scan of its (sensor, date) primary key.
+
+        minutes: int
+        room: string
+        return: list of tuples
+                    [(date(datetime), temperature(float)), ...] oldest first
+        """
+        since = datetime.datetime.now() - datetime.timedelta(minutes=minutes)
+        readings = []
+        for (sensor,) in self.my_query_rows("SELECT sensor FROM room_temp WHERE room = %s", room):
+            rows = self.my_query_rows("SELECT date, temp FROM temp_history "
+                                      "WHERE sensor = %s AND date >= %s ORDER BY date", sensor, since)
+            readings.extend((date, float(temp)) for date, temp in rows)
+        return sorted(readings)
+
+
+    def get_livtemp(self):
+        """Gets the latest living room temperature.
+
+        A reading pushed by templog is used while it is fresh, so the
+        database is only asked when the pushes have stopped.
+
+        return: float (or None if there is no reading at all)
+        """
+        livtemp = temp_cache.get('living')
+        if livtemp is not None:
+            return livtemp
+        reading = self.latest_reading()
+        if reading is None:
+            logging.warning("No living room temperature has been recorded")
+            return None
+        return reading[0]
+
+
     def my_update(self, sql, *values):
         """Forms a MySQL instruction from the arguments.
         
@@ -533,83 +2404,561 @@ class DBase(object):
         sql = sql % tuple(placeholders)
         values = tuple(new_values)
 
-        self.cursor.execute(sql, values)
+        self.execute(sql, values)
+        self.commit()
+
+
+    def rollback(self):
+        """Rolls back the current transaction, if connected."""
+        self.pending = False
+        if self.db is not None:
+            self.db.rollback()
+
+
+    def commit(self):
+        """Commits the current transaction."""
+        if self.db is None:
+            # Only after the connection has been lost, taking the transaction with it
+            raise self.backend.OperationalError("no " + self.backend.name + " connection to commit on")
         self.db.commit()
+        self.pending = False
 
 
     def my_logout(self):
-        """Clean up and close connection."""
+        """Clean up and hand the connection back to the shared pool."""
+        if self.db is None:
+            return
         self.cursor.close()
-        logging.debug("Closing MySQL connection")
-        self.db.close()
+        logging.debug(("Returning", self.backend.name, "connection to the pool"))
+        self.pool.put(self.db)
+        self.db = None
+        self.cursor = None
+
+
+
+class TempCache(object):
+    """The latest temperature pushed by templog for each room.
+
+    A reading is only used for max_age seconds after it arrives.  After
+    that get() returns None, so the caller reads the database instead,
+    until the pushes start again.  Readings that arrive out of order (by
+    the time templog took them) are ignored.
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        # Stored as {room: (temperature, time taken, time received)}
+        self.readings = {}
+        self.stale = set()
+        self.lock = threading.Lock()
+
+
+    def update(self, room, temp_c, taken, received=None):
+        """Stores a pushed reading.
+
+        room: string
+        temp_c: float
+        taken: float (Unix time templog took the reading)
+        received: float (optional, otherwise now)
+        return: boolean
+                    False if a newer reading for the room was already stored
+        """
+        with self.lock:
+            last = self.readings.get(room)
+            if last and (taken < last[1]):
+                return False
+            self.readings[room] = (temp_c, taken, time.time() if received is None else received)
+            if room in self.stale:
+                logging.info(("Temperature pushes for", room, "have started again"))
+                self.stale.discard(room)
+            return True
+
+
+    def age(self, room):
+        """Gets the seconds since a room's last reading arrived.
+
+        room: string
+        return: float (or None if no reading has arrived)
+        """
+        with self.lock:
+            if room not in self.readings:
+                return None
+            return time.time() - self.readings[room][2]
+
+
+    def get(self, room):
+        """Gets a room's temperature, if the last push is fresh enough.
+
+        room: string
+        return: float (or None if there is no fresh reading)
+        """
+        with self.lock:
+            reading = self.readings.get(room)
+            if reading is None:
+                return None
+            if (time.time() - reading[2]) > self.max_age:
+                if room not in self.stale:
+                    logging.warning(("No temperature pushed for", room, "in", self.max_age,
+                                     "seconds, reading the database instead"))
+                    self.stale.add(room)
+                return None
+            return reading[0]
+
+
+# The temperatures pushed by templog, used before the database
+temp_cache = TempCache(config.getfloat('push', 'max_age'))
+
+
+
+class TempListener(asyncio.DatagramProtocol):
+    """Receives the readings templog pushes, as UDP datagrams.
+
+    Each datagram is JSON, of the form
+        {"time": Unix time taken(float), "rooms": {room(string): temperature(float)}}
+
+    cache: TempCache
+    allow: list of strings
+                the addresses readings are accepted from, or empty for any
+    on_reading: callable (optional)
+                called with the room name for every reading stored
+    """
+
+    def __init__(self, cache, allow=(), on_reading=None):
+        self.cache = cache
+        self.allow = set(allow)
+        self.on_reading = on_reading
+
+
+    def datagram_received(self, data, addr):
+        if self.allow and (addr[0] not in self.allow):
+            logging.warning(("Ignoring temperatures pushed from", addr[0]))
+            return
+        try:
+            message = json.loads(data.decode('utf-8'))
+            taken = float(message['time'])
+            readings = [(str(room), float(temp_c)) for room, temp_c in message['rooms'].items()]
+        except (ValueError, TypeError, KeyError, AttributeError, UnicodeDecodeError):
+            logging.warning(("Bad temperature push from", addr[0], data[:100]))
+            return
+        for room, temp_c in readings:
+            if self.cache.update(room, temp_c, taken) and self.on_reading:
+                self.on_reading(room)
+
+
+
+class StateStore(dict):
+    """The state of each piheat function, and the target temperature.
+
+    Behaves like the pi_state dictionary, e.g. pi_state['CH'] = 'on', but
+    remembers which values have changed.  Setting a value to what it already
+    is does nothing, and commit() writes only the changed values to MySQL,
+    in a single transaction.
+    """
+
+    def __init__(self, db):
+        dict.__init__(self)
+        self.db = db
+        self.target_temp = None
+        self.dirty = set()
+
+
+    def load(self):
+        """Reads every function's state and the target temperature in one query."""
+        rows = self.db.my_query_rows("SELECT piheat_function, piheat_control FROM piheat "
+                                     "UNION ALL SELECT 'target_temp', temp FROM target_temp")
+        for function, control in rows:
+            if function == 'target_temp':
+                self.target_temp = float(control)
+            else:
+                dict.__setitem__(self, function, control)
+        self.dirty.clear()
+
 
+    def __setitem__(self, function, control):
+        if self.get(function) == control:
+            return
+        dict.__setitem__(self, function, control)
+        self.dirty.add(function)
+
+
+    def set_target_temp(self, target_temp):
+        """Sets the target temperature, if it has changed.
+
+        target_temp: float
+        """
+        if target_temp == self.target_temp:
+            return
+        self.target_temp = target_temp
+        self.dirty.add('target_temp')
+
+
+    def commit(self):
+        """Writes any changed values to the database, in one transaction.
+
+        If the connection is lost part way through, the transaction is
+        rolled back and the whole of it is tried once more.
+
+        return: int
+                    the number of values written
+        """
+        if not self.dirty:
+            return 0
+        dirty = sorted(self.dirty)
+        for attempt in range(2):
+            try:
+                self.db.my_login()
+                for function in dirty:
+                    if function == 'target_temp':
+                        self.db.execute("UPDATE target_temp SET temp=(%s)", (self.target_temp,))
+                    else:
+                        self.db.execute("UPDATE piheat SET piheat_control=(%s) WHERE piheat_function=(%s)",
+                                        (self[function], function))
+                self.db.commit()
+                break
+            except self.db.backend.OperationalError:
+                self.db.rollback()
+                if attempt:
+                    logging.exception("Could not save the piheat state")
+                    return 0
+                logging.warning("Connection lost while saving the piheat state, starting again")
+            except self.db.backend.Error:
+                logging.exception("Could not save the piheat state")
+                self.db.rollback()
+                return 0
+        self.dirty.clear()
+        logging.debug(("Saved", dirty))
+        return len(dirty)
+
+
+
+class Runtime(object):
+    """Runs piheat as a set of concurrent asyncio tasks.
+
+    watch_mail:         waits in IMAP IDLE and acts on command emails
+    poll_temperature:   reads the room and target temperatures, and
+                        listens for readings pushed by templog (see
+                        [push] in the config file)
+    control_heating:    runs the thermostat whenever a command or a new
+                        temperature comes in, or every thermostat period
+    monitor_network:    keeps track of the internet connection
+    run_schedule:       carries out the local schedule while Gmail can't be
+                        reached
+
+    The blocking IMAP, MySQL and GPIO calls run in worker threads, each with
+    a timeout, so no task can hold up the others.  IDLE is limited to
+    idle_timeout seconds so the mail task regularly gets a chance to notice
+    it has been cancelled.  A Gmail session that fails, or an IDLE that
+    doesn't come back in time, is reconnected by a MailSupervisor rather
+    than stopping the service.
+    """
+
+    def __init__(self, piheat, my_db, pi_state, conn,
+                 idle_timeout=IDLE_TIMEOUT, temp_period=TEMP_POLL_PERIOD):
+        self.piheat = piheat
+        self.my_db = my_db
+        self.pi_state = pi_state
+        self.conn = conn
+        self.idle_timeout = idle_timeout
+        self.temp_period = temp_period
+        self.thermostat = Thermostat(pi_state)
+        self.pio = Pio()
+        self.supervisor = MailSupervisor(piheat, my_db)
+        # When the connection was lost, and the hub last reset, see monitor_network()
+        self.offline_since = None
+        self.last_hub_reset = 0
+        # (livtemp, target_temp) from the last poll
+        self.temps = None
+        # Created in run(), as they belong to the event loop
+        self.online = None
+        self.kick = None
+
+
+    async def blocking(self, timeout, func, *args):
+        """Runs a blocking call in a worker thread, giving up after timeout seconds.
+
+        timeout: int or float
+        func: callable
+        *args: the arguments for func
+        return: whatever func returns
+        """
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(None, func, *args), timeout)
+
+
+    def end_idle(self):
+        """Sends a NOOP, which ends any IDLE the mail worker thread is waiting in."""
+        try:
+            self.piheat.noop()
+        except Exception:
+            pass
+
+
+    async def watch_mail(self):
+        """Waits for command emails, until the ST699 is switched back on."""
+        supervisor = self.supervisor
+        while True:
+            await self.online.wait()
+            try:
+                if not supervisor.connected():
+                    await self.blocking(CALL_TIMEOUT, supervisor.reconnect)
+                self.pi_state = await self.blocking(self.idle_timeout + CALL_TIMEOUT,
+                                                    self.piheat.read_folder, supervisor.mailbox,
+                                                    'SELECTED', self.pi_state, self.idle_timeout)
+                supervisor.succeeded()
+                self.thermostat.pi_state = self.pi_state
+                # Let the thermostat act on any command straight away
+                self.kick.set()
+            except asyncio.CancelledError:
+                # Any other command ends IDLE, so the worker thread can finish.  Not waited
+                # for, as the connection may not answer, and that would hold up the shutdown
+                threading.Thread(target=self.end_idle, name='end idle', daemon=True).start()
+                raise
+            except Exception as error:
+                # Includes an IDLE that has timed out, as the connection has probably gone
+                logging.exception("Error while reading email")
+                self.conn.invalidate()
+                try:
+                    # Logging out of a connection that has stopped answering can take a while
+                    delay = await self.blocking(CALL_TIMEOUT, supervisor.failed, error)
+                except asyncio.TimeoutError:
+                    logging.warning("Gmail logout timed out")
+                    delay = supervisor.backoff()
+                await asyncio.sleep(delay)
+            if not self.pio.check_io(ST699):
+                logging.info("ST699 is on, handing control back to the old programmer")
+                return
+
+
+    async def poll_temperature(self):
+        """Reads the temperatures every temp_period seconds."""
+        while True:
+            try:
+                temps = await self.blocking(CALL_TIMEOUT, self.thermostat.read_temps)
+                if temps != self.temps:
+                    self.temps = temps
+                    self.kick.set()
+            except Exception:
+                logging.exception("Could not read the temperatures")
+            await asyncio.sleep(self.temp_period)
+
+
+    def pushed(self, room):
+        """Runs the thermostat as soon as templog pushes a new living room temperature.
+
+        room: string
+        """
+        if room != 'living':
+            return
+        livtemp = temp_cache.get('living')
+        target_temp = getattr(self.pi_state, 'target_temp', None)
+        if target_temp is None and self.temps:
+            target_temp = self.temps[1]
+        if (livtemp is not None) and (target_temp is not None) and ((livtemp, target_temp) != self.temps):
+            self.temps = (livtemp, target_temp)
+            self.kick.set()
+
+
+    async def listen(self):
+        """Starts listening for temperatures pushed by templog, if set up to.
+
+        return: asyncio.DatagramTransport (or None if not listening)
+        """
+        listen = config.get('push', 'listen')
+        if not listen:
+            return None
+        host, sep, port = listen.rpartition(':')
+        allow = [address.strip() for address in config.get('push', 'allow').split(',') if address.strip()]
+        loop = asyncio.get_running_loop()
+        try:
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: TempListener(temp_cache, allow, self.pushed), local_addr=(host or '0.0.0.0', int(port)))
+        except (OSError, ValueError):
+            logging.exception(("Could not listen for temperatures on", listen))
+            return None
+        logging.info(("Listening for temperatures on", listen))
+        return transport
+
+
+    def current_temps(self):
+        """The last room temperature read, with the target as it is now.
+
+        A command since the last poll may have changed the target, so it is
+        taken from pi_state rather than from self.temps.
+
+        return: tuple
+                    (livtemp(float), target_temp(float)), or None if the room temperature isn't known yet
+        """
+        if (self.temps is None) or (self.temps[0] is None):
+            return None
+        target_temp = getattr(self.pi_state, 'target_temp', None)
+        if target_temp is None:
+            target_temp = self.temps[1]
+        return self.temps[0], target_temp
+
+
+    async def control_heating(self):
+        """Runs the thermostat when kicked, or every thermostat period."""
+        while True:
+            try:
+                await asyncio.wait_for(self.kick.wait(), self.thermostat.period)
+            except asyncio.TimeoutError:
+                pass
+            self.kick.clear()
+            temps = self.current_temps()
+            if temps is None:
+                # Nothing to go on until there is a room temperature
+                continue
+            try:
+                # Start heating early for a 'CH = n @ time' event, if it is time to
+                due = self.piheat.due_preheat(*temps)
+                if due:
+                    self.pi_state = await self.blocking(CALL_TIMEOUT, self.piheat.check_commands,
+                                                        due, self.pi_state, False)
+                    self.thermostat.pi_state = self.pi_state
+                    temps = self.current_temps()
+            except Exception:
+                logging.exception("Could not start the pre-heat")
+            try:
+                await self.blocking(CALL_TIMEOUT, self.thermostat.tick, *temps)
+            except Exception:
+                logging.exception("Thermostat tick failed")
+
+
+    async def monitor_network(self):
+        """Checks the internet connection, and resets the hub if it is lost.
+
+        The hub takes minutes to reboot (and may still be starting up after
+        a power cut), so it is only reset once the connection has been down
+        for HUB_RESET_AFTER seconds, and then once every HUB_RESET_INTERVAL
+        seconds, however long the connection is down.
+        """
+        while True:
+            try:
+                connection = await self.blocking(CALL_TIMEOUT, self.conn.test)
+            except asyncio.TimeoutError:
+                connection = False
+            if connection:
+                self.online.set()
+                self.offline_since = None
+                await asyncio.sleep(self.conn.ttl)
+                continue
+            self.online.clear()
+            now = time.time()
+            if self.offline_since is None:
+                self.offline_since = now
+            if (now - self.offline_since >= HUB_RESET_AFTER) and (now - self.last_hub_reset >= HUB_RESET_INTERVAL):
+                self.last_hub_reset = time.time()
+                try:
+                    # Should reset the hub
+                    await self.blocking(CALL_TIMEOUT + 4 * HUB_TIMEOUT, reset_hub)
+                except Exception as error:
+                    logging.error(("Could not reset the hub:", repr(error)))
+            # Don't trust the cached result from before the reset
+            self.conn.invalidate()
+            await asyncio.sleep(self.conn.fail_ttl)
+
+
+    async def run_schedule(self):
+        """Carries out the local schedule whenever Gmail can't be reached.
+
+        While the mail is being read, the emails themselves are acted on, and
+        the schedule entries that come due are just passed over.
+        """
+        while True:
+            schedule.check_ical(config.get('schedule', 'ical'), config.getint('schedule', 'days'))
+            due = schedule.due()
+            offline = (not self.online.is_set()) or (self.piheat.get_mail_state() not in ('AUTH', 'SELECTED'))
+            if due and offline:
+                logging.info(("Gmail can't be reached, so running", due, "from the local schedule"))
+                try:
+                    self.pi_state = await self.blocking(CALL_TIMEOUT, self.piheat.check_commands,
+                                                        [(0, command) for command in due], self.pi_state)
+                    self.thermostat.pi_state = self.pi_state
+                    self.kick.set()
+                except Exception:
+                    logging.exception("Could not run the scheduled commands")
+            next_time = schedule.next_time()
+            wait = SCHEDULE_CHECK if next_time is None else next_time - time.time()
+            await asyncio.sleep(min(max(wait, 0), SCHEDULE_CHECK))
+
+
+    async def run(self):
+        """Runs all the tasks until the mail task finishes, or it is stopped."""
+        self.online = asyncio.Event()
+        self.kick = asyncio.Event()
+        listener = await self.listen()
+        tasks = [asyncio.ensure_future(task()) for task in
+                 (self.watch_mail, self.poll_temperature, self.control_heating, self.monitor_network,
+                  self.run_schedule)]
+        loop = asyncio.get_running_loop()
+        # Let systemd stop the service cleanly
+        loop.add_signal_handler(signal.SIGTERM, lambda: [task.cancel() for task in tasks])
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if listener is not None:
+                listener.close()
+            # Until they stop, as wait_for can swallow a cancel that lands just as its call finishes
+            while not all(task.done() for task in tasks):
+                for task in tasks:
+                    task.cancel()
+                await asyncio.wait(tasks, timeout=1)
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+                    logging.error(("Task failed:", result))
+            self.thermostat.db.my_logout()
+            logging.info(("Gmail sessions:", self.supervisor.stats()))
+
+
+startup_times['import piheat'] = time.perf_counter() - import_started
 
 
 def main():
     """The main piheat.py function."""
-    logging.debug("TEST")
+    init_gpio()
     check_pio = Pio()
-    logged_in = False
     conn = CheckNet()
+    # A single database session, shared with the Gmail command handler
+    my_db = DBase()
+    # Given the session now, as the local schedule may need it before Gmail can be logged in to
+    piheat  = Gmail(my_db)
     connection = conn.test()
     if connection:
-        piheat  = Gmail()
-        logged_in = piheat.login()
-    else:
-        hub = VMSuperHub()
-        # Should reset the hub
-        hub.vm_login()
-    my_db = DBase()
+        piheat.login(my_db)
+    # If not, the runtime will reset the hub and log in once the connection is back
     rv = my_db.my_login()
+    if debug:
+        startup_times['ready'] = time.perf_counter() - import_started
+        logging.debug(("Startup profile (seconds):",
+                       sorted(startup_times.items(), key=lambda step: step[1], reverse=True)))
     if rv:
         
-        pi_state = {}
-        # Get the state of each 'function' from 'piheat' table
-        for function in piheat.get_commands():
-            sql = "SELECT piheat_control FROM piheat WHERE piheat_function='" + function + "'"
-            pi_state[function] = my_db.my_query(sql)
+        # Get the state of each 'function' from 'piheat' table, and the target temperature
+        pi_state = StateStore(DBase(config.get('database', 'state_backend')))
+        pi_state.load()
         # Need to invoke 'function_on' if 'on' in dictionary, else keep off
         if pi_state['st699'] == 'on':
             check_pio.st699_on()
         elif pi_state['HW'] == 'on':
             check_pio.hw_on()
         elif pi_state['CH'] == 'on':
-            livtemp = my_db.my_query("SELECT livtemp FROM temp_log")
-            target_temp = float(my_db.my_query("SELECT temp FROM target_temp"))
-            check_pio.ch_on(livtemp, target_temp)
+            livtemp = my_db.get_livtemp()
+            check_pio.ch_on(livtemp, pi_state.target_temp)
         print(pi_state)
-    while (check_pio.check_io(ST699)) and logged_in:
-#        # Need this as a thread to run constantly
-#        if pi_state['CH'] == 'on':
-#            livtemp = my_db.my_query("SELECT livtemp FROM temp_log")
-#            target_temp = my_db.my_query("SELECT temp FROM target_temp")
-#            check_pio.ch_on(livtemp, target_temp)
+    # Nothing to do while the ST699 is in control
+    if rv and check_pio.check_io(ST699):
+        runtime = Runtime(piheat, my_db, pi_state, conn)
         try:
-            connection = conn.test()
-            if connection:
-                gmail_state = piheat.get_mail_state()
-                if (gmail_state == 'AUTH') or (gmail_state == 'SELECTED'):
-                    pi_state = piheat.read_folder('piheat', gmail_state, pi_state)
-                    
-                elif gmail.state == 'NONAUTH':
-                    logged_in = piheat.login()
-                else:
-                    logging.error("\n\nCannot connect to Gmail IMAP server.")
-                    logging.error("State repsonse is:")
-                    logging.error(gmail_state)
-            else:
-                # Should reset the hub
-                hub.vm_login()
-                st699_state = check_pio.check_io(ST699)
-                break
+            asyncio.run(runtime.run())
         except (KeyboardInterrupt):
             # On Ctrl-c cleanup & exit
             logging.info("PROGRAM STOPPING!  Closing MySQL and IMAP connections")
-            break
     try:
         piheat.logout()
     except:
         pass
+    close_pools()
     logging.shutdown()
 
 
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""Logging for piheat.py and templog.py, kind to the SD card.
+
+Records are held in a ring buffer in RAM, and written to the log file in
+one batch:
+    - every 'flush_interval' seconds
+    - straight away for a record at or above 'flush_level' (so the records
+      leading up to an error are written along with it)
+    - when the program exits
+If more than 'buffer' records come in between writes, the oldest are
+dropped, and a line saying how many is written in their place.
+
+The same message (at the same level) is only logged 'rate_limit' times in
+each 'rate_period' seconds.  How many were left out is added to the next
+one that gets through.
+
+The log file is rotated once it reaches 'max_bytes', keeping
+'backup_count' old files.  Records can be written as text, or as one JSON
+object per line ('format = json'), which includes any 'extra' fields
+logged with them, e.g. the stage timings piheat logs for each wake-up.
+
+All of these are set in the [logging] section of the config file, see
+scripts/piheat.conf.
+"""
+import sys
+import json
+import logging
+import threading
+import collections
+import logging.handlers
+
+
+# The settings in the [logging] section, and their defaults
+DEFAULTS = {'level': 'info',
+            'format': 'text',
+            'piheat_file': '/var/log/piheat.log',
+            'templog_file': '/var/log/livtemp.log',
+            'buffer': '1000',
+            'flush_interval': '60',
+            'flush_level': 'warning',
+            'max_bytes': '1048576',
+            'backup_count': '3',
+            'rate_limit': '10',
+            'rate_period': '60',
+            'imap_debug': '0'}
+
+TEXT_FORMAT = '%(asctime)s %(message)s'
+
+# The attributes every LogRecord has, so anything else was passed as 'extra'
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | set(['message', 'asctime'])
+
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets the same message through at most 'limit' times in each 'period' seconds.
+
+    Messages are the same if they are at the same level and start the same:
+    the first item of a tuple, as logged throughout piheat, or the format
+    string of any other message.  The number left out is put on the next
+    one let through, as record.suppressed.
+    """
+
+    def __init__(self, limit, period):
+        logging.Filter.__init__(self)
+        self.limit = limit
+        self.period = period
+        # Stored as {(level, message): [period start(float), count(int), suppressed(int)]}
+        self.counts = {}
+
+
+    def filter(self, record):
+        if self.limit <= 0:
+            return True
+        message = record.msg[0] if isinstance(record.msg, tuple) and record.msg else record.msg
+        key = (record.levelno, str(message))
+        now = record.created
+        count = self.counts.get(key)
+        if (count is None) or (now - count[0] >= self.period):
+            if len(self.counts) > 1000:
+                # Don't let one-off messages build up forever
+                self.counts.clear()
+            suppressed = count[2] if count else 0
+            count = self.counts[key] = [now, 0, suppressed]
+        count[1] += 1
+        if count[1] > self.limit:
+            count[2] += 1
+            return False
+        if count[2]:
+            record.suppressed = count[2]
+            count[2] = 0
+        return True
+
+
+
+class TextFormatter(logging.Formatter):
+    """The usual '%(asctime)s %(message)s', noting any messages left out by the rate limit."""
+
+    def format(self, record):
+        text = logging.Formatter.format(self, record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += ' (%d more like this left out)' % suppressed
+        return text
+
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats each record as one line of JSON.
+
+    A message logged as a tuple is kept as a list, so it can be read back
+    without parsing the text.  Any 'extra' fields are included as they are.
+    """
+
+    def format(self, record):
+        if isinstance(record.msg, tuple) and not record.args:
+            message = list(record.msg)
+        else:
+            message = record.getMessage()
+        entry = {'time': round(record.created, 3),
+                 'level': record.levelname,
+                 'thread': record.threadName,
+                 'message': message}
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+
+class BatchFileHandler(logging.handlers.RotatingFileHandler):
+    """A RotatingFileHandler that can write a batch of lines with one write.
+
+    The file isn't opened until the first batch, so nothing is written
+    for a program that doesn't log anything.
+    """
+
+    def __init__(self, filename, max_bytes, backup_count):
+        logging.handlers.RotatingFileHandler.__init__(self, filename, maxBytes=max_bytes,
+                                                      backupCount=backup_count, delay=True)
+
+
+    def write_lines(self, lines):
+        """Writes formatted records to the file, rotating it first if they won't fit.
+
+        lines: list of string
+        """
+        text = ''.join(line + self.terminator for line in lines)
+        self.acquire()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes and (self.stream.tell() + len(text) >= self.maxBytes):
+                self.doRollover()
+                if self.stream is None:
+                    # doRollover leaves the new file for later, as the file is opened lazily
+                    self.stream = self._open()
+            self.stream.write(text)
+            self.stream.flush()
+        except OSError:
+            # Nowhere to report it but stderr, as logging.Handler.handleError does
+            sys.stderr.write("Could not write to the log file %s\n" % self.baseFilename)
+        finally:
+            self.release()
+
+
+
+class RingBufferHandler(logging.Handler):
+    """Holds the newest 'capacity' records in RAM, and passes them on in batches.
+
+    Records are formatted as they come in, so a batch shows the values
+    logged at the time, not as they are when it is written.
+
+    target: BatchFileHandler
+    capacity: int
+    flush_interval: int or float (seconds)
+    flush_level: int (e.g. logging.WARNING)
+    """
+
+    def __init__(self, target, capacity, flush_interval, flush_level):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.buffer = collections.deque(maxlen=capacity)
+        self.flush_level = flush_level
+        self.flush_interval = flush_interval
+        # Records pushed out of the buffer before they could be written
+        self.dropped = 0
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_every, name='log flush', daemon=True)
+        self.flusher.start()
+
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.acquire()
+        try:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(line)
+        finally:
+            self.release()
+        if record.levelno >= self.flush_level:
+            self.flush()
+
+
+    def flush(self):
+        """Writes everything in the buffer to the target, in one batch."""
+        self.acquire()
+        try:
+            lines = list(self.buffer)
+            self.buffer.clear()
+            dropped, self.dropped = self.dropped, 0
+        finally:
+            self.release()
+        if dropped:
+            lines.insert(0, self.format(logging.makeLogRecord(
+                {'msg': ("Log buffer full,", dropped, "records dropped"),
+                 'levelno': logging.WARNING, 'levelname': 'WARNING'})))
+        if lines:
+            self.target.write_lines(lines)
+
+
+    def _flush_every(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+
+    def close(self):
+        self.closed.set()
+        self.flush()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+
+def setup(program, config, console=False):
+    """Sets up the root logger for piheat or templog, from the [logging] section of config.
+
+    Like logging.basicConfig, does nothing if the root logger already has
+    handlers, e.g. when imported by a test program that logs elsewhere.
+
+    program: string ('piheat' or 'templog', for the '<program>_file' setting)
+    config: configparser.ConfigParser
+                with the [logging] section, whose defaults are in DEFAULTS
+    console: boolean
+                log everything to stderr as it happens, for debugging
+    return: logging.Handler (or None if logging was already set up)
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    settings = config['logging']
+    if console:
+        handler = logging.StreamHandler(sys.stderr)
+        root.setLevel(logging.DEBUG)
+    else:
+        target = BatchFileHandler(settings.get(program + '_file'), settings.getint('max_bytes'),
+                                  settings.getint('backup_count'))
+        handler = RingBufferHandler(target, settings.getint('buffer'), settings.getfloat('flush_interval'),
+                                    logging.getLevelName(settings.get('flush_level').upper()))
+        root.setLevel(logging.getLevelName(settings.get('level').upper()))
+    if settings.get('format') == 'json':
+        formatter = JSONFormatter()
+    else:
+        formatter = TextFormatter(TEXT_FORMAT)
+    handler.setFormatter(formatter)
+    handler.addFilter(RateLimitFilter(settings.getint('rate_limit'), settings.getfloat('rate_period')))
+    root.addHandler(handler)
+    return handler
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+"""Stand-ins for the hardware and servers piheat talks to.
+
+Lets the whole command path be run, tested and timed on any Linux box,
+without a Raspberry Pi, a Gmail account, MySQL or a DS18B20.
+
+piheat.py uses these when the PIHEAT_SIMULATE environment variable is set
+to 'yes' (or 'enabled = yes' is set in the [simulation] section of the
+config file):
+    FakeGPIO            replaces RPi.GPIO, and records every pin change
+    FakeIMAPServer      a mailbox held in memory, which Gmail.login connects
+                        to instead of imap.gmail.com
+    SQLite              both database backends use one in-memory SQLite
+                        database, which includes the temperature tables
+
+The simulated sensors are files laid out like the kernel's one-wire sysfs
+tree, for templog.py to read (see make_w1_tree).
+"""
+import os
+import re
+import time
+import threading
+import email.utils
+
+
+# Name of the shared in-memory SQLite database used in place of MySQL
+SIM_DB = 'file:piheat_sim?mode=memory&cache=shared'
+
+# The simulated servers accept any login, so give them one
+os.environ.setdefault('PIHEAT_IMAP_GMAIL_COM_LOGIN', 'piheat@example.com')
+os.environ.setdefault('PIHEAT_IMAP_GMAIL_COM_PASSWORD', 'simulated')
+
+
+
+class FakeGPIO(object):
+    """Stands in for RPi.GPIO, keeping the pin states in memory.
+
+    Every change is recorded in 'history', as (time, pin, value).
+    """
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self):
+        self.pins = {}
+        self.history = []
+
+
+    def setwarnings(self, flag):
+        pass
+
+
+    def setmode(self, mode):
+        self.mode = mode
+
+
+    def setup(self, pin, mode, initial=0):
+        self.output(pin, initial)
+
+
+    def output(self, pin, value):
+        value = int(bool(value))
+        self.pins[pin] = value
+        self.history.append((time.time(), pin, value))
+
+
+    def input(self, pin):
+        return self.pins.get(pin, 0)
+
+
+    def cleanup(self):
+        self.pins.clear()
+
+
+
+class FakeIMAPServer(object):
+    """A single mailbox, held in memory.
+
+    Messages are added with deliver(), which also wakes any connection
+    waiting in IDLE.  Only the subject and date of each message are kept.
+    drop_connections() simulates the network going, as every connection
+    open at the time fails.
+    """
+
+    def __init__(self):
+        self.changed = threading.Condition()
+        # Goes up each time the connections are dropped
+        self.generation = 0
+        self.reset()
+
+
+    def reset(self):
+        """Empties the mailbox, and starts the UIDs again."""
+        with self.changed:
+            # Stored as {uid(int): subject(string)}
+            self.messages = {}
+            # Stored as {uid(int): Unix time the message was sent(float)}
+            self.dates = {}
+            self.deleted = set()
+            self.next_uid = 1
+            self.uidvalidity = int(time.time())
+            # Every command received, as (command(string), args(tuple))
+            self.commands = []
+
+
+    def deliver(self, subject, sent=None):
+        """Adds a message to the mailbox.
+
+        subject: string
+        sent: float (optional)
+                    the Unix time for the Date header, otherwise now
+        return: int (the message's UID)
+        """
+        with self.changed:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.messages[uid] = subject
+            self.dates[uid] = time.time() if sent is None else sent
+            self.changed.notify_all()
+            return uid
+
+
+    def drop_connections(self):
+        """Makes every open connection fail, including any waiting in IDLE."""
+        with self.changed:
+            self.generation += 1
+            self.changed.notify_all()
+
+
+    def connect(self):
+        """Opens a new connection to the mailbox.
+
+        return: FakeIMAP
+        """
+        return FakeIMAP(self)
+
+
+
+class FakeIMAP(object):
+    """Stands in for imaplib2.IMAP4_SSL, connected to a FakeIMAPServer.
+
+    Supports the commands piheat uses, returning responses in the same
+    form as imaplib2.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.state = 'NONAUTH'
+        self.responses = {}
+        self.seen_uid = 0
+        self.interrupted = False
+        self.generation = server.generation
+
+
+    def _log(self, command, *args):
+        self._check()
+        self.server.commands.append((command, args))
+
+
+    def _check(self):
+        """Fails, as imaplib2 would, if the connection has been dropped."""
+        if self.generation != self.server.generation:
+            self.state = 'LOGOUT'
+            raise ConnectionError("connection dropped")
+
+
+    def login(self, user, password):
+        self._log('LOGIN', user)
+        self.state = 'AUTH'
+        return 'OK', [b'LOGIN completed']
+
+
+    def select(self, mailbox='INBOX'):
+        self._log('SELECT', mailbox)
+        with self.server.changed:
+            self.state = 'SELECTED'
+            self.responses['UIDVALIDITY'] = [str(self.server.uidvalidity).encode()]
+            self.responses['UIDNEXT'] = [str(self.server.next_uid).encode()]
+            self.seen_uid = self.server.next_uid - 1
+            return 'OK', [str(len(self.server.messages)).encode()]
+
+
+    def response(self, code):
+        return code, self.responses.pop(code, [None])
+
+
+    def noop(self):
+        """Like the real thing, any command ends an IDLE in another thread."""
+        self._log('NOOP')
+        with self.server.changed:
+            self.interrupted = True
+            self.server.changed.notify_all()
+        return 'OK', [b'NOOP completed']
+
+
+    def idle(self, timeout=None):
+        """Waits until a message arrives, or timeout seconds have passed."""
+        self._log('IDLE', timeout)
+        server = self.server
+        with server.changed:
+            server.changed.wait_for(lambda: (server.next_uid - 1 > self.seen_uid) or self.interrupted
+                                    or (self.generation != server.generation), timeout)
+            self._check()
+            self.interrupted = False
+            self.seen_uid = server.next_uid - 1
+        self.responses['IDLE'] = [None]
+        return 'OK', [b'IDLE terminated']
+
+
+    def uid(self, command, *args):
+        self._log('UID ' + command, *args)
+        with self.server.changed:
+            if command == 'SEARCH':
+                return self._search(args[1:])
+            if command == 'FETCH':
+                return self._fetch(args[0], args[1])
+            if command == 'STORE':
+                self.server.deleted.update(parse_message_set(args[0], self.server.messages))
+                return 'OK', [None]
+        return 'BAD', [b'command unknown or arguments invalid']
+
+
+    def _search(self, criteria):
+        messages = self.server.messages
+        if criteria[0] == 'ALL':
+            uids = sorted(messages)
+        elif criteria[0] == 'UID':
+            uids = parse_message_set(criteria[1], messages)
+        else:
+            found = re.search(r'SUBJECT "([^"]*)"', criteria[0])
+            text = found.group(1) if found else ''
+            uids = [uid for uid in sorted(messages) if text in messages[uid]]
+        return 'OK', [' '.join(str(uid) for uid in uids).encode()]
+
+
+    def _fetch(self, message_set, item):
+        data = []
+        messages = self.server.messages
+        # Answer with the headers asked for, e.g. 'BODY[HEADER.FIELDS (SUBJECT DATE)]'
+        fields = re.search(r'HEADER\.FIELDS \(([^)]*)\)', item).group(1).upper().split()
+        for seq, uid in enumerate(parse_message_set(message_set, messages), 1):
+            header = ''
+            if 'SUBJECT' in fields:
+                header += 'Subject: ' + messages[uid] + '\r\n'
+            if 'DATE' in fields:
+                header += 'Date: ' + email.utils.formatdate(self.server.dates[uid], localtime=True) + '\r\n'
+            header = (header + '\r\n').encode('utf-8')
+            envelope = '%d (UID %d BODY[HEADER.FIELDS (%s)] {%d}' % (seq, uid, ' '.join(fields), len(header))
+            data.append((envelope.encode(), header))
+            data.append(b')')
+        return 'OK', data
+
+
+    def expunge(self):
+        self._log('EXPUNGE')
+        with self.server.changed:
+            for uid in self.server.deleted:
+                self.server.messages.pop(uid, None)
+                self.server.dates.pop(uid, None)
+            self.server.deleted.clear()
+        return 'OK', [None]
+
+
+    def close(self):
+        self._log('CLOSE')
+        self.state = 'AUTH'
+        return 'OK', [None]
+
+
+    def logout(self):
+        """Like the real thing, ends an IDLE in another thread."""
+        self._log('LOGOUT')
+        with self.server.changed:
+            self.state = 'LOGOUT'
+            self.interrupted = True
+            self.server.changed.notify_all()
+        return 'BYE', [None]
+
+
+
+def parse_message_set(message_set, messages):
+    """Turns an IMAP message set such as '1:3,7' or '5:*' into a list of UIDs.
+
+    As with a real server, 'n:*' always includes the highest UID.
+
+    message_set: string
+    messages: dict (the mailbox)
+    return: list of int
+    """
+    highest = max(messages) if messages else 0
+    uids = set()
+    for part in str(message_set).split(','):
+        first, sep, last = part.partition(':')
+        first = highest if first == '*' else int(first)
+        last = first if not sep else (highest if last == '*' else int(last))
+        first, last = min(first, last), max(first, last)
+        uids.update(uid for uid in messages if first <= uid <= last)
+    return sorted(uids)
+
+
+def make_w1_tree(base, temps):
+    """Lays out a simulated one-wire sysfs tree, for templog.py to read.
+
+    base: string (a directory, used in place of /sys/bus/w1/devices)
+    temps: dict
+                of the form {serial number(string): temperature(float)}
+    """
+    for serial, temp_c in temps.items():
+        set_w1_temp(base, serial, temp_c)
+
+
+def set_w1_temp(base, serial, temp_c, crc_ok=True):
+    """Sets the reading of one simulated DS18B20.
+
+    base: string
+    serial: string (e.g. '28-0000000000aa')
+    temp_c: float
+    crc_ok: boolean (False simulates a failed CRC check)
+    """
+    device = os.path.join(base, serial)
+    if not os.path.isdir(device):
+        os.makedirs(device)
+    crc = 'YES' if crc_ok else 'NO'
+    with open(os.path.join(device, 'w1_slave'), 'w') as f:
+        f.write('72 01 4b 46 7f ff 0e 10 57 : crc=57 %s\n' % crc)
+        f.write('72 01 4b 46 7f ff 0e 10 57 t=%d\n' % int(round(temp_c * 1000)))
+
+
+def set_room_temp(db, temp_c, room='living', sensor='28-000000000000'):
+    """Records a room temperature in the simulated database, as templog would.
+
+    db: piheat.DBase (using the SQLite backend)
+    temp_c: float
+    room: string
+    sensor: string
+    """
+    db.execute("INSERT OR REPLACE INTO room_temp (sensor, room, temp) VALUES (%s, %s, %s)",
+               (sensor, room, temp_c))
+    db.execute("INSERT OR REPLACE INTO temp_history (sensor, temp) VALUES (%s, %s)", (sensor, temp_c))
+    if room == 'living':
+        db.execute("UPDATE temp_log SET livtemp=(%s)", (temp_c,))
+    db.commit()
+
+
+# The one simulated mailbox, which Gmail.login connects to
+imap_server = FakeIMAPServer()
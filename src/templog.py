@@ -2,98 +2,620 @@
 
 """Reads the temperature from a DS18B20 digital one-wire thermometer.
 
-The temperature is converted to celcius and written to a MySQL database.
+Every DS18B20 on the one-wire bus is found automatically and read at the
+same time.  The temperatures are converted to celcius and written to a
+MySQL database, one row per room in 'room_temp', with the living room
+sensor also written to 'temp_log' as before.  Every reading is appended to
+'temp_history', which is rolled up into 1-minute and 1-hour aggregates in
+'temp_rollup' and pruned after a while.
+
+Run with no arguments (e.g. from cron) to take a single reading, or with
+--daemon to keep running, sampling every --interval seconds over one
+persistent database connection.  With --push HOST:PORT every set of
+readings is also sent straight to piheat, as a UDP datagram, so it doesn't
+have to wait for the database.
 """
+import os
+import glob
 import time
+import json
+import socket
+import argparse
+import statistics
+import signal
+import threading
+import importlib
+import configparser
+from concurrent.futures import ThreadPoolExecutor
 
-import MySQLdb
 import logging
-# Appends logging messages to the specified file, with a timestamp for each entry
-logging.basicConfig(filename='/var/log/livtemp.log', level=logging.INFO, format='%(asctime)s %(message)s')
+import piheat_log
+
+import credentials
+
+
+# Shares the [logging] section of piheat's config file, see piheat_log.py
+CONFIG_FILE = os.environ.get('PIHEAT_CONFIG', '/etc/piheat.conf')
+
+
+# Where the kernel lists one-wire devices.  DS18B20 serial numbers start with '28-'
+w1_devices = "/sys/bus/w1/devices"
+
+# The serial number of the living room probe, written to 'temp_log'
+living_room_sensor = "28-051686a14fff"
+# Points to the DS18B20, used if no sensors can be found on the bus
+temp_sensor = "/sys/devices/w1_bus_master1/" + living_room_sensor + "/w1_slave"
+
+# Longest time (in seconds) to wait for a bus-wide conversion
+bulk_read_timeout = 2.0
 
-import netrc
-secrets = netrc.netrc()
+# How many times a bad reading is retried, and the first wait between tries
+# (in seconds), which doubles after each failure
+read_retries = 4
+read_backoff = 0.2
+# A DS18B20 reads exactly 85C until it has done its first conversion
+power_on_value = 85.0
+# The range the DS18B20 can actually measure
+valid_range = (-55.0, 125.0)
+# A jump bigger than this from the last good reading has to be seen twice
+max_step = 5.0
 
+# The last good reading from each sensor, used to spot spikes
+last_good = {}
 
-# Points to the DS18B20, where 28-...... is the serial number of the probe
-temp_sensor = "/sys/devices/w1_bus_master1/28-051686a14fff/w1_slave"
+# How long (in days) to keep raw readings, 1-minute and 1-hour rollups
+history_days = 7
+minute_rollup_days = 30
+hour_rollup_days = 730
+# Seconds between rolling up and pruning the history, in daemon mode
+maintain_interval = 300
+# Most rows removed from a table by one prune, so it never blocks for long
+prune_limit = 10000
 
 
 
-def temp_raw():
+def discover_sensors(base=None):
+    """Finds every DS18B20 on the one-wire bus.
+
+    base: string (defaults to w1_devices, which piheat_sim can point elsewhere)
+    return: dict
+                of the form {serial number(string): path to w1_slave(string)}
+    """
+    base = base or w1_devices
+    sensors = {}
+    for device in sorted(glob.glob(os.path.join(base, '28-*'))):
+        sensors[os.path.basename(device)] = os.path.join(device, 'w1_slave')
+    if not sensors:
+        logging.warning(("No sensors found in", base, "using", temp_sensor))
+        sensors[living_room_sensor] = temp_sensor
+    return sensors
+
+
+def bulk_convert(base=None):
+    """Starts a temperature conversion on every sensor at once.
+
+    Newer kernels provide 'therm_bulk_read' on each bus master.  Writing
+    'trigger' to it converts every sensor on the bus in parallel, so the
+    w1_slave files can then be read without waiting ~750ms for each one.
+
+    base: string
+    return: boolean
+                True if a bulk conversion was completed
+    """
+    base = base or w1_devices
+    masters = glob.glob(os.path.join(base, 'w1_bus_master*', 'therm_bulk_read'))
+    if not masters:
+        return False
+    try:
+        for master in masters:
+            with open(master, 'w') as f:
+                f.write('trigger\n')
+        deadline = time.time() + bulk_read_timeout
+        for master in masters:
+            # Reads -1 while the conversion is still in progress
+            while True:
+                with open(master) as f:
+                    status = f.read().strip()
+                if status != '-1' or time.time() > deadline:
+                    break
+                time.sleep(0.05)
+        return True
+    except (IOError, OSError):
+        logging.warning("Bulk conversion failed, reading sensors one by one")
+        return False
+
+
+def temp_raw(path=temp_sensor):
     """Reads the raw data from DS18B20
 
+    path: string (the sensor's w1_slave file)
     return: list
                 lines is a list of strings where each element of the list is a line
                 from the file being read
     """
-    f = open(temp_sensor, 'r')
+    f = open(path, 'r')
     lines = f.readlines()
     f.close()
     return lines
 
 
-def read_temp():
-    """Gets the raw data, finds the temperature and converts to celcius.
+def parse_temp(lines):
+    """Finds the temperature in the raw data and converts to celcius.
 
-    return: float
+    lines: list of strings (from temp_raw)
+    return: float (or None if the reading failed its CRC check, or is invalid)
     """
-    lines = temp_raw()
     # Check for a successful temperature reading, will return "YES" at end of reading,
-    while lines[0].strip()[-3:] != 'YES':
-        # if not successful, sleep for 0.2sec & repeat
-        time.sleep(0.2)
-        lines = temp_raw()
-
+    if (len(lines) < 2) or (lines[0].strip()[-3:] != 'YES'):
+        return None
     # Reads the temperature & processes into celcius
     temp_output = lines[1].find('t=')
-    if temp_output != -1:
-        temp_string = lines[1].strip()[temp_output+2:]
-        temp_c = float(temp_string) / 1000.0
+    if temp_output == -1:
+        return None
+    try:
+        temp_c = float(lines[1].strip()[temp_output+2:]) / 1000.0
+    except ValueError:
+        return None
+    if (temp_c == power_on_value) or not (valid_range[0] <= temp_c <= valid_range[1]):
+        return None
     return temp_c
 
 
-def update_mysql(temp_c):
-    """Updates a temperatue value in a MySQL database.
+def read_once(path, retries=read_retries):
+    """Takes one good reading from a sensor.
 
-    temp_c: float
-    return: boolean
+    Bad readings are retried up to 'retries' times, waiting twice as long
+    after each failure.  A reading that jumps more than max_step from the
+    last good one is only accepted if the next reading agrees with it.
+
+    path: string (the sensor's w1_slave file)
+    retries: int
+    return: tuple
+                (temperature(float), number of retries(int))
+    """
+    wait = read_backoff
+    spike = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(wait)
+            wait *= 2
+        try:
+            temp_c = parse_temp(temp_raw(path))
+        except (IOError, OSError):
+            temp_c = None
+        if temp_c is None:
+            continue
+        previous = last_good.get(path)
+        if (previous is None) or (abs(temp_c - previous) <= max_step):
+            last_good[path] = temp_c
+            return temp_c, attempt
+        if (spike is not None) and (abs(temp_c - spike) <= max_step):
+            # Seen twice, so it is a real change rather than a spike
+            last_good[path] = temp_c
+            return temp_c, attempt
+        logging.warning(("Rejecting spike from", path, temp_c))
+        spike = temp_c
+    raise RuntimeError("read_once:  No good reading from " + path + " after " + str(retries + 1) + " tries.")
+
+
+def read_sensor(path=temp_sensor, samples=1, retries=read_retries):
+    """Reads a sensor, returning the median of 'samples' good readings.
+
+    path: string (the sensor's w1_slave file)
+    samples: int
+    retries: int (for each reading)
+    return: tuple
+                (temperature(float), stats(dict))
+                where stats is of the form {'latency': seconds(float), 'retries': int}
+    """
+    start = time.time()
+    temps = []
+    total_retries = 0
+    for sample in range(samples):
+        temp_c, tries = read_once(path, retries)
+        temps.append(temp_c)
+        total_retries += tries
+    stats = {'latency': time.time() - start, 'retries': total_retries}
+    logging.debug(("Read", path, "in", round(stats['latency'], 3), "seconds with", total_retries, "retries"))
+    return statistics.median(temps), stats
+
+
+def read_temp(path=temp_sensor):
+    """Gets the raw data, finds the temperature and converts to celcius.
+
+    path: string (the sensor's w1_slave file)
+    return: float
+    """
+    return read_sensor(path)[0]
+
+
+def read_all(sensors, samples=1, retries=read_retries):
+    """Reads every sensor, concurrently.
+
+    If the bus can convert all its sensors at once that is used, otherwise
+    each sensor is read in its own thread, so that the conversion time
+    doesn't grow with the number of sensors.  A sensor that can't give a
+    good reading is left out, rather than holding up the others.
+
+    sensors: dict
+                of the form {serial number(string): path to w1_slave(string)}
+    samples: int (readings to take the median of, for each sensor)
+    retries: int
+    return: dict
+                of the form {serial number(string): temperature(float)}
+    """
+    def read(path):
+        try:
+            return read_sensor(path, samples, retries)[0]
+        except RuntimeError as error:
+            logging.error(error)
+            return None
+
+    if (len(sensors) == 1) or bulk_convert():
+        temps = [read(path) for path in sensors.values()]
+    else:
+        with ThreadPoolExecutor(max_workers=len(sensors)) as pool:
+            temps = list(pool.map(read, sensors.values()))
+    return dict((serial, temp_c) for serial, temp_c in zip(sensors.keys(), temps)
+                if temp_c is not None)
+
+
+def mysqldb():
+    """Imports MySQLdb the first time it is needed.
+
+    Only writing to the database needs it, so templog can read (and push)
+    temperatures, or be imported by test_sim.py, on a box without it.
+
+    return: module
+    """
+    return importlib.import_module('MySQLdb')
+
+
+def connect_mysql():
+    """Opens a connection to the MySQL database.
+
+    return: MySQLdb connection
     """
     # Read from .netrc
-    login, account, password = secrets.authenticators('mysql')
+    login, account, password = credentials.get_secrets('mysql')
+    logging.debug("Connecting to MySQL database")
+    return mysqldb().connect(db="site_db", host=account)
+
+
+def update_mysql(readings, rooms, db=None):
+    """Updates the temperature values in a MySQL database.
+
+    All the rooms are written with one multi-row statement, and the living
+    room temperature is also written to 'temp_log', in a single transaction.
+
+    readings: dict
+                of the form {serial number(string): temperature(float)}
+    rooms: dict
+                of the form {serial number(string): room name(string)}
+    db: MySQLdb connection (optional)
+            an open connection to reuse, if not given a new connection is
+            opened and closed again afterwards
+    return: boolean
+    """
+    own_db = db is None
+    cursor = None
     try:
-        logging.debug("Connecting to MySQL database")
-        db = MySQLdb.connect(db="site_db", host=account)
+        if own_db:
+            db = connect_mysql()
 
         logging.debug("Setup cursor")
         cursor = db.cursor()
 
-        logging.debug("Update temperature")
-        cursor.execute("UPDATE temp_log SET livtemp=(%s)",(temp_c,))
+        logging.debug("Update temperatures")
+        names = room_names(readings, rooms)
+        rows = [(serial, names[serial], temp_c)
+                for serial, temp_c in sorted(readings.items())]
+        # MySQLdb sends this as a single INSERT with one VALUES list per room
+        cursor.executemany("INSERT INTO room_temp (sensor, room, temp) VALUES (%s, %s, %s) "
+                           "ON DUPLICATE KEY UPDATE room=VALUES(room), temp=VALUES(temp)", rows)
+        cursor.executemany("INSERT IGNORE INTO temp_history (sensor, temp) VALUES (%s, %s)",
+                           [(serial, temp_c) for serial, room, temp_c in rows])
+        livtemp = living_room_temp(readings)
+        if livtemp is not None:
+            cursor.execute("UPDATE temp_log SET livtemp=(%s)",(livtemp,))
         db.commit()
         return True
-    except:
+    except mysqldb().Error:
+        if db is not None:
+            try:
+                db.rollback()
+            except mysqldb().Error:
+                pass
+        return False
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if own_db and (db is not None):
+            db.close()
+
+
+def maintain_history(db):
+    """Rolls up recent history into 1-minute and 1-hour aggregates, and prunes.
+
+    Only the last hour or two of raw readings is rolled up each time (the
+    buckets are recalculated, so running this often is harmless), and each
+    prune removes at most prune_limit rows, so the work stays small however
+    long the history gets.
+
+    db: MySQLdb connection
+    return: boolean
+    """
+    rollups = (('minute', "'%%Y-%%m-%%d %%H:%%i:00'"),
+               ('hour',   "'%%Y-%%m-%%d %%H:00:00'"))
+    cursor = db.cursor()
+    try:
+        for period, bucket_format in rollups:
+            cursor.execute("INSERT INTO temp_rollup (sensor, period, bucket, min_temp, max_temp, avg_temp, samples) "
+                           "SELECT sensor, %s, DATE_FORMAT(date, " + bucket_format + ") AS bucket, "
+                           "MIN(temp), MAX(temp), AVG(temp), COUNT(*) FROM temp_history "
+                           "WHERE date >= DATE_FORMAT(NOW() - INTERVAL 1 HOUR, '%%Y-%%m-%%d %%H:00:00') "
+                           "GROUP BY sensor, bucket "
+                           "ON DUPLICATE KEY UPDATE min_temp=VALUES(min_temp), max_temp=VALUES(max_temp), "
+                           "avg_temp=VALUES(avg_temp), samples=VALUES(samples)", (period,))
+        cursor.execute("DELETE FROM temp_history WHERE date < NOW() - INTERVAL %s DAY LIMIT %s",
+                       (history_days, prune_limit))
+        cursor.execute("DELETE FROM temp_rollup WHERE period='minute' AND bucket < NOW() - INTERVAL %s DAY LIMIT %s",
+                       (minute_rollup_days, prune_limit))
+        cursor.execute("DELETE FROM temp_rollup WHERE period='hour' AND bucket < NOW() - INTERVAL %s DAY LIMIT %s",
+                       (hour_rollup_days, prune_limit))
+        db.commit()
+        return True
+    except mysqldb().Error as error:
+        logging.error(("Error - Could not maintain temperature history", error))
         db.rollback()
         return False
     finally:
         cursor.close()
+
+
+def living_room_temp(readings):
+    """Picks out the living room reading, for 'temp_log'.
+
+    If there is only one sensor it is assumed to be in the living room.
+
+    readings: dict
+    return: float (or None if there is no living room sensor)
+    """
+    if living_room_sensor in readings:
+        return readings[living_room_sensor]
+    if len(readings) == 1:
+        return list(readings.values())[0]
+    return None
+
+
+def room_names(readings, rooms):
+    """Names the room each reading is from, as written to the database and pushed to piheat.
+
+    Like living_room_temp, a lone sensor is taken to be in the living room
+    unless it has been given another name.
+
+    readings: dict
+    rooms: dict
+    return: dict
+                of the form {serial number(string): room name(string)}
+    """
+    names = dict((serial, rooms.get(serial, serial)) for serial in readings)
+    if (len(readings) == 1) and (living_room_sensor not in readings):
+        serial = list(readings)[0]
+        if serial not in rooms:
+            names[serial] = 'living'
+    return names
+
+
+def has_changed(readings, last_readings, threshold):
+    """Checks whether any sensor has moved by more than threshold.
+
+    readings: dict
+    last_readings: dict
+    threshold: float
+    return: boolean
+    """
+    for serial, temp_c in readings.items():
+        if (serial not in last_readings) or (abs(temp_c - last_readings[serial]) > threshold):
+            return True
+    return False
+
+
+def push_readings(readings, rooms, address):
+    """Sends a set of readings straight to piheat, as one UDP datagram.
+
+    Nothing waits for an answer, so this never holds up the readings, and
+    if piheat isn't listening it simply carries on reading the database.
+
+    readings: dict
+                of the form {serial number(string): temperature(float)}
+    rooms: dict
+    address: tuple
+                of the form (host(string), port(int))
+    return: boolean
+                True if the datagram was sent
+    """
+    names = room_names(readings, rooms)
+    message = {'time': time.time(),
+               'rooms': dict((names[serial], temp_c) for serial, temp_c in readings.items())}
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(json.dumps(message).encode('utf-8'), address)
+        finally:
+            sock.close()
+        return True
+    except OSError as error:
+        logging.error(("Error - Could not push the readings to", address, error))
+        return False
+
+
+def run_daemon(sensors, rooms, interval, threshold, max_age, stop, samples=1, push=None):
+    """Keeps sampling the temperatures until stop is set.
+
+    One database connection is kept open for as long as it works.  A set of
+    readings is only written if a sensor has moved by more than threshold
+    since the last values written, or if nothing has been written for
+    max_age seconds.
+
+    sensors: dict
+    rooms: dict
+    interval: int or float (seconds between readings)
+    threshold: float (degrees celcius)
+    max_age: int or float (seconds)
+    stop: threading.Event
+    samples: int (readings to take the median of, for each sensor)
+    push: tuple (optional)
+                the (host, port) piheat listens on, sent every set of readings
+    """
+    db = None
+    last_readings = {}
+    last_write = 0
+    last_maintained = 0
+    while not stop.is_set():
+        start = time.time()
+        readings = read_all(sensors, samples)
+        logging.debug(("Temperatures are", readings), extra={'timings': {'read': time.time() - start}})
+        if not readings:
+            stop.wait(interval)
+            continue
+        if push:
+            push_readings(readings, rooms, push)
+        changed = has_changed(readings, last_readings, threshold)
+        if changed or ((time.time() - last_write) >= max_age):
+            if db is None:
+                try:
+                    db = connect_mysql()
+                except mysqldb().Error:
+                    logging.error("Error - Could not connect to database")
+            if (db is not None) and update_mysql(readings, rooms, db):
+                last_readings = readings
+                last_write = time.time()
+                if (last_write - last_maintained) >= maintain_interval:
+                    maintain_history(db)
+                    last_maintained = last_write
+            else:
+                logging.error("Error - Database could not be updated")
+                # Start again with a fresh connection next time
+                if db is not None:
+                    try:
+                        db.close()
+                    except mysqldb().Error:
+                        pass
+                db = None
+        stop.wait(interval)
+    if db is not None:
         db.close()
 
 
+def get_args():
+    """Reads the command line options.
+
+    return: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Log the temperature from a DS18B20 to MySQL.")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running instead of taking a single reading")
+    parser.add_argument('--interval', type=float, default=60,
+                        help="seconds between readings in daemon mode (default: 60)")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="only write when the temperature changes by more than this (default: 0.1)")
+    parser.add_argument('--max-age', type=float, default=900,
+                        help="write at least this often in seconds, even if unchanged (default: 900)")
+    parser.add_argument('--samples', type=int, default=1,
+                        help="take the median of this many readings from each sensor (default: 1)")
+    parser.add_argument('--room', action='append', default=[], metavar='SERIAL=NAME',
+                        help="name the room a sensor is in, e.g. 28-051686a14fff=living")
+    parser.add_argument('--push', default=None, metavar='HOST:PORT',
+                        help="also send every reading straight to piheat, listening on HOST:PORT")
+    return parser.parse_args()
+
+
+def get_push_address(push_arg):
+    """Turns the --push option into an address.
+
+    push_arg: string (of the form 'host:port', or None)
+    return: tuple (or None if not pushing)
+                of the form (host(string), port(int))
+    """
+    if not push_arg:
+        return None
+    host, sep, port = push_arg.rpartition(':')
+    if not (sep and host and port.isdigit()):
+        raise SystemExit("--push must be of the form HOST:PORT")
+    return host, int(port)
+
+
+def get_rooms(room_args):
+    """Turns the --room options into a dictionary.
+
+    room_args: list of strings (of the form 'serial=name')
+    return: dict
+                of the form {serial number(string): room name(string)}
+    """
+    rooms = {living_room_sensor: 'living'}
+    for room in room_args:
+        serial, sep, name = room.partition('=')
+        if not sep:
+            raise SystemExit("--room must be of the form SERIAL=NAME")
+        rooms[serial.strip()] = name.strip()
+    return rooms
+
+
+def setup_logging():
+    """Logs to the file set by 'templog_file' in the [logging] section of the config file."""
+    config = configparser.ConfigParser()
+    config.read_dict({'logging': piheat_log.DEFAULTS})
+    config.read(CONFIG_FILE)
+    piheat_log.setup('templog', config)
+
+
 def main():
     """Gets a temperature reading and updates a database."""
-    temp_c = read_temp()
-    logging.debug(("Living room temperature is", temp_c))
+    args = get_args()
+    setup_logging()
+    rooms = get_rooms(args.room)
+    push = get_push_address(args.push)
+    sensors = discover_sensors()
+    logging.debug(("Found sensors", list(sensors.keys())))
+    if args.daemon:
+        stop = threading.Event()
+        # Let systemd stop the daemon cleanly
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        logging.info("Starting templog daemon")
+        try:
+            run_daemon(sensors, rooms, args.interval, args.threshold, args.max_age, stop, args.samples, push)
+        except KeyboardInterrupt:
+            pass
+        logging.info("templog daemon stopped")
+        logging.shutdown()
+        return
+
+    readings = read_all(sensors, args.samples)
+    logging.debug(("Temperatures are", readings))
+    if not readings:
+        logging.error("Error - No good readings from any sensor")
+        logging.shutdown()
+        return
+    if push:
+        push_readings(readings, rooms, push)
 
-    success = update_mysql(temp_c)
+    try:
+        db = connect_mysql()
+    except mysqldb().Error:
+        logging.error("Error - Could not connect to database")
+        logging.shutdown()
+        return
+    success = update_mysql(readings, rooms, db)
     if success:
         logging.debug("Database was updated successfully")
+        maintain_history(db)
     else:
         logging.error("Error - Database could not be updated")
+    db.close()
     logging.shutdown()
 
 
 # Only run the main function when not under test
 if __name__ == "__main__":
     main()
-    
@@ -2,6 +2,7 @@
 
 # Import the file being tested
 from piheat import *
+GPIO = init_gpio()
 
 
 
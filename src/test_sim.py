@@ -0,0 +1,1264 @@
+#!/usr/bin/env python
+
+"""Tests the whole command path against the stand-ins in piheat_sim.py.
+
+Needs no Raspberry Pi, Gmail account, MySQL server or sensors, so can be
+run on any Linux box:
+
+    python test_sim.py
+"""
+import os
+import time
+import json
+import netrc
+import random
+import tempfile
+import threading
+
+# Must be set before piheat is imported, so it never touches the real GPIO
+os.environ['PIHEAT_SIMULATE'] = 'yes'
+
+# Import the files being tested
+from piheat import *
+import piheat
+import piheat_sim
+import piheat_log
+import credentials
+GPIO = init_gpio()
+
+
+# Remove the handlers set in piheat.py so that output from the test suite can be logged in a different file.
+log = logging.getLogger()
+for hdlr in log.handlers[:]:  # remove all old handlers
+    log.removeHandler(hdlr)
+
+# Set the logging level to 'DEBUG' so that ALL messages are sent to the log file.
+log.setLevel(logging.DEBUG)
+
+#  'w' denotes that the log will be overwritten each time the tests are run
+logfile = logging.FileHandler(os.path.join(tempfile.gettempdir(), 'test_sim.log'), 'w')
+log.addHandler(logfile)
+
+# The relays can be switched as fast as the tests like
+relays.min_dwell = 0
+
+
+# Define a dictionary for storing the results from each test.
+# This is stored as {'test name':test result}, where test result is a boolean, True == 'passed', False == 'failed'
+test_results = {}
+
+
+def setup_sim():
+    """Empties the simulated mailbox, and sets everything back to off.
+
+    return: tuple
+                of the form (Gmail (logged in), StateStore)
+    """
+    piheat_sim.imap_server.reset()
+    if os.path.exists(UID_STATE_FILE):
+        os.remove(UID_STATE_FILE)
+    Pio().st699_on()
+    my_db = DBase()
+    my_db.my_login()
+    piheat_sim.set_room_temp(my_db, 18.0)
+    pi_state = StateStore(DBase('sqlite'))
+    pi_state.load()
+    for function in ('st699', 'CH', 'HW'):
+        pi_state[function] = 'off'
+    pi_state.set_target_temp(20.0)
+    pi_state.commit()
+    piheat = Gmail()
+    piheat.login(my_db)
+    return piheat, pi_state
+
+
+def send(piheat, pi_state, subject):
+    """Emails a command to the simulated mailbox, and has piheat act on it.
+
+    piheat: Gmail
+    subject: string
+    return: StateStore
+    """
+    if piheat.get_mail_state() == 'AUTH':
+        # Select the mailbox first, as piheat only acts on mail that arrives after that
+        pi_state = piheat.read_folder('piheat', 'AUTH', pi_state, idle_timeout=0)
+    piheat_sim.imap_server.deliver(subject)
+    return piheat.read_folder('piheat', 'SELECTED', pi_state, idle_timeout=1)
+
+
+def test_sim_relays():
+    """Checks the relays are set as in the table at the top of piheat.py.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_relays'")
+    ctrl_pio = Pio()
+    ctrl_pio.st699_on()
+    expected = {(False, False): (0, 0, 0),
+                (True, False): (0, 1, 0),
+                (False, True): (1, 0, 1),
+                (True, True): (0, 1, 1)}
+    test_passes = 0
+    for (hw, ch), outputs in expected.items():
+        ctrl_pio.set_outputs(hw, ch)
+        if tuple(GPIO.input(pin) for pin in (DHW_OFF, DHW_ON, CH_ON)) == outputs:
+            test_passes += 1
+    # Setting the same outputs again shouldn't touch the GPIO
+    changes = len(GPIO.history)
+    ctrl_pio.set_outputs(True, True)
+    if len(GPIO.history) == changes:
+        test_passes += 1
+    ctrl_pio.st699_on()
+    logging.debug(("sim_relays passed", test_passes, "of", len(expected) + 1, "sub-tests"))
+    return test_passes == len(expected) + 1
+
+
+def test_sim_command_path():
+    """Emails each command to the simulated mailbox and checks the relays and state.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_command_path'")
+    piheat, pi_state = setup_sim()
+    test_passes = 0
+    sub_tests = 4
+
+    pi_state = send(piheat, pi_state, 'HWon')
+    if GPIO.input(DHW_ON) and (pi_state['HW'] == 'on'):
+        test_passes += 1
+
+    # 18C in the living room, so a target of 21C turns the heating on
+    pi_state = send(piheat, pi_state, 'CH = 21')
+    if GPIO.input(CH_ON) and (pi_state.target_temp == 21.0):
+        test_passes += 1
+
+    pi_state = send(piheat, pi_state, 'HWoff')
+    if (not GPIO.input(DHW_ON)) and GPIO.input(DHW_OFF) and (pi_state['HW'] == 'off'):
+        test_passes += 1
+
+    # The state was written to the database, not just kept in memory
+    saved = StateStore(DBase('sqlite'))
+    saved.load()
+    if (saved['HW'] == 'off') and (saved['CH'] == 'on') and (saved.target_temp == 21.0):
+        test_passes += 1
+
+    piheat.logout()
+    Pio().st699_on()
+    logging.debug(("sim_command_path passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_sim_command_queue():
+    """Sends several commands at once, and checks they are applied as one batch.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_command_queue'")
+    piheat, pi_state = setup_sim()
+    pi_state = piheat.read_folder('piheat', 'AUTH', pi_state, idle_timeout=0)
+    test_passes = 0
+    sub_tests = 4
+
+    # Two calendar events at 06:30, and two older ones which arrive late
+    now = time.time()
+    hw_on = piheat_sim.imap_server.deliver('Notification: HWon @ Mon 6 Jan 2020 06:30', now)
+    ch_on = piheat_sim.imap_server.deliver('Notification: CH = 21 @ Mon 6 Jan 2020 06:30', now)
+    piheat_sim.imap_server.deliver('Notification: CHoff @ Mon 6 Jan 2020 06:00', now - 1800)
+    piheat_sim.imap_server.deliver('Notification: HWoff @ Mon 6 Jan 2020 05:30', now - 3600)
+    changes = len(GPIO.history)
+    pi_state = piheat.read_folder('piheat', 'SELECTED', pi_state, idle_timeout=1)
+
+    if (pi_state['HW'] == 'on') and (pi_state['CH'] == 'on') and (pi_state.target_temp == 21.0):
+        test_passes += 1
+    if (GPIO.input(DHW_ON), GPIO.input(CH_ON), GPIO.input(DHW_OFF)) == (1, 1, 0):
+        test_passes += 1
+    # Each relay was switched straight to where it ended up
+    if sorted(pin for when, pin, value in GPIO.history[changes:]) == sorted([DHW_ON, CH_ON]):
+        test_passes += 1
+    # Only the commands that were applied are left in the mailbox
+    if sorted(piheat_sim.imap_server.messages) == [hw_on, ch_on]:
+        test_passes += 1
+
+    piheat.logout()
+    Pio().st699_on()
+    logging.debug(("sim_command_queue passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_sim_reconnect():
+    """Checks a dropped Gmail session is reconnected, with a backoff, and no command is missed.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_reconnect'")
+    test_passes = 0
+    sub_tests = 5
+    piheat, pi_state = setup_sim()
+    supervisor = MailSupervisor(piheat, piheat.piheat_db, min_delay=2, max_delay=30)
+    # The wait doubles with each failure up to the most, less up to half at random
+    delays_ok = True
+    for failures in range(1, 10):
+        supervisor.failures = failures
+        most = min(30, 2 * 2 ** (failures - 1))
+        delays = [supervisor.backoff() for i in range(20)]
+        if not all(most / 2.0 <= delay <= most for delay in delays) or (len(set(delays)) < 2):
+            delays_ok = False
+    supervisor.failures = 0
+    if delays_ok:
+        test_passes += 1
+
+    # Logging in at startup isn't counted as a reconnect
+    supervisor.reconnect()
+    if supervisor.connected() and (supervisor.stats()['reconnects'] == 0):
+        test_passes += 1
+
+    # A command sent while the connection is down is acted on once it is back
+    piheat_sim.imap_server.drop_connections()
+    piheat_sim.imap_server.deliver('HWon')
+    try:
+        pi_state = piheat.read_folder('piheat', 'SELECTED', pi_state, idle_timeout=1)
+        delay = None
+    except ConnectionError as error:
+        delay = supervisor.failed(error)
+    if (delay is not None) and (delay <= 2) and not supervisor.connected():
+        supervisor.reconnect()
+        pi_state = piheat.read_folder('piheat', 'SELECTED', pi_state, idle_timeout=0)
+        supervisor.succeeded()
+        stats = supervisor.stats()
+        if (pi_state['HW'] == 'on') and GPIO.input(DHW_ON) and (stats['reconnects'] == 1) \
+                and (stats['downtime'] >= 0) and stats['connected'] and (supervisor.failures == 0):
+            test_passes += 1
+
+    # The runtime's mail task does the same by itself, and keeps going
+    Pio().st699_off()
+    runtime = Runtime(piheat, piheat.piheat_db, pi_state, CheckNet(), idle_timeout=1)
+    runtime.supervisor.min_delay = 0.05
+
+    async def drop_once():
+        runtime.online = asyncio.Event()
+        runtime.kick = asyncio.Event()
+        runtime.online.set()
+        task = asyncio.ensure_future(runtime.watch_mail())
+        await asyncio.sleep(0.3)
+        piheat_sim.imap_server.drop_connections()
+        piheat_sim.imap_server.deliver('HWoff')
+        await asyncio.sleep(2)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    asyncio.run(drop_once())
+    if (runtime.pi_state['HW'] == 'off') and (runtime.supervisor.stats()['reconnects'] == 1):
+        test_passes += 1
+
+    # A read left waiting in IDLE when it timed out can't carry on with the new connection
+    piheat, pi_state = setup_sim()
+    pi_state = piheat.read_folder('piheat', 'AUTH', pi_state, idle_timeout=0)
+    supervisor = MailSupervisor(piheat, piheat.piheat_db, min_delay=0.01)
+    outcome = []
+
+    def abandoned():
+        try:
+            piheat.read_folder('piheat', 'SELECTED', pi_state, idle_timeout=30)
+            outcome.append('read')
+        except Exception as error:
+            outcome.append(error)
+    worker = threading.Thread(target=abandoned)
+    worker.start()
+    time.sleep(0.2)
+    supervisor.failed(TimeoutError("IDLE timed out"))
+    supervisor.reconnect()
+    worker.join(5)
+    uid = piheat_sim.imap_server.deliver('HWoff')
+    pi_state = piheat.read_folder('piheat', 'SELECTED', pi_state, idle_timeout=0)
+    if outcome and isinstance(outcome[0], RuntimeError) and (not worker.is_alive()) \
+            and (piheat.last_uid == uid) and (pi_state['HW'] == 'off'):
+        test_passes += 1
+
+    piheat.logout()
+    Pio().st699_on()
+    logging.debug(("sim_reconnect passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_sim_mail_blocking():
+    """Checks logging out of a failed Gmail connection, or ending IDLE, doesn't hold up the other tasks.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_mail_blocking'")
+    test_passes = 0
+    sub_tests = 2
+
+    class HungMail(object):
+        """A Gmail session that is slow to log out of, or to answer a NOOP ending IDLE."""
+        def __init__(self):
+            self.fail = True
+            self.idle = threading.Event()
+            self.drops = 0
+            self.noops = 0
+        def get_mail_state(self):
+            return 'SELECTED'
+        def read_folder(self, mailbox, state, pi_state, idle_timeout):
+            if self.fail:
+                time.sleep(0.05)
+                raise ConnectionError("connection reset")
+            self.idle.wait(5)
+            return pi_state
+        def drop(self):
+            self.drops += 1
+            time.sleep(0.3)
+        def noop(self):
+            self.noops += 1
+            time.sleep(0.5)
+            self.idle.set()
+
+    class UpNet(object):
+        """A connection check that never fails."""
+        def invalidate(self):
+            pass
+
+    Pio().st699_off()
+    mail = HungMail()
+    runtime = Runtime(mail, None, None, UpNet())
+    runtime.supervisor.min_delay = 0.01
+    runtime.supervisor.max_delay = 0.01
+
+    async def failing(seconds):
+        runtime.online = asyncio.Event()
+        runtime.kick = asyncio.Event()
+        runtime.online.set()
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.time())
+                await asyncio.sleep(0.01)
+        tasks = [asyncio.ensure_future(runtime.watch_mail()), asyncio.ensure_future(tick())]
+        await asyncio.sleep(seconds)
+        cancelled = time.time()
+        while not all(task.done() for task in tasks):
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks, timeout=0.1)
+        return max(later - earlier for earlier, later in zip(ticks, ticks[1:])), time.time() - cancelled
+
+    # Reads that keep failing, each followed by a slow logout
+    longest_wait, stopping = asyncio.run(failing(1.0))
+    if (mail.drops >= 2) and (longest_wait < 0.15):
+        test_passes += 1
+    # Stopped while in IDLE, the NOOP that ends it is left to finish by itself
+    mail.fail = False
+    mail.idle.clear()
+    noops = mail.noops
+    longest_wait, stopping = asyncio.run(failing(0.3))
+    if (mail.noops == noops + 1) and (stopping < 0.15):
+        test_passes += 1
+    Pio().st699_on()
+    logging.debug(("sim_mail_blocking passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_sim_thermostat():
+    """Drives the thermostat through a series of room temperatures, checking the hysteresis and minimum on and off times.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_thermostat'")
+    test_passes = 0
+    sub_tests = 5
+    Pio().st699_off()
+    Pio().ch_relay(False)
+    pi_state = {'CH': 'on', 'st699': 'off'}
+    # Rises of less than WARMUP_MIN_RISE, so the warm-up model isn't taught anything
+    thermostat = Thermostat(pi_state, hysteresis=0.3, min_on=0, min_off=0)
+
+    # On once the room is 'hysteresis' below the target, off again once it gets there
+    relay = []
+    for livtemp in (19.8, 19.6, 19.9, 20.0):
+        thermostat.tick(livtemp, 20.0)
+        relay.append(GPIO.input(CH_ON))
+    if (relay == [0, 1, 1, 0]) and (thermostat.switch_count == 2):
+        test_passes += 1
+
+    # Held off for min_off, then switched on
+    thermostat.min_off = 300
+    thermostat.tick(19.6, 20.0)
+    held = GPIO.input(CH_ON)
+    thermostat.last_switch -= 300
+    thermostat.tick(19.6, 20.0)
+    if (not held) and GPIO.input(CH_ON) and (thermostat.switch_count == 3):
+        test_passes += 1
+
+    # Held on for min_on
+    thermostat.min_on = 300
+    thermostat.tick(20.5, 20.0)
+    if GPIO.input(CH_ON) and (thermostat.switch_count == 3):
+        test_passes += 1
+
+    # Switched off by a command, so held off from then
+    Pio().ch_relay(False)
+    thermostat.tick(19.0, 20.0)
+    if (not GPIO.input(CH_ON)) and (thermostat.switch_count == 3):
+        test_passes += 1
+
+    # Found on at the first tick, as just switched on by a command
+    Pio().ch_relay(True)
+    thermostat = Thermostat(pi_state, hysteresis=0.3, min_on=300, min_off=300)
+    thermostat.tick(21.0, 20.0)
+    if GPIO.input(CH_ON) and (thermostat.switch_count == 0):
+        test_passes += 1
+    Pio().ch_relay(False)
+    logging.debug(("sim_thermostat passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_sim_command_target():
+    """Checks the thermostat judges a command against its new target, not the one last polled.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_command_target'")
+    Pio().st699_off()
+    pi_state = StateStore(DBase('sqlite'))
+    pi_state.load()
+    pi_state['st699'] = 'off'
+    pi_state['CH'] = 'on'
+    pi_state.set_target_temp(22.0)
+    runtime = Runtime(Gmail(), None, pi_state, None)
+    # Polled before 'CH = 22' came in, with the room at 21 and the old target 20
+    runtime.temps = (21.0, 20.0)
+    # Without the minimum on time, which would hide a wrong decision
+    runtime.thermostat.min_on = 0
+    runtime.thermostat.heating = False
+    Pio().ch_on(21.0, 22.0)
+
+    async def kicked():
+        runtime.kick = asyncio.Event()
+        task = asyncio.ensure_future(runtime.control_heating())
+        runtime.kick.set()
+        await asyncio.sleep(0.3)
+        while not task.done():
+            task.cancel()
+            await asyncio.wait([task], timeout=0.1)
+    asyncio.run(kicked())
+    passed = bool(GPIO.input(CH_ON)) and (runtime.thermostat.switch_count == 0)
+    Pio().ch_off()
+    logging.debug(("sim_command_target passed", int(passed), "of", 1, "sub-tests"))
+    return passed
+
+
+def test_hub_reset():
+    """Checks the hub is only reset after a long outage, at most once an interval, without blocking the other tasks.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_hub_reset'")
+    test_passes = 0
+    sub_tests = 2
+
+    class DownNet(object):
+        """A connection check that always fails."""
+        ttl = 0.01
+        fail_ttl = 0.01
+        def test(self):
+            return False
+        def invalidate(self):
+            pass
+
+    resets = []
+
+    def slow_reset():
+        time.sleep(0.2)
+        resets.append(time.time())
+
+    saved = (piheat.reset_hub, piheat.HUB_RESET_AFTER, piheat.HUB_RESET_INTERVAL)
+    piheat.reset_hub = slow_reset
+    runtime = Runtime(Gmail(), None, None, DownNet())
+
+    async def outage(seconds):
+        runtime.online = asyncio.Event()
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.time())
+                await asyncio.sleep(0.01)
+        tasks = [asyncio.ensure_future(runtime.monitor_network()), asyncio.ensure_future(tick())]
+        await asyncio.sleep(seconds)
+        # Until they stop, as wait_for can swallow a cancel that lands just as its call finishes
+        while not all(task.done() for task in tasks):
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks, timeout=0.1)
+        return max(later - earlier for earlier, later in zip(ticks, ticks[1:]))
+
+    # A short outage doesn't reset the hub at all
+    piheat.HUB_RESET_AFTER = 60
+    asyncio.run(outage(0.3))
+    if not resets:
+        test_passes += 1
+    # A long one resets it once, while the other tasks carry on
+    piheat.HUB_RESET_AFTER = 0
+    piheat.HUB_RESET_INTERVAL = 60
+    longest_wait = asyncio.run(outage(1.0))
+    if (len(resets) == 1) and (longest_wait < 0.15):
+        test_passes += 1
+
+    piheat.reset_hub, piheat.HUB_RESET_AFTER, piheat.HUB_RESET_INTERVAL = saved
+    logging.debug(("hub_reset passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_warmup():
+    """Checks the warm-up model learns a heating rate, and a pre-heat starts early enough.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_warmup'")
+    test_passes = 0
+    sub_tests = 6
+    if os.path.exists(WARMUP_STATE_FILE):
+        os.remove(WARMUP_STATE_FILE)
+    model = WarmupModel(WARMUP_STATE_FILE)
+    # A house with 10 minutes of dead time, then 20 minutes per degree
+    rng = random.Random(22)
+    for i in range(60):
+        degrees = rng.uniform(0.5, 4.0)
+        model.learn(degrees, 600 + 1200 * degrees + rng.uniform(-60, 60))
+    if abs(model.predict(2.0) - 3000) < 150:
+        test_passes += 1
+    # The sums were saved, and are read back by a new model
+    if abs(WarmupModel(WARMUP_STATE_FILE).predict(2.0) - model.predict(2.0)) < 1e-6:
+        test_passes += 1
+
+    # 'CH = 21' for two hours time is held back...
+    at = datetime.datetime.now() + datetime.timedelta(hours=2)
+    piheat, pi_state = setup_sim()
+    pi_state = piheat.read_folder('piheat', 'AUTH', pi_state, idle_timeout=0)
+    pi_state = send(piheat, pi_state, 'Notification: CH = 21 @ ' + at.strftime('%a %d %b %Y %H:%M'))
+    if (pi_state['CH'] == 'off') and (not GPIO.input(CH_ON)) and (piheat.preheat is not None):
+        test_passes += 1
+    # ...and still held back after a restart, though its email has been read
+    restarted = Gmail()
+    restarted.login(DBase())
+    restarted.read_folder('piheat', 'AUTH', pi_state, idle_timeout=0)
+    if (restarted.preheat is not None) and (restarted.preheat == piheat.preheat):
+        test_passes += 1
+    restarted.logout()
+    # ...until the room is cold enough to need more than two hours to warm up
+    saved = warmup.sums
+    warmup.sums = model.sums
+    due_warm = piheat.due_preheat(20.0, 20.0)
+    due_cold = piheat.due_preheat(14.0, 20.0)
+    warmup.sums = saved
+    if (not due_warm) and due_cold and (due_cold[0][1] == Command('CH', 'on', 21.0, None)):
+        learned = dict(schedule.entries)
+        pi_state = piheat.check_commands(due_cold, pi_state, False)
+        if (pi_state['CH'] == 'on') and GPIO.input(CH_ON) and (piheat.preheat is None):
+            test_passes += 1
+        # Learned at its event time when it was held back, not again at the time it started
+        if (schedule.entries == learned) and (('mail', 'CH', at.weekday(), at.strftime('%H:%M')) in learned):
+            test_passes += 1
+
+    piheat.logout()
+    Pio().st699_on()
+    logging.debug(("warmup passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+ICAL = """BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:weekday-hw@example.com
+DTSTART;TZID=Europe/London:20240101T063000
+RRULE:FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR;COUNT=7
+SUMMARY:HW
+ on
+END:VEVENT
+BEGIN:VEVENT
+UID:all-day@example.com
+DTSTART;VALUE=DATE:20240102
+SUMMARY:CHoff
+END:VEVENT
+BEGIN:VEVENT
+UID:party@example.com
+DTSTART:20240103T190000
+SUMMARY:Party
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def test_schedule():
+    """Checks the local schedule learns emailed commands, reads an iCalendar file, and runs while offline.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_schedule'")
+    test_passes = 0
+    sub_tests = 6
+    path = os.path.join(tempfile.gettempdir(), 'test_sim_schedule.json')
+    if os.path.exists(path):
+        os.remove(path)
+    local = Schedule(path)
+    monday = datetime.datetime(2024, 1, 1, 6, 0).timestamp()
+    # Entries come out in time order, and only once due
+    local.add(('test', 2), monday + 120, Command('CH', 'on', None, None), monday)
+    local.add(('test', 1), monday + 60, Command('HW', 'on', None, None), monday)
+    local.add(('test', 1), monday + 90, Command('HW', 'off', None, None), monday)
+    if (local.due(monday) == []) and (local.next_time() == monday + 90) \
+            and (local.due(monday + 120) == [Command('HW', 'off', None, None), Command('CH', 'on', None, None)]):
+        test_passes += 1
+
+    # An emailed command is expected again next week, and kept after a restart
+    local.learn(Command('CH', 'on', 21.0, datetime.datetime(2024, 1, 1, 7, 0)), monday)
+    week = 7 * 86400
+    if (Schedule(path).next_time() == monday + 3600) \
+            and (local.due(monday + 3600) == [Command('CH', 'on', 21.0, None)]) \
+            and (local.next_time() == monday + 3600 + week):
+        test_passes += 1
+    # Until none has come for SCHEDULE_KEEP_DAYS
+    for i in range(1, 5):
+        local.due(monday + 3600 + i * week)
+    if local.next_time() is None:
+        test_passes += 1
+
+    # Seven weekday mornings from an iCalendar file, of which five fall in the next week
+    ical = os.path.join(tempfile.gettempdir(), 'test_sim_schedule.ics')
+    with open(ical, 'w') as f:
+        f.write(ICAL)
+    added = local.import_ical(ical, 7, monday)
+    first = datetime.datetime.fromtimestamp(local.next_time())
+    if (added == 5) and (first == datetime.datetime(2024, 1, 1, 6, 30)):
+        test_passes += 1
+
+    def run_offline(runtime, command):
+        """Runs the schedule task briefly, with the one entry due and no internet."""
+        # Only the one entry, whatever the other tests have emailed
+        schedule.entries.clear()
+        del schedule.heap[:]
+        schedule.add(('test', 'offline'), time.time() - 1, command, time.time())
+
+        async def run_once():
+            runtime.online = asyncio.Event()
+            runtime.kick = asyncio.Event()
+            task = asyncio.ensure_future(runtime.run_schedule())
+            await asyncio.sleep(0.5)
+            task.cancel()
+        asyncio.run(run_once())
+        return runtime.pi_state
+
+    # With the mail unreachable, the global schedule switches the relays itself
+    piheat, pi_state = setup_sim()
+    piheat.logout()
+    pi_state = run_offline(Runtime(piheat, None, pi_state, None), Command('HW', 'on', None, None))
+    if (pi_state['HW'] == 'on') and GPIO.input(DHW_ON):
+        test_passes += 1
+
+    # Even if there was no internet at startup, so Gmail was never logged in to (as main() does it)
+    Pio().st699_on()
+    my_db = DBase()
+    pi_state = StateStore(DBase('sqlite'))
+    pi_state.load()
+    pi_state['HW'] = 'off'
+    pi_state.commit()
+    piheat = Gmail(my_db)
+    pi_state = run_offline(Runtime(piheat, my_db, pi_state, None), Command('HW', 'on', None, None))
+    if (piheat.get_mail_state() == 'NONAUTH') and (pi_state['HW'] == 'on') and GPIO.input(DHW_ON):
+        test_passes += 1
+
+    Pio().st699_on()
+    logging.debug(("schedule passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_parse_command():
+    """Checks parse_command against real calendar subjects, then fuzzes and times it.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_parse_command'")
+    at = datetime.datetime(2020, 1, 6, 6, 30)
+    corpus = {'HWon': Command('HW', 'on', None, None),
+              'HWoff': Command('HW', 'off', None, None),
+              'CH on': Command('CH', 'on', None, None),
+              'CH=0': Command('CH', 'on', 0.0, None),
+              'st699off': Command('st699', 'off', None, None),
+              'Notification: HWon @ Mon 6 Jan 2020 06:30 - 07:30 (GMT)': Command('HW', 'on', None, at),
+              'Notification: CHoff @ Mon 6 Jan 2020 6:30am - 7:30am (GMT) (piheat@example.com)':
+                  Command('CH', 'off', None, at),
+              'Notification: CH = 21.5 @ Mon 6 Jan 2020 06:30 - 07:30 (GMT)': Command('CH', 'on', 21.5, at),
+              'Reminder: st699on @ Monday 6 January 2020 06:30': Command('st699', 'on', None, at),
+              # Not commands, although the old substring checks would have acted on them
+              'Notification: Monitor CHECKS @ Mon 6 Jan 2020 06:30': None,
+              'HW = 50': None,
+              'CHonly': None,
+              'Fwd: SCHool run': None,
+              '': None}
+    test_passes = 0
+    for subject, expected in corpus.items():
+        if parse_command(subject) == expected:
+            test_passes += 1
+        else:
+            logging.error(("parse_command", repr(subject), "gave", parse_command(subject)))
+
+    # Random subjects, built from pieces of real ones, must never raise
+    # or give a command that can't be applied
+    rng = random.Random(699)
+    pieces = ['CH', 'HW', 'st699', 'on', 'off', '=', ' = ', '21', '-3.5', '@', ' @ ', 'Mon', 'Notification:',
+              ' ', '6 Jan 2020', '06:30', '6:30pm', '(GMT)', 'x', '\u00e9', '99:99', '31 Feb 2020']
+    fuzzed = 0
+    for i in range(5000):
+        subject = ''.join(rng.choice(pieces) for j in range(rng.randint(0, 8)))
+        try:
+            command = parse_command(subject)
+        except Exception as error:
+            logging.error(("parse_command raised", error, "for", repr(subject)))
+            continue
+        if (command is None) or ((command.target in ('st699', 'CH', 'HW')) and
+                                 (command.action in ('on', 'off')) and
+                                 (command.setpoint is None or command.target == 'CH')):
+            fuzzed += 1
+    if fuzzed == 5000:
+        test_passes += 1
+
+    start = time.perf_counter()
+    for i in range(100):
+        for subject in corpus:
+            parse_command(subject)
+    per_subject = (time.perf_counter() - start) / (100 * len(corpus))
+    logging.info(("parse_command takes", round(per_subject * 1e6, 2), "microseconds per subject"))
+
+    logging.debug(("parse_command passed", test_passes, "of", len(corpus) + 1, "sub-tests"))
+    return test_passes == len(corpus) + 1
+
+
+def test_sim_livtemp():
+    """Checks the living room temperature is read back as templog wrote it.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_livtemp'")
+    my_db = DBase()
+    my_db.my_login()
+    piheat_sim.set_room_temp(my_db, 19.5)
+    livtemp = my_db.get_livtemp()
+    my_db.my_logout()
+    return livtemp == 19.5
+
+
+def test_sim_readings():
+    """Checks the latest and recent readings for a room, and that a missing reading is reported as None.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_readings'")
+    test_passes = 0
+    sub_tests = 4
+    my_db = DBase()
+    my_db.my_login()
+    piheat_sim.set_room_temp(my_db, 17.5, room='study', sensor='28-00000000aaaa')
+    reading = my_db.latest_reading('study')
+    if (reading is not None) and (reading[0] == 17.5):
+        test_passes += 1
+    recent = my_db.recent_readings(10, 'study')
+    if [temp_c for date, temp_c in recent] == [17.5]:
+        test_passes += 1
+
+    # A room no sensor is in
+    if (my_db.latest_reading('cellar') is None) and (my_db.recent_readings(10, 'cellar') == []):
+        test_passes += 1
+
+    # Nothing recorded for the living room, not even in temp_log
+    my_db.execute("DELETE FROM room_temp")
+    my_db.execute("DELETE FROM temp_history")
+    my_db.execute("DELETE FROM temp_log")
+    try:
+        if (my_db.get_livtemp() is None) and (Pio().ch_on(None, 20) is False) and not GPIO.input(CH_ON):
+            test_passes += 1
+    finally:
+        my_db.rollback()
+        my_db.execute("DELETE FROM room_temp WHERE room = %s", ('study',))
+        my_db.commit()
+        my_db.my_logout()
+    logging.debug(("sim_readings passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_sim_db_reads():
+    """Checks a session that only reads ends each transaction, so it doesn't keep seeing old data.
+
+    MySQL would show such a session the temperatures as they were at its
+    first SELECT, which SQLite can't reproduce, so the rollbacks are counted.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_db_reads'")
+    test_passes = 0
+    sub_tests = 3
+
+    class CountingConnection(object):
+        """Passes everything on to a real connection, counting the rollbacks."""
+        def __init__(self, db):
+            self.db = db
+            self.rollbacks = 0
+        def rollback(self):
+            self.rollbacks += 1
+            self.db.rollback()
+        def __getattr__(self, name):
+            return getattr(self.db, name)
+
+    session = DBase('sqlite')
+    session.pool = DBPool(session.backend)
+    session.my_login()
+    session.db = db = CountingConnection(session.db)
+    session.get_livtemp()
+    session.my_query("SELECT temp FROM target_temp")
+    if db.rollbacks >= 2:
+        test_passes += 1
+
+    # Not while a change is waiting to be committed
+    before = db.rollbacks
+    session.execute("UPDATE target_temp SET temp=temp")
+    session.my_query("SELECT temp FROM target_temp")
+    if (db.rollbacks == before) and session.pending:
+        test_passes += 1
+    session.commit()
+
+    # Or left open when the connection goes back to the pool
+    before = db.rollbacks
+    session.my_logout()
+    if db.rollbacks == before + 1:
+        test_passes += 1
+    session.pool.close_all()
+    logging.debug(("sim_db_reads passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_sim_db_errors():
+    """Checks a lost or unreachable database raises the backend's own error, and never commits half a transaction.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_db_errors'")
+    test_passes = 0
+    sub_tests = 4
+
+    class DroppedCursor(object):
+        """Fails like a cursor on a connection the server has closed."""
+        def __init__(self, backend):
+            self.backend = backend
+        def execute(self, *args):
+            raise self.backend.OperationalError("server has gone away")
+
+    # A database that can't be opened gives backend.Error, which StateStore handles
+    session = DBase('sqlite')
+    session.pool = DBPool(SQLiteBackend('/proc/piheat/piheat.db'))
+    session.backend = session.pool.backend
+    try:
+        session.execute("SELECT 1")
+        raised = None
+    except session.backend.Error as error:
+        raised = error
+    unreachable = StateStore(session)
+    unreachable['HW'] = 'on'
+    if (raised is not None) and (unreachable.commit() == 0) and ('HW' in unreachable.dirty):
+        test_passes += 1
+
+    # With nothing waiting to be committed, a lost connection is replaced and the statement tried again
+    session = DBase('sqlite')
+    session.my_login()
+    session.cursor = DroppedCursor(session.backend)
+    if session.my_query("SELECT temp FROM target_temp") is not None:
+        test_passes += 1
+
+    # Part way through a transaction it isn't, as the earlier statements went with the connection
+    session.execute("UPDATE target_temp SET temp=(%s)", (5.0,))
+    session.cursor = DroppedCursor(session.backend)
+    try:
+        session.execute("UPDATE piheat SET piheat_control=(%s) WHERE piheat_function=(%s)", ('on', 'HW'))
+        raised = None
+    except session.backend.OperationalError as error:
+        raised = error
+    if (raised is not None) and (session.db is None):
+        test_passes += 1
+
+    # StateStore starts the whole transaction again, so both values are saved
+    pi_state = StateStore(DBase('sqlite'))
+    pi_state.load()
+    pi_state['HW'] = 'on' if pi_state['HW'] == 'off' else 'off'
+    pi_state.set_target_temp(pi_state.target_temp + 1)
+    pi_state.db.my_login()
+    execute = pi_state.db.execute
+    calls = []
+
+    def drop_second(sql, values=None):
+        calls.append(sql)
+        if len(calls) == 2:
+            pi_state.db.cursor = DroppedCursor(pi_state.db.backend)
+        return execute(sql, values)
+    pi_state.db.execute = drop_second
+    saved = pi_state.commit()
+    del pi_state.db.execute
+    check = StateStore(DBase('sqlite'))
+    check.load()
+    if (saved == 2) and (len(calls) == 4) and (check['HW'] == pi_state['HW']) \
+            and (check.target_temp == pi_state.target_temp):
+        test_passes += 1
+
+    logging.debug(("sim_db_errors passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_sim_push():
+    """Pushes a reading from templog, and checks piheat uses it until it goes stale.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_push'")
+    import socket
+    import templog
+    test_passes = 0
+    sub_tests = 5
+    my_db = DBase()
+    my_db.my_login()
+    piheat_sim.set_room_temp(my_db, 18.0)
+
+    # templog sends a datagram, which is handed to the listener as asyncio would
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(1)
+    pushed = []
+    listener = TempListener(temp_cache, ['127.0.0.1'], pushed.append)
+    if templog.push_readings({'28-0000000000aa': 22.5}, {'28-0000000000aa': 'living'}, receiver.getsockname()):
+        data, addr = receiver.recvfrom(1024)
+        listener.datagram_received(data, addr)
+    receiver.close()
+    if (pushed == ['living']) and (my_db.get_livtemp() == 22.5):
+        test_passes += 1
+
+    # Rubbish, and readings from anywhere else, are ignored
+    listener.datagram_received(b'{"rooms": 3}', ('127.0.0.1', 1))
+    listener.datagram_received(b'{"time": 0, "rooms": {"living": 5}}', ('10.0.0.1', 1))
+    if my_db.get_livtemp() == 22.5:
+        test_passes += 1
+
+    # A reading taken before the one already held is out of date
+    if not temp_cache.update('living', 10.0, 0):
+        test_passes += 1
+
+    # Once the pushes stop, the database is read again
+    temp_cache.update('living', 22.5, time.time(), time.time() - temp_cache.max_age - 1)
+    if my_db.get_livtemp() == 18.0:
+        test_passes += 1
+
+    # A lone sensor is the living room, however it is numbered, as it is in the database
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(1)
+    pushed.clear()
+    if templog.push_readings({'28-0000000000bb': 21.0}, templog.get_rooms([]), receiver.getsockname()):
+        data, addr = receiver.recvfrom(1024)
+        listener.datagram_received(data, addr)
+    receiver.close()
+    if (pushed == ['living']) and (my_db.get_livtemp() == 21.0) \
+            and (templog.living_room_temp({'28-0000000000bb': 21.0}) == 21.0):
+        test_passes += 1
+    temp_cache.readings.clear()
+    my_db.my_logout()
+    logging.debug(("sim_push passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_sim_sensors():
+    """Reads a simulated one-wire bus with templog.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_sensors'")
+    import templog
+    temps = {'28-0000000000aa': 21.5, '28-0000000000bb': 4.25}
+    with tempfile.TemporaryDirectory() as base:
+        piheat_sim.make_w1_tree(base, temps)
+        templog.w1_devices = base
+        sensors = templog.discover_sensors()
+        readings = templog.read_all(sensors)
+        # With no retries, a sensor that fails its CRC check is left out
+        piheat_sim.set_w1_temp(base, '28-0000000000bb', 4.25, crc_ok=False)
+        failed = templog.read_all(sensors, retries=0)
+    return (readings == temps) and (list(failed) == ['28-0000000000aa'])
+
+
+def test_sim_sensor_checks():
+    """Checks templog retries bad readings, rejects impossible values and spikes, and takes the median of samples.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_sim_sensor_checks'")
+    import templog
+    test_passes = 0
+    sub_tests = 6
+    serial = '28-0000000000cc'
+    saved = (templog.temp_raw, templog.read_backoff)
+    reads = []
+
+    def play(base, script):
+        """Makes each read of the sensor see the next of a series of (temperature, crc_ok) values."""
+        script = list(script)
+        del reads[:]
+
+        def temp_raw(path):
+            if script:
+                piheat_sim.set_w1_temp(base, serial, *script.pop(0))
+            reads.append(path)
+            return saved[0](path)
+        templog.temp_raw = temp_raw
+
+    templog.read_backoff = 0
+    try:
+        with tempfile.TemporaryDirectory() as base:
+            piheat_sim.make_w1_tree(base, {serial: 20.0})
+            path = os.path.join(base, serial, 'w1_slave')
+            templog.last_good.pop(path, None)
+
+            # A failed CRC check is retried...
+            play(base, [(20.0, False), (20.0, False), (20.0, True)])
+            if templog.read_once(path, retries=4) == (20.0, 2):
+                test_passes += 1
+            # ...until the retries run out
+            play(base, [(20.0, False)] * 3)
+            try:
+                templog.read_once(path, retries=2)
+                gave_up = False
+            except RuntimeError:
+                gave_up = True
+            if gave_up and (len(reads) == 3):
+                test_passes += 1
+
+            # The power-on value, and anything the DS18B20 can't measure, are read again
+            play(base, [(85.0, True), (130.0, True), (-60.0, True), (20.5, True)])
+            if templog.read_once(path, retries=4) == (20.5, 3):
+                test_passes += 1
+
+            # A sudden jump is only believed once it is seen twice...
+            play(base, [(35.0, True), (20.75, True)])
+            spike = templog.read_once(path, retries=4)
+            play(base, [(35.0, True), (35.25, True)])
+            change = templog.read_once(path, retries=4)
+            if (spike == (20.75, 1)) and (change == (35.25, 1)) and (templog.last_good[path] == 35.25):
+                test_passes += 1
+            # ...so one that never comes back is given up on
+            play(base, [(50.0, True), (20.0, True), (65.0, True)])
+            try:
+                templog.read_once(path, retries=2)
+                gave_up = False
+            except RuntimeError:
+                gave_up = True
+            if gave_up:
+                test_passes += 1
+
+            # --samples takes the median, so one odd reading doesn't count
+            play(base, [(35.0, True), (38.0, True), (35.5, True)])
+            temp_c, stats = templog.read_sensor(path, samples=3)
+            if (temp_c == 35.5) and (stats['retries'] == 0):
+                test_passes += 1
+            templog.last_good.pop(path, None)
+    finally:
+        templog.temp_raw, templog.read_backoff = saved
+    logging.debug(("sim_sensor_checks passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_credentials():
+    """Checks login details are found in the environment, a systemd credential and ~/.netrc, and re-read when changed.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_credentials'")
+    test_passes = 0
+    sub_tests = 4
+    saved_env = dict(os.environ)
+    saved_interval = credentials.CHECK_INTERVAL
+    home = tempfile.mkdtemp()
+    creds = tempfile.mkdtemp()
+    credentials.clear_cache()
+    try:
+        # Environment variables come first
+        os.environ['PIHEAT_DB_EXAMPLE_ORG_LOGIN'] = 'env_user'
+        os.environ['PIHEAT_DB_EXAMPLE_ORG_PASSWORD'] = 'env_pass'
+        if credentials.get_secrets('db.example.org') == ('env_user', None, 'env_pass'):
+            test_passes += 1
+        del os.environ['PIHEAT_DB_EXAMPLE_ORG_LOGIN']
+        del os.environ['PIHEAT_DB_EXAMPLE_ORG_PASSWORD']
+
+        # Then a systemd credential, which is read again once it changes
+        os.environ['CREDENTIALS_DIRECTORY'] = creds
+        os.environ['HOME'] = home
+        path = os.path.join(creds, 'db.example.org')
+        with open(path, 'w') as f:
+            f.write("machine db.example.org login cred_user account host1 password first\n")
+        first = credentials.get_secrets('db.example.org')
+        with open(path, 'w') as f:
+            f.write("machine db.example.org login cred_user account host1 password second\n")
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        cached = credentials.get_secrets('db.example.org')
+        credentials.CHECK_INTERVAL = 0
+        changed = credentials.get_secrets('db.example.org')
+        if (first == ('cred_user', 'host1', 'first')) and (cached == first) \
+                and (changed == ('cred_user', 'host1', 'second')):
+            test_passes += 1
+
+        # ~/.netrc is only trusted if no one else can read it
+        del os.environ['CREDENTIALS_DIRECTORY']
+        path = os.path.join(home, '.netrc')
+        with open(path, 'w') as f:
+            f.write("machine mail.example.org login home_user password secret\n")
+        os.chmod(path, 0o644)
+        try:
+            credentials.get_secrets('mail.example.org')
+            refused = False
+        except netrc.NetrcParseError:
+            refused = True
+        if refused:
+            test_passes += 1
+        os.chmod(path, 0o600)
+        credentials.clear_cache()
+        if credentials.get_secrets('mail.example.org') == ('home_user', '', 'secret'):
+            test_passes += 1
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        credentials.CHECK_INTERVAL = saved_interval
+        credentials.clear_cache()
+    logging.debug(("credentials passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+def test_logging():
+    """Checks log records are buffered, rate limited, written in batches, rotated and can be JSON.
+
+    return: boolean
+            (where True == 'passed' and False == 'failed')
+    """
+    logging.info("Running 'test_logging'")
+    test_passes = 0
+    sub_tests = 5
+    path = os.path.join(tempfile.gettempdir(), 'test_sim_piheat.log')
+    for name in (path, path + '.1'):
+        if os.path.exists(name):
+            os.remove(name)
+    target = piheat_log.BatchFileHandler(path, 2000, 1)
+    handler = piheat_log.RingBufferHandler(target, 5, 3600, logging.WARNING)
+    handler.setFormatter(piheat_log.JSONFormatter())
+    handler.addFilter(piheat_log.RateLimitFilter(3, 60))
+    logger = logging.getLogger('test_sim.logging')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+
+    def lines():
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    # Nothing is written until the buffer is flushed...
+    logger.info(("Wake-up", 1), extra={'timings': {'idle': 0.5}})
+    written = lines()
+    # ...which a warning does straight away, along with what came before it
+    logger.warning("Relay stuck")
+    records = lines()
+    if (written == []) and (len(records) == 2) and (records[0]['message'] == ['Wake-up', 1]) \
+            and (records[0]['timings'] == {'idle': 0.5}) and (records[1]['level'] == 'WARNING'):
+        test_passes += 1
+
+    # Only 3 of the same message get through, and only the newest 5 records are kept
+    for i in range(10):
+        logger.debug(("Temperatures are", i))
+    for i in range(6):
+        logger.debug(("Reading", i))
+    handler.flush()
+    records = lines()[2:]
+    if (records[0]['message'] == ['Log buffer full,', 1, 'records dropped']) \
+            and ([record['message'][1] for record in records[1:]] == [1, 2, 0, 1, 2]):
+        test_passes += 1
+
+    # The next one let through, after the period, says how many were left out
+    later = logging.LogRecord('test_sim.logging', logging.DEBUG, __file__, 0, ("Temperatures are", 10), None, None)
+    later.created += 61
+    logger.handle(later)
+    handler.flush()
+    if lines()[-1].get('suppressed') == 7:
+        test_passes += 1
+
+    # The file is rotated once it is full
+    for i in range(40):
+        logger.error(("Error %d" % i, "x" * 40))
+    if os.path.exists(path + '.1') and os.path.getsize(path) <= 2000:
+        test_passes += 1
+
+    # Plain text is as before, noting what the rate limit left out
+    record = logging.LogRecord('test_sim.logging', logging.INFO, __file__, 0, ("HW", "on"), None, None)
+    record.suppressed = 4
+    if piheat_log.TextFormatter(piheat_log.TEXT_FORMAT).format(record).endswith(
+            "('HW', 'on') (4 more like this left out)"):
+        test_passes += 1
+
+    logger.removeHandler(handler)
+    handler.close()
+    logging.debug(("logging passed", test_passes, "of", sub_tests, "sub-tests"))
+    return test_passes == sub_tests
+
+
+if __name__ == "__main__":
+    test_results['sim_relays'] = test_sim_relays()
+    test_results['sim_command_path'] = test_sim_command_path()
+    test_results['sim_command_queue'] = test_sim_command_queue()
+    test_results['sim_reconnect'] = test_sim_reconnect()
+    test_results['sim_mail_blocking'] = test_sim_mail_blocking()
+    test_results['sim_thermostat'] = test_sim_thermostat()
+    test_results['sim_command_target'] = test_sim_command_target()
+    test_results['hub_reset'] = test_hub_reset()
+    test_results['warmup'] = test_warmup()
+    test_results['schedule'] = test_schedule()
+    test_results['parse_command'] = test_parse_command()
+    test_results['sim_livtemp'] = test_sim_livtemp()
+    test_results['sim_readings'] = test_sim_readings()
+    test_results['sim_db_reads'] = test_sim_db_reads()
+    test_results['sim_db_errors'] = test_sim_db_errors()
+    test_results['sim_push'] = test_sim_push()
+    test_results['sim_sensors'] = test_sim_sensors()
+    test_results['sim_sensor_checks'] = test_sim_sensor_checks()
+    test_results['credentials'] = test_credentials()
+    test_results['logging'] = test_logging()
+    close_pools()
+
+    # Create a list containing the name of each test that failed
+    failed_tests = []
+    for testcase in test_results:
+        if not test_results[testcase]:
+            failed_tests.append(testcase)
+    if failed_tests:
+        logging.error(("The tests that failed are:", failed_tests))
+        print("The tests that failed are:", failed_tests)
+    else:
+        logging.info("All tests passed succesfully")
+        print("All tests passed succesfully")